@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Telegram Stars Bot - Handler load benchmark
+Drives the real handlers in bot.py with synthetic updates against a stubbed
+Bot API and reports throughput, latency percentiles and bytes read/written
+per update for each storage backend and database size
+
+Usage:
+    python benchmark.py
+    python benchmark.py --backends sqlite journal --users 1000 100000 1000000 --updates 5000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest, RequestData
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_USERNAME = 'bench_bot'
+
+# Share of each kind of update in the synthetic workload
+WORKLOAD = [
+    ('start_referral', 5),
+    ('start', 5),
+    ('account', 15),
+    ('daily_gift', 15),
+    ('tasks', 15),
+    ('task', 10),
+    ('verify', 10),
+    ('referral', 10),
+    ('withdraw', 10),
+    ('withdraw_amount', 5),
+]
+
+# =====================================================
+# FAKE BOT API - Canned responses, no network
+# =====================================================
+
+class FakeRequest(BaseRequest):
+    """
+    Answers every Bot API call locally with a minimal successful response
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': BOT_USERNAME}
+        elif endpoint == 'getChatMember':
+            user_id = int(params.get('user_id', 0))
+            result = {
+                'status': 'member' if user_id % 4 else 'left',
+                'user': {'id': user_id, 'is_bot': False, 'first_name': 'User'}
+            }
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            result = {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0) or 0), 'type': 'private'},
+                'text': 'ok'
+            }
+        else:
+            result = True
+
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+# =====================================================
+# SYNTHETIC DATA - Seeded users and updates
+# =====================================================
+
+def make_user(user_id: int, user_count: int, task_ids: List[str], rng: random.Random) -> Dict:
+    """
+    Build a plausible user record
+    """
+    joined = datetime.now() - timedelta(days=rng.randint(0, 365))
+    last_daily = datetime.now() - timedelta(hours=rng.randint(0, 72)) if rng.random() < 0.7 else None
+    return {
+        'user_id': user_id,
+        'stars': round(rng.uniform(0, 300), 1),
+        'completed_tasks': [task_id for task_id in task_ids if rng.random() < 0.5],
+        'last_daily_reward': last_daily.isoformat() if last_daily else None,
+        'referred_by': rng.randint(1, user_count) if user_id > 1 and rng.random() < 0.3 else None,
+        'username': f"user{user_id}",
+        'first_name': f"User {user_id}",
+        'join_date': joined.isoformat()
+    }
+
+def seed_storage(bot, user_count: int, rng: random.Random) -> float:
+    """
+    Fill the configured backend with user_count users
+    Returns seconds spent
+    """
+    started = time.perf_counter()
+    storage = bot.get_storage()
+    task_ids = [task['id'] for task in bot.TASKS]
+    # The JSON backend rewrites the whole file per batch, so give it one batch
+    batch_size = user_count if storage.name == 'json' else 10000
+    for first in range(1, user_count + 1, batch_size):
+        last = min(first + batch_size, user_count + 1)
+        storage.put_users([make_user(user_id, user_count, task_ids, rng) for user_id in range(first, last)])
+    return time.perf_counter() - started
+
+def user_dict(user_id: int) -> Dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}", 'username': f"user{user_id}"}
+
+def command_update(update_id: int, user_id: int, text: str) -> Dict:
+    command = text.split()[0]
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': user_dict(user_id),
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        }
+    }
+
+def callback_update(update_id: int, user_id: int, data: str) -> Dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': user_dict(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                # A distinct message per press, so no edit is skipped as unchanged
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench'},
+                'text': 'menu'
+            }
+        }
+    }
+
+def make_workload(count: int, user_count: int, task_ids: List[str], rng: random.Random) -> List[tuple]:
+    """
+    Build (route, update dict) pairs following WORKLOAD
+    """
+    kinds = [kind for kind, _ in WORKLOAD]
+    weights = [weight for _, weight in WORKLOAD]
+    next_new_user = user_count + 1
+    workload = []
+
+    for update_id in range(1, count + 1):
+        kind = rng.choices(kinds, weights)[0]
+        user_id = rng.randint(1, user_count)
+
+        if kind == 'start_referral':
+            update = command_update(update_id, next_new_user, f"/start {user_id}")
+            next_new_user += 1
+        elif kind == 'start':
+            update = command_update(update_id, user_id, "/start")
+        elif kind == 'task':
+            update = callback_update(update_id, user_id, f"task_{rng.choice(task_ids)}")
+        elif kind == 'verify':
+            update = callback_update(update_id, user_id, f"verify_{rng.choice(task_ids)}")
+        elif kind == 'withdraw_amount':
+            update = callback_update(update_id, user_id, "withdraw_50")
+        else:
+            update = callback_update(update_id, user_id, kind)
+        workload.append((kind, update))
+
+    return workload
+
+# =====================================================
+# MEASUREMENT - Latency percentiles and process I/O
+# =====================================================
+
+def read_io_counters() -> Dict[str, int]:
+    """
+    Bytes this process has read and written through syscalls (Linux only)
+    """
+    counters = {'rchar': 0, 'wchar': 0}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+    }
+
+async def drive(bot, workload: List[tuple], concurrency: int) -> Dict:
+    """
+    Feed the workload through the real handlers and time every update
+    """
+    request = FakeRequest()
+    application = (
+        Application.builder()
+        .token('1:benchmark')
+        .request(request)
+        .get_updates_request(FakeRequest())
+        .build()
+    )
+    bot.register_handlers(application)
+    await application.initialize()
+
+    latencies: Dict[str, List[float]] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(route: str, data: Dict) -> None:
+        async with semaphore:
+            update = Update.de_json(data, application.bot)
+            started = time.perf_counter()
+            await application.process_update(update)
+            latencies.setdefault(route, []).append(time.perf_counter() - started)
+
+    io_before = read_io_counters()
+    started = time.perf_counter()
+    await asyncio.gather(*(process(route, data) for route, data in workload))
+    # Write-behind caching defers work; charge the final flush to the run
+    bot.get_user_cache().flush()
+    elapsed = time.perf_counter() - started
+    io_after = read_io_counters()
+
+    await application.shutdown()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    throttle = bot.get_callback_throttle().stats()
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'throughput': round(len(workload) / elapsed, 1),
+        'bytes_read_per_update': round((io_after['rchar'] - io_before['rchar']) / len(workload)),
+        'bytes_written_per_update': round((io_after['wchar'] - io_before['wchar']) / len(workload)),
+        'api_calls': request.calls,
+        # Presses that never reached a handler and edits answered without
+        # an API call; both should be 0 with throttling and edit skipping off
+        'dropped': throttle['duplicates'] + throttle['throttled'],
+        'skipped_edits': bot.get_message_states().stats()['skipped'],
+        'cache': bot.get_user_cache().stats(),
+        **summarize(all_latencies),
+        'routes': {route: summarize(values) for route, values in sorted(latencies.items())},
+    }
+
+# =====================================================
+# RUNNER - One child process per backend and size
+# =====================================================
+
+def run_case(args: argparse.Namespace) -> None:
+    """
+    Child process entry: seed one backend and benchmark it
+    The working directory is a scratch directory owned by the parent
+    """
+    sys.path.insert(0, BOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    import bot
+
+    rng = random.Random(args.seed)
+    seed_seconds = seed_storage(bot, args.case_users, rng)
+    task_ids = [task['id'] for task in bot.TASKS]
+    workload = make_workload(args.updates, args.case_users, task_ids, rng)
+
+    result = asyncio.run(drive(bot, workload, args.concurrency))
+    result.update({
+        'backend': args.case_backend,
+        'users': args.case_users,
+        'updates': args.updates,
+        'seed_s': round(seed_seconds, 2),
+    })
+    bot.get_storage().close()
+    print(json.dumps(result))
+
+def launch_case(args: argparse.Namespace, backend: str, user_count: int) -> Optional[Dict]:
+    """
+    Run one case in a fresh process so backends don't share state or I/O counters
+    """
+    with tempfile.TemporaryDirectory(prefix='stars-bench-') as workdir:
+        env = dict(os.environ)
+        env.update({
+            'STORAGE_BACKEND': backend,
+            'SQLITE_DATABASE_FILE': os.path.join(workdir, 'bench.sqlite3'),
+            'JOURNAL_SNAPSHOT_FILE': os.path.join(workdir, 'bench.snapshot.jsonl'),
+            'JOURNAL_FILE': os.path.join(workdir, 'bench.journal'),
+            'OUTBOX_FILE': os.path.join(workdir, 'bench_outbox.sqlite3'),
+            'USER_CACHE_SIZE': str(args.cache_size),
+            'MEMBERSHIP_CHECK_RATE': '1000000',
+            'MEMBERSHIP_CHECK_BURST': '1000000',
+            # Measure handler work: no presses dropped, no edits skipped
+            'THROTTLE_RATE': '0',
+            'MESSAGE_STATE_SIZE': '0',
+        })
+        command = [
+            sys.executable, os.path.abspath(__file__),
+            '--case-backend', backend,
+            '--case-users', str(user_count),
+            '--updates', str(args.updates),
+            '--concurrency', str(args.concurrency),
+            '--seed', str(args.seed),
+        ]
+        completed = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+
+    if completed.returncode != 0:
+        print(f"❌ {backend} with {user_count} users failed:\n{completed.stderr}")
+        return None
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def print_report(results: List[Dict], by_route: bool) -> None:
+    header = (f"{'backend':<8} {'users':>9} {'upd/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+              f"{'read B/upd':>11} {'write B/upd':>12} {'seed s':>7} {'dropped':>8} {'skipped':>8}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['backend']:<8} {r['users']:>9} {r['throughput']:>9} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+              f"{r['p99_ms']:>8} {r['bytes_read_per_update']:>11} {r['bytes_written_per_update']:>12} "
+              f"{r['seed_s']:>7} {r['dropped']:>8} {r['skipped_edits']:>8}")
+
+    if by_route:
+        for r in results:
+            print(f"\n{r['backend']} / {r['users']} users")
+            for route, stats in r['routes'].items():
+                print(f"  {route:<16} n={stats['count']:<6} p50={stats['p50_ms']}ms "
+                      f"p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark bot handlers against each storage backend")
+    parser.add_argument('--backends', nargs='+', default=['sqlite', 'journal', 'json'],
+                        help="Storage backends to compare")
+    parser.add_argument('--users', nargs='+', type=int, default=[1000, 10000],
+                        help="Database sizes to seed (e.g. 1000 100000 1000000)")
+    parser.add_argument('--updates', type=int, default=2000, help="Updates to send per case")
+    parser.add_argument('--concurrency', type=int, default=32, help="Updates in flight at once")
+    parser.add_argument('--cache-size', type=int, default=10000, help="USER_CACHE_SIZE for the run")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed for data and workload")
+    parser.add_argument('--by-route', action='store_true', help="Also print latency per route")
+    parser.add_argument('--json', action='store_true', help="Print raw results as JSON")
+    parser.add_argument('--case-backend', help=argparse.SUPPRESS)
+    parser.add_argument('--case-users', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case_backend:
+        run_case(args)
+        return
+
+    results = []
+    for backend in args.backends:
+        for user_count in args.users:
+            print(f"⏱  {backend}: {user_count} users, {args.updates} updates...", file=sys.stderr)
+            result = launch_case(args, backend, user_count)
+            if result:
+                results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results, args.by_route)
+
+if __name__ == '__main__':
+    main()
@@ -5,19 +5,44 @@ A complete bot system for earning stars through referrals, daily rewards, and ch
 """
 
 import os
+import sys
 import logging
+import argparse
+import sqlite3
+import asyncio
+import multiprocessing
+import signal
+import threading
+import time
+import bisect
+import random
+import heapq
+import csv
+import gzip
+import hashlib
+import shutil
+from collections import OrderedDict, deque
+from itertools import islice
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from typing import Any, Awaitable, Callable, Optional, Dict, List, Iterable, Iterator
 import json
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, CallbackQuery
+from telegram.helpers import escape_markdown
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters
 )
+from telegram.request import HTTPXRequest
 
 # =====================================================
 # CONFIGURATION - Use environment variables for security
@@ -26,9 +51,61 @@ BOT_TOKEN = '8586101763:AAEDdNdiFy6lfMezzbiFwGuKJ88hTOV7t1I';  # Bot token from
 ADMIN_ID = 7504646622;  # Admin Telegram ID
 
 # =====================================================
-# DATABASE STRUCTURE - Using JSON file for simplicity
+# DATABASE STRUCTURE - SQLite by default, legacy JSON file supported
 # =====================================================
 DATABASE_FILE = 'bot_database.json'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')  # 'sqlite', 'journal' or 'json'
+SQLITE_DATABASE_FILE = os.getenv('SQLITE_DATABASE_FILE', 'bot_database.sqlite3')
+JOURNAL_SNAPSHOT_FILE = os.getenv('JOURNAL_SNAPSHOT_FILE', 'bot_database.snapshot.jsonl')
+JOURNAL_FILE = os.getenv('JOURNAL_FILE', 'bot_database.journal')
+JOURNAL_FSYNC_INTERVAL = float(os.getenv('JOURNAL_FSYNC_INTERVAL', '1'))  # Seconds between fsyncs, 0 = every write
+JOURNAL_COMPACT_BYTES = int(os.getenv('JOURNAL_COMPACT_BYTES', str(64 * 1024 * 1024)))  # Journal size that triggers compaction
+JOURNAL_COMPACT_INTERVAL = float(os.getenv('JOURNAL_COMPACT_INTERVAL', '3600'))  # Compact at least this often (seconds)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))  # Users kept in memory, 0 disables caching
+CACHE_FLUSH_INTERVAL = float(os.getenv('CACHE_FLUSH_INTERVAL', '5'))  # Seconds between write-behind flushes
+CACHE_FLUSH_BATCH = int(os.getenv('CACHE_FLUSH_BATCH', '500'))  # Dirty users that trigger an early flush
+USER_LOCK_STRIPES = 256  # Number of per-user lock stripes for atomic updates
+STORAGE_WORKERS = int(os.getenv('STORAGE_WORKERS', '4'))  # Threads running storage calls off the event loop
+REFERRAL_LEVELS = int(os.getenv('REFERRAL_LEVELS', '3'))  # Referral levels tracked for network stats
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'snapshots')  # Compressed point-in-time copies of the database
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', '3600'))  # Seconds between snapshots, 0 disables them
+SNAPSHOT_KEEP = int(os.getenv('SNAPSHOT_KEEP', '24'))  # Snapshots kept, older ones are deleted
+
+# =====================================================
+# SERVING MODE - Long polling or webhook
+# =====================================================
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # 'polling' or 'webhook'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Public HTTPS base URL Telegram posts updates to
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Checked against X-Telegram-Bot-Api-Secret-Token
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))  # Updates processed in parallel, 1 = sequential
+CONNECTION_POOL_SIZE = int(os.getenv('CONNECTION_POOL_SIZE', '64'))  # HTTP connections for Bot API calls
+BOT_API_BASE_URL = os.getenv('BOT_API_BASE_URL', 'https://api.telegram.org/bot')  # Point at a local Bot API server if you run one
+CLUSTER_WORKERS = int(os.getenv('CLUSTER_WORKERS', str(os.cpu_count() or 1)))  # Worker processes for `python bot.py cluster`
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', '2'))  # Button presses per second per user, 0 disables throttling
+THROTTLE_BURST = float(os.getenv('THROTTLE_BURST', '5'))  # Presses a user may make in a burst
+DEBOUNCE_WINDOW = float(os.getenv('DEBOUNCE_WINDOW', '1'))  # Seconds during which repeated presses of one button are dropped
+THROTTLE_MAX_USERS = 100000  # Users whose press history is kept in memory
+MESSAGE_STATE_SIZE = int(os.getenv('MESSAGE_STATE_SIZE', '100000'))  # Messages whose shown content is remembered, 0 always edits
+# Only the update types the bot actually handles
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# =====================================================
+# VERIFICATION SETTINGS - Channel membership checks
+# =====================================================
+MEMBERSHIP_POSITIVE_TTL = float(os.getenv('MEMBERSHIP_POSITIVE_TTL', '60'))  # Seconds to trust "is a member"
+MEMBERSHIP_NEGATIVE_TTL = float(os.getenv('MEMBERSHIP_NEGATIVE_TTL', '5'))  # Seconds to trust "not a member"
+MEMBERSHIP_CHECK_RATE = float(os.getenv('MEMBERSHIP_CHECK_RATE', '20'))  # getChatMember calls per second, 0 for no limit
+MEMBERSHIP_CHECK_BURST = float(os.getenv('MEMBERSHIP_CHECK_BURST', '20'))  # Calls allowed in a burst
+MEMBERSHIP_MAX_WAIT = float(os.getenv('MEMBERSHIP_MAX_WAIT', '30'))  # Longest a check may wait in the queue
+SWEEP_INTERVAL = float(os.getenv('SWEEP_INTERVAL', '86400'))  # Seconds between re-verification passes, 0 disables them
+SWEEP_RATE = float(os.getenv('SWEEP_RATE', '5'))  # Re-verification checks per second, taken from MEMBERSHIP_CHECK_RATE, 0 for no limit
+SWEEP_CONCURRENCY = int(os.getenv('SWEEP_CONCURRENCY', '5'))  # Re-verification checks in flight at once
+SWEEP_BATCH_SIZE = int(os.getenv('SWEEP_BATCH_SIZE', '200'))  # Completions per checkpoint
+SWEEP_ACTION = os.getenv('SWEEP_ACTION', 'clawback')  # 'clawback' takes the reward back, 'flag' only reports
+SWEEP_STATE_FILE = os.getenv('SWEEP_STATE_FILE', 'bot_sweep.json')  # Checkpoint of the running pass
 
 # =====================================================
 # CONSTANTS - Bot settings and rewards
@@ -37,10 +114,16 @@ REFERRAL_REWARD = 0.5  # Stars earned per referral
 TASK_REWARD = 2.0  # Stars earned per completed task
 DAILY_REWARD = 2.0  # Stars earned from daily gift
 WITHDRAWAL_AMOUNTS = [50, 100, 200, 300]  # Available withdrawal amounts
+WITHDRAWALS_PAGE_SIZE = 20  # Requests per page in /withdrawals
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', '10'))  # Users listed by /top
 
 # =====================================================
 # TASKS CONFIGURATION - Channels/Groups to join
 # =====================================================
+TASKS_FILE = os.getenv('TASKS_FILE', 'tasks.json')  # Task catalog, reloaded when it changes
+TASKS_RELOAD_INTERVAL = float(os.getenv('TASKS_RELOAD_INTERVAL', '5'))  # Seconds between checks for changes
+# Default catalog, used while TASKS_FILE doesn't exist. Tasks may also set
+# 'max_completions' (retired once reached) and 'active': False
 TASKS = [
     {
         'id': 'task_1',
@@ -61,6 +144,31 @@ TASKS = [
     # Add more tasks here
 ]
 
+# =====================================================
+# OUTBOUND MESSAGES - Notification queue and Telegram limits
+# =====================================================
+OUTBOX_FILE = os.getenv('OUTBOX_FILE', 'bot_outbox.sqlite3')  # Pending messages survive restarts here
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '25'))  # Messages per second across all chats, 0 for no limit
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))  # Messages per second to a single chat, 0 for no limit
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '8'))  # Concurrent senders
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))  # Network failures before a message is dropped
+BROADCAST_STATE_FILE = os.getenv('BROADCAST_STATE_FILE', 'bot_broadcast.json')  # Checkpoint of the running broadcast
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '500'))  # Recipients per checkpoint
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '25'))  # Sends in flight at once
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '15'))  # Seconds between progress updates
+REMINDER_INTERVAL = float(os.getenv('REMINDER_INTERVAL', '60'))  # Seconds between daily gift reminder runs, 0 disables
+REMINDER_BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', '1000'))  # Most reminders queued per run
+
+# =====================================================
+# MONITORING - Prometheus metrics endpoint
+# =====================================================
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))  # GET /metrics, /healthz and /readyz, 0 disables the endpoint
+HEALTH_MAX_LOOP_LAG = float(os.getenv('HEALTH_MAX_LOOP_LAG', '5'))  # Event loop lag (seconds) that fails /healthz
+HEALTH_STORAGE_TIMEOUT = float(os.getenv('HEALTH_STORAGE_TIMEOUT', '10'))  # Storage probe time that fails /healthz
+HEALTH_MAX_OUTBOX = int(os.getenv('HEALTH_MAX_OUTBOX', '10000'))  # Queued messages that fail /readyz
+HEALTH_MAX_RETRY_AFTER = float(os.getenv('HEALTH_MAX_RETRY_AFTER', '30'))  # Telegram flood wait that fails /readyz
+
 # =====================================================
 # LOGGING SETUP - Track bot activities
 # =====================================================
@@ -70,6 +178,225 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# =====================================================
+# METRICS - Prometheus counters and latency histograms
+# =====================================================
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """
+    Monotonic counter with labels, rendered in Prometheus text format
+    """
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    """
+    Cumulative-bucket histogram with labels, rendered in Prometheus text format
+    """
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._series: Dict[tuple, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values) -> Iterator[None]:
+        """
+        Observe how long the with-block took
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), series):
+                    cumulative += count
+                    labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {series[-1]}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+HANDLER_LATENCY = Histogram('bot_handler_duration_seconds', "Time spent in update handlers", ('handler', 'route'))
+HANDLER_CALLS = Counter('bot_handler_calls_total', "Handler invocations by outcome", ('handler', 'route', 'outcome'))
+STORAGE_LATENCY = Histogram('bot_storage_duration_seconds', "Time spent in storage calls", ('backend', 'operation'))
+API_LATENCY = Histogram('bot_api_duration_seconds', "Time spent in Bot API requests", ('method',))
+API_CALLS = Counter('bot_api_requests_total', "Bot API requests by outcome", ('method', 'outcome'))
+
+METRICS = [HANDLER_LATENCY, HANDLER_CALLS, STORAGE_LATENCY, API_LATENCY, API_CALLS]
+# Callables returning extra exposition lines (gauges read at scrape time)
+METRIC_COLLECTORS: List[Callable[[], Iterable[str]]] = []
+
+def render_metrics() -> str:
+    """
+    Render every registered metric in Prometheus text format
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for collector in METRIC_COLLECTORS:
+        try:
+            lines.extend(collector())
+        except Exception as e:
+            logger.error(f"Metrics collector failed: {e}")
+    return '\n'.join(lines) + '\n'
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    HTTPXRequest that records latency and outcome of every Bot API call
+    """
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple:
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            outcome = str(code)
+            if code >= 400:
+                get_health_monitor().api_error(api_method, code, payload)
+            return code, payload
+        except Exception as e:
+            get_health_monitor().api_error(api_method, None, str(e).encode('utf-8'))
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - start, api_method)
+            API_CALLS.inc(api_method, outcome)
+
+# =====================================================
+# HTTP SERVER - Minimal endpoint server for metrics and probes
+# =====================================================
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+                500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+class HttpServer:
+    """
+    Tiny asyncio HTTP/1.0 server for internal endpoints
+    Routes map (method, path) to async callables taking the request body and
+    lower-cased headers and returning (status, content_type, body).
+    One request per connection
+    """
+
+    def __init__(self, host: str, port: int, max_body: int = 1024 * 1024):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self._routes: Dict[tuple, Callable[[bytes, Dict[str, str]], Any]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def route(self, method: str, path: str, handler: Callable[[bytes, Dict[str, str]], Any]) -> None:
+        """
+        Register handler for method (GET/POST) and path
+        """
+        self._routes[(method.upper(), path)] = handler
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"HTTP endpoints listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            response = await asyncio.wait_for(self._respond(reader), 10)
+        except Exception as e:
+            logger.error(f"HTTP endpoint error: {e}")
+            response = (500, 'text/plain', b'internal error\n')
+        status, content_type, body = response
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        head = (
+            f"HTTP/1.0 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        try:
+            writer.write(head.encode('latin-1') + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _respond(self, reader: asyncio.StreamReader) -> tuple:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) < 2:
+            return 400, 'text/plain', b'bad request\n'
+        method, target = request_line[0].upper(), request_line[1]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > self.max_body:
+            return 400, 'text/plain', b'body too large\n'
+        body = await reader.readexactly(length) if length else b''
+
+        path = target.split('?', 1)[0]
+        handler = self._routes.get((method, path))
+        if handler is None:
+            if any(route_path == path for _, route_path in self._routes):
+                return 405, 'text/plain', b'method not allowed\n'
+            return 404, 'text/plain', b'not found\n'
+        return await handler(body, headers)
+
 # =====================================================
 # DATABASE MANAGEMENT - Load and save user data
 # =====================================================
@@ -88,249 +415,4640 @@ def load_database() -> Dict:
         logger.error(f"Error loading database: {e}")
         return {}
 
+def iter_json_object(path: str, chunk_size: int = 65536) -> Iterator[tuple]:
+    """
+    Stream the (key, value) pairs of a file holding one JSON object
+    Only the pair being decoded is kept in memory, so this also works on
+    databases that are too large to json.load
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        pos = 0
+
+        def peek() -> str:
+            # Next non-whitespace character, '' at the end of the file
+            nonlocal buffer, pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buffer):
+                    return buffer[pos]
+                buffer, pos = f.read(chunk_size), 0
+                if not buffer:
+                    return ''
+
+        def expect(chars: str) -> str:
+            nonlocal pos
+            char = peek()
+            if not char or char not in chars:
+                raise ValueError(f"{path}: expected one of {chars!r} near character {f.tell()}")
+            pos += 1
+            return char
+
+        def value() -> Any:
+            # Values are objects or strings, so a value cut off at the end
+            # of the buffer fails to decode instead of decoding short
+            nonlocal buffer, pos
+            peek()
+            while True:
+                try:
+                    result, pos = decoder.raw_decode(buffer, pos)
+                    return result
+                except json.JSONDecodeError:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        raise
+                    buffer, pos = buffer[pos:] + chunk, 0
+
+        if not peek():
+            return
+        expect('{')
+        if peek() == '}':
+            return
+        while True:
+            key = value()
+            expect(':')
+            yield key, value()
+            if expect(',}') == '}':
+                return
+
 def save_database(data: Dict) -> None:
     """
     Save user database to JSON file
-    Creates backup before saving
+    The file is replaced atomically, so a crash mid-write leaves the old
+    one intact. Backups are taken by the snapshot scheduler, not here
     """
     try:
-        # Create backup
-        if os.path.exists(DATABASE_FILE):
-            backup_file = f"{DATABASE_FILE}.backup"
-            with open(DATABASE_FILE, 'r', encoding='utf-8') as f:
-                backup_data = f.read()
-            with open(backup_file, 'w', encoding='utf-8') as f:
-                f.write(backup_data)
-        
-        # Save new data
-        with open(DATABASE_FILE, 'w', encoding='utf-8') as f:
+        tmp_file = f"{DATABASE_FILE}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_file, DATABASE_FILE)
     except Exception as e:
         logger.error(f"Error saving database: {e}")
 
-def get_user_data(user_id: int) -> Dict:
-    """
-    Get user data from database
-    Creates new user if doesn't exist
-    """
-    db = load_database()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in db:
-        # Create new user with default values
-        db[user_id_str] = {
-            'user_id': user_id,
-            'stars': 0.0,
-            'referrals': [],
-            'completed_tasks': [],
-            'last_daily_reward': None,
-            'referred_by': None,
-            'username': None,
-            'first_name': None,
-            'join_date': datetime.now().isoformat(),
-            'withdrawal_requests': []
-        }
-        save_database(db)
-    
-    return db[user_id_str]
-
-def update_user_data(user_id: int, data: Dict) -> None:
+def new_user_record(user_id: int) -> Dict:
     """
-    Update user data in database
+    Build a fresh user record with default values
     """
-    db = load_database()
-    db[str(user_id)] = data
-    save_database(db)
+    return {
+        'user_id': user_id,
+        'stars': 0.0,
+        'completed_tasks': [],
+        'last_daily_reward': None,
+        'referred_by': None,
+        'username': None,
+        'first_name': None,
+        'join_date': datetime.now().isoformat(),
+        'blocked': False,
+        # Opt-in daily gift reminder and when it is due (None = nothing scheduled)
+        'daily_reminder': False,
+        'next_reminder': None
+    }
 
-def add_stars(user_id: int, amount: float, reason: str = "") -> float:
+def withdrawal_row(row: tuple) -> Dict:
     """
-    Add stars to user account
-    Returns new total
+    Build a withdrawal dict from an (id, user_id, amount, date, status) row
     """
-    user_data = get_user_data(user_id)
-    user_data['stars'] = round(user_data['stars'] + amount, 2)
-    update_user_data(user_id, user_data)
-    logger.info(f"Added {amount} stars to user {user_id}. Reason: {reason}")
-    return user_data['stars']
+    return {'id': row[0], 'user_id': row[1], 'amount': row[2], 'date': row[3], 'status': row[4]}
 
 # =====================================================
-# KEYBOARD LAYOUTS - Main menu and navigation
+# USER RECORDS - Compact in-memory representation
 # =====================================================
 
-def get_main_menu_keyboard() -> InlineKeyboardMarkup:
+EPOCH = datetime(1970, 1, 1)
+
+def pack_time(value: Any) -> Any:
     """
-    Generate main menu keyboard with all options
+    Turn an ISO timestamp into integer microseconds since EPOCH
+    Anything that wouldn't convert back to the same string is kept as is
     """
-    keyboard = [
-        [InlineKeyboardButton("⭐️ My Account", callback_data='account')],
-        [InlineKeyboardButton("🎁 Daily Gift", callback_data='daily_gift')],
-        [InlineKeyboardButton("📋 Tasks", callback_data='tasks')],
-        [InlineKeyboardButton("👥 Referral", callback_data='referral')],
-        [InlineKeyboardButton("💰 Withdraw", callback_data='withdraw')],
-        [InlineKeyboardButton("ℹ️ Help", callback_data='help')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    if not isinstance(value, str):
+        return value
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if moment.tzinfo is not None or moment.isoformat() != value:
+        return value
+    return (moment - EPOCH) // timedelta(microseconds=1)
 
-def get_back_keyboard() -> InlineKeyboardMarkup:
+def unpack_time(value: Any) -> Any:
     """
-    Generate back button keyboard
+    Inverse of pack_time
     """
-    keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]]
-    return InlineKeyboardMarkup(keyboard)
+    if isinstance(value, int):
+        return (EPOCH + timedelta(microseconds=value)).isoformat()
+    return value
 
-def get_tasks_keyboard(user_id: int) -> InlineKeyboardMarkup:
+class TaskBits:
     """
-    Generate tasks keyboard with completion status
+    Assigns every task id a bit position for completion bitsets
+    Positions are handed out on first use and never reused, so retiring
+    or reordering tasks never changes what a stored bitset means
     """
-    user_data = get_user_data(user_id)
-    completed_tasks = user_data.get('completed_tasks', [])
-    
-    keyboard = []
-    for task in TASKS:
-        if task['id'] in completed_tasks:
-            status = "✅"
-        else:
-            status = "❌"
-        
-        keyboard.append([
-            InlineKeyboardButton(
-                f"{status} {task['name']}",
-                callback_data=f"task_{task['id']}"
-            )
-        ])
-    
-    keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')])
-    return InlineKeyboardMarkup(keyboard)
 
-def get_withdrawal_keyboard() -> InlineKeyboardMarkup:
+    def __init__(self):
+        self._ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def position(self, task_id: str) -> int:
+        position = self._positions.get(task_id)
+        if position is None:
+            with self._lock:
+                position = self._positions.get(task_id)
+                if position is None:
+                    position = self._positions[task_id] = len(self._ids)
+                    self._ids.append(task_id)
+        return position
+
+    def encode(self, task_ids: Iterable[str]) -> int:
+        mask = 0
+        for task_id in task_ids:
+            mask |= 1 << self.position(task_id)
+        return mask
+
+    def decode(self, mask: int) -> List[str]:
+        task_ids = []
+        while mask:
+            low = mask & -mask
+            task_ids.append(self._ids[low.bit_length() - 1])
+            mask ^= low
+        return task_ids
+
+    def ids(self, start: int = 0) -> List[str]:
+        """
+        Task ids from position start onwards, in position order
+        """
+        return self._ids[start:]
+
+TASK_BITS = TaskBits()
+
+class UserRecord:
     """
-    Generate withdrawal amounts keyboard
+    Slotted form of a user record for users held in memory
+    Completed tasks are a TASK_BITS bitset and timestamps are integers.
+    Referrals live in the referral index, not on the record. Keys a record
+    doesn't model (e.g. legacy referral lists) are kept in extra.
+    Records are never mutated once built: callers get plain dicts from
+    to_dict() and hand changed dicts back to from_dict()
     """
-    keyboard = []
-    for amount in WITHDRAWAL_AMOUNTS:
-        keyboard.append([
-            InlineKeyboardButton(
-                f"💎 {amount} Stars",
-                callback_data=f"withdraw_{amount}"
-            )
-        ])
-    
-    keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')])
-    return InlineKeyboardMarkup(keyboard)
+
+    __slots__ = ('user_id', 'stars', 'tasks', 'last_daily_reward', 'referred_by', 'username', 'first_name',
+                 'join_date', 'blocked', 'daily_reminder', 'next_reminder', 'extra')
+
+    FIELDS = frozenset(('user_id', 'stars', 'completed_tasks', 'last_daily_reward', 'referred_by', 'username',
+                        'first_name', 'join_date', 'blocked', 'daily_reminder', 'next_reminder'))
+    # Flag bits in the packed form
+    BLOCKED = 1
+    DAILY_REMINDER = 2
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'UserRecord':
+        record = cls.__new__(cls)
+        record.user_id = data['user_id']
+        record.stars = data.get('stars', 0.0)
+        record.tasks = TASK_BITS.encode(data.get('completed_tasks', []))
+        record.last_daily_reward = pack_time(data.get('last_daily_reward'))
+        record.referred_by = data.get('referred_by')
+        record.username = data.get('username')
+        record.first_name = data.get('first_name')
+        record.join_date = pack_time(data.get('join_date'))
+        record.blocked = bool(data.get('blocked'))
+        record.daily_reminder = bool(data.get('daily_reminder'))
+        record.next_reminder = pack_time(data.get('next_reminder'))
+        extra = {key: value for key, value in data.items() if key not in cls.FIELDS}
+        record.extra = copy_record(extra) if extra else None
+        return record
+
+    def to_dict(self) -> Dict:
+        data = {
+            'user_id': self.user_id,
+            'stars': self.stars,
+            'completed_tasks': TASK_BITS.decode(self.tasks),
+            'last_daily_reward': unpack_time(self.last_daily_reward),
+            'referred_by': self.referred_by,
+            'username': self.username,
+            'first_name': self.first_name,
+            'join_date': unpack_time(self.join_date),
+            'blocked': self.blocked,
+            'daily_reminder': self.daily_reminder,
+            'next_reminder': unpack_time(self.next_reminder)
+        }
+        if self.extra:
+            data.update(copy_record(self.extra))
+        return data
+
+    def has_task(self, task_id: str) -> bool:
+        return bool(self.tasks >> TASK_BITS.position(task_id) & 1)
+
+    def pack(self) -> list:
+        """
+        Positional form for the journal; bits refer to the TASK_BITS
+        positions listed in the file's {"tasks": ...} lines
+        """
+        flags = (self.BLOCKED if self.blocked else 0) | (self.DAILY_REMINDER if self.daily_reminder else 0)
+        packed = [self.user_id, self.stars, self.tasks, self.join_date, self.last_daily_reward, self.referred_by,
+                  self.username, self.first_name, flags, self.next_reminder]
+        if self.extra:
+            packed.append(self.extra)
+        return packed
+
+    @classmethod
+    def unpack(cls, packed: list, task_ids: List[str]) -> 'UserRecord':
+        """
+        Inverse of pack; task_ids maps the file's bit positions to task ids
+        """
+        record = cls.__new__(cls)
+        (record.user_id, record.stars, mask, record.join_date, record.last_daily_reward, record.referred_by,
+         record.username, record.first_name, flags, record.next_reminder) = packed[:10]
+        record.tasks = 0
+        while mask:
+            low = mask & -mask
+            record.tasks |= 1 << TASK_BITS.position(task_ids[low.bit_length() - 1])
+            mask ^= low
+        record.blocked = bool(flags & cls.BLOCKED)
+        record.daily_reminder = bool(flags & cls.DAILY_REMINDER)
+        record.extra = packed[10] if len(packed) > 10 else None
+        return record
 
 # =====================================================
-# COMMAND HANDLERS - Bot commands
+# STORAGE BACKENDS - Pluggable persistence for user records
 # =====================================================
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def referrals_from_records(records: Iterable[Dict]) -> Iterator[tuple]:
     """
-    Handle /start command
-    Process referral links and welcome new users
+    Yield (referrer_id, referee_id) pairs stored on user records
     """
-    user = update.effective_user
-    user_id = user.id
-    
-    # Update user info
-    user_data = get_user_data(user_id)
-    user_data['username'] = user.username
-    user_data['first_name'] = user.first_name
-    
-    # Check for referral parameter
-    if context.args and len(context.args) > 0:
-        referrer_id = context.args[0]
-        try:
-            referrer_id = int(referrer_id)
-            
-            # Check if user hasn't been referred before and not self-referral
-            if user_data['referred_by'] is None and referrer_id != user_id:
-                user_data['referred_by'] = referrer_id
-                
-                # Add referral reward to referrer
-                referrer_data = get_user_data(referrer_id)
-                referrer_data['referrals'].append(user_id)
-                add_stars(referrer_id, REFERRAL_REWARD, f"Referral from {user_id}")
-                update_user_data(referrer_id, referrer_data)
-                
-                # Notify referrer
-                try:
-                    await context.bot.send_message(
-                        chat_id=referrer_id,
-                        text=f"🎉 Great news! @{user.username or user.first_name} joined using your referral link!\n"
-                             f"💰 You earned {REFERRAL_REWARD} stars!"
-                    )
-                except Exception as e:
-                    logger.error(f"Could not notify referrer {referrer_id}: {e}")
-        except ValueError:
-            pass
-    
-    update_user_data(user_id, user_data)
-    
-    # Welcome message with large star emoji
-    welcome_text = (
-        f"⭐️⭐️⭐️⭐️⭐️\n\n"
-        f"🌟 **Welcome to Telegram Stars Bot!** 🌟\n\n"
-        f"Hello, {user.first_name}! @{user.username or 'User'}\n\n"
-        f"🎯 **Start earning Telegram Stars now!**\n\n"
-        f"💫 **How to earn:**\n"
-        f"🎁 Daily gifts - {DAILY_REWARD} stars\n"
-        f"📋 Complete tasks - {TASK_REWARD} stars each\n"
-        f"👥 Refer friends - {REFERRAL_REWARD} stars per referral\n
-        f"🚀 Choose an option below to get started!"
-    )
-    
-    await update.message.reply_text(
-        welcome_text,
-        reply_markup=get_main_menu_keyboard(),
-        parse_mode='Markdown'
-    )
+    for record in records:
+        if record.get('referred_by') is not None:
+            yield record['referred_by'], record['user_id']
+        # Older databases also kept a list of referees on the referrer
+        for referee_id in record.get('referrals', []):
+            yield record['user_id'], referee_id
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+class StorageBackend:
     """
-    Handle /help command
+    Base class for user record storage
+    Backends exchange plain user dicts (same shape as new_user_record).
+    Withdrawal requests are kept outside the user records, indexed by
+    status and date, so admins can page and settle them without a scan
     """
-    help_text = (
-        "📖 **Bot Help Guide**\n\n"
-        "🌟 **Available Commands:**\n"
-        "/start - Start the bot\n"
-        "/help - Show this help message\n"
-        "/account - View your account details\n\n"
-        "💫 **How to Use:**\n\n"
-        "1️⃣ **Daily Gift**: Claim your daily reward every 24 hours\n"
-        "2️⃣ **Tasks**: Join channels/groups to earn stars\n"
-        "3️⃣ **Referral**: Share your link and earn from referrals\n"
-        "4️⃣ **Withdraw**: Request withdrawal when you have enough stars\n"
-        "5️⃣ **Account**: Check your balance and statistics\n\n"
-        "❓ **Need Support?** Contact admin for help!"
-    )
-    
-    await update.message.reply_text(
-        help_text,
-        reply_markup=get_back_keyboard(),
-        parse_mode='Markdown'
-    )
 
-async def account_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    name = 'base'
+    # True when the backend started without any existing data
+    is_new = False
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        """
+        Return the stored record for user_id, or None if unknown
+        """
+        raise NotImplementedError
+
+    def put_user(self, user_id: int, data: Dict) -> None:
+        """
+        Insert or replace the record for user_id
+        """
+        raise NotImplementedError
+
+    def put_users(self, records: Iterable[Dict]) -> None:
+        """
+        Insert or replace several records
+        Backends override this to write the whole batch at once
+        """
+        for record in records:
+            self.put_user(record['user_id'], record)
+
+    def iter_referrals(self) -> Iterator[tuple]:
+        """
+        Yield every (referrer_id, referee_id) pair
+        """
+        raise NotImplementedError
+
+    def iter_balances(self) -> Iterator[tuple]:
+        """
+        Yield (user_id, stars) for every user with a positive balance
+        """
+        raise NotImplementedError
+
+    def iter_reminders(self) -> Iterator[tuple]:
+        """
+        Yield (user_id, next_reminder) for every user with a reminder scheduled
+        """
+        raise NotImplementedError
+
+    def count_completions(self) -> Dict[str, int]:
+        """
+        Number of users who completed each task
+        """
+        raise NotImplementedError
+
+    def iter_completions(self, after: tuple = (0, '')) -> Iterator[tuple]:
+        """
+        Yield (user_id, task_id) completions after the given pair, ordered
+        by user_id and then task_id
+        """
+        raise NotImplementedError
+
+    def iter_users(self) -> Iterator[Dict]:
+        """
+        Yield every stored user record, one at a time
+        Reads are streamed, so reports never hold the whole database
+        """
+        raise NotImplementedError
+
+    def iter_user_ids(self, after_id: int = 0, include_blocked: bool = False) -> Iterator[int]:
+        """
+        Yield user ids greater than after_id in ascending order
+        Users who blocked the bot are skipped unless include_blocked is set
+        """
+        raise NotImplementedError
+
+    def count_users(self, include_blocked: bool = False) -> int:
+        """
+        Number of stored users
+        """
+        raise NotImplementedError
+
+    def add_withdrawal(self, user_id: int, amount: float, date: str) -> int:
+        """
+        Record a pending withdrawal request and return its id
+        """
+        return self.add_withdrawals([{'user_id': user_id, 'amount': amount, 'date': date}])[0]
+
+    def add_withdrawals(self, withdrawals: Iterable[Dict]) -> List[int]:
+        """
+        Record several withdrawal requests (user_id, amount, date, optional
+        status) in one write. Returns their ids in order
+        """
+        raise NotImplementedError
+
+    def get_withdrawals(self, status: str, offset: int = 0, limit: int = 20) -> List[Dict]:
+        """
+        Return one page of withdrawals with the given status, oldest first
+        """
+        raise NotImplementedError
+
+    def withdrawal_totals(self, status: str) -> tuple:
+        """
+        Return (count, total amount) of withdrawals with the given status
+        """
+        raise NotImplementedError
+
+    def settle_withdrawals(self, ids: Optional[Iterable[int]], status: str) -> List[Dict]:
+        """
+        Move pending withdrawals to status in a single write
+        ids=None settles every pending request. Requests that are not
+        pending are skipped; returns the ones that changed
+        """
+        raise NotImplementedError
+
+    def snapshot(self, path: str) -> None:
+        """
+        Write a consistent point-in-time copy of the stored data to path,
+        in the backend's own file format
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """
+        Release any resources held by the backend
+        """
+
+class JsonStorage(StorageBackend):
     """
-    Handle /account command
+    Legacy backend: the whole database lives in one JSON file
+    Every read parses the file and every write rewrites it
     """
-    user_id = update.effective_user.id
-    await show_account(update, context, user_id)
 
-# =====================================================
-# CALLBACK HANDLERS - Button interactions
-# =====================================================
+    name = 'json'
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    def __init__(self):
+        # Every call reads or rewrites the whole file, so calls from
+        # storage threads must not interleave
+        self._lock = threading.RLock()
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            record = load_database().get(str(user_id))
+            if record is not None:
+                # Withdrawals stay in the file but are managed separately
+                record.pop('withdrawal_requests', None)
+            return record
+
+    def put_user(self, user_id: int, data: Dict) -> None:
+        self.put_users([data])
+
+    def put_users(self, records: Iterable[Dict]) -> None:
+        with self._lock:
+            db = load_database()
+            for record in records:
+                key = str(record['user_id'])
+                stored = db.get(key, {})
+                db[key] = dict(record, withdrawal_requests=stored.get('withdrawal_requests', []))
+            save_database(db)
+
+    def iter_referrals(self) -> Iterator[tuple]:
+        with self._lock:
+            return referrals_from_records(load_database().values())
+
+    def iter_balances(self) -> Iterator[tuple]:
+        with self._lock:
+            return iter([(record['user_id'], record['stars']) for record in load_database().values()
+                         if record.get('stars', 0) > 0])
+
+    def iter_reminders(self) -> Iterator[tuple]:
+        with self._lock:
+            return iter([(record['user_id'], record['next_reminder']) for record in load_database().values()
+                         if record.get('next_reminder')])
+
+    def count_completions(self) -> Dict[str, int]:
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for record in self._stream():
+                for task_id in record.get('completed_tasks', []):
+                    counts[task_id] = counts.get(task_id, 0) + 1
+            return counts
+
+    def iter_completions(self, after: tuple = (0, ''), page_size: int = 1000) -> Iterator[tuple]:
+        # Keyset pages: each streamed pass keeps only the next page_size users
+        # after the cursor, so the file is never loaded or sorted as a whole
+        user_id, task_id = after
+        while True:
+            with self._lock:
+                page = heapq.nsmallest(page_size, (
+                    (record['user_id'], sorted(record['completed_tasks'])) for record in self._stream()
+                    if record.get('completed_tasks') and (record['user_id'], max(record['completed_tasks'])) > (user_id, task_id)
+                ))
+            if not page:
+                return
+            for page_user_id, task_ids in page:
+                for page_task_id in task_ids:
+                    if (page_user_id, page_task_id) > (user_id, task_id):
+                        yield page_user_id, page_task_id
+            user_id, task_id = page[-1][0], page[-1][1][-1]
+
+    def _stream(self) -> Iterator[Dict]:
+        """
+        Stream raw records, withdrawals included, without loading the file
+        """
+        if not os.path.exists(DATABASE_FILE):
+            return
+        for user_id_str, record in iter_json_object(DATABASE_FILE):
+            record.setdefault('user_id', int(user_id_str))
+            yield record
+
+    def iter_users(self) -> Iterator[Dict]:
+        for record in self._stream():
+            record.pop('withdrawal_requests', None)
+            yield record
+
+    def iter_user_ids(self, after_id: int = 0, include_blocked: bool = False) -> Iterator[int]:
+        with self._lock:
+            return iter(sorted(
+                record['user_id'] for record in load_database().values()
+                if record['user_id'] > after_id and (include_blocked or not record.get('blocked'))
+            ))
+
+    def count_users(self, include_blocked: bool = False) -> int:
+        with self._lock:
+            return sum(1 for record in self._stream() if include_blocked or not record.get('blocked'))
+
+    def _load_withdrawals(self) -> tuple:
+        """
+        Load the database and list every (record, withdrawal) pair
+        Requests written before ids existed are numbered on first access
+        """
+        db = load_database()
+        pairs = [(record, withdrawal) for record in db.values()
+                 for withdrawal in record.get('withdrawal_requests', [])]
+        next_id = max((w.get('id') or 0 for _, w in pairs), default=0) + 1
+        missing = [w for _, w in pairs if w.get('id') is None]
+        for withdrawal in missing:
+            withdrawal['id'] = next_id
+            next_id += 1
+        if missing:
+            save_database(db)
+        return db, pairs, next_id
+
+    def add_withdrawals(self, withdrawals: Iterable[Dict]) -> List[int]:
+        with self._lock:
+            db, _, next_id = self._load_withdrawals()
+            ids = []
+            for withdrawal in withdrawals:
+                record = db.setdefault(str(withdrawal['user_id']), new_user_record(withdrawal['user_id']))
+                record.setdefault('withdrawal_requests', []).append({
+                    'id': next_id,
+                    'amount': withdrawal['amount'],
+                    'date': withdrawal['date'],
+                    'status': withdrawal.get('status', 'pending')
+                })
+                ids.append(next_id)
+                next_id += 1
+            save_database(db)
+            return ids
+
+    def _matching(self, pairs: List[tuple], status: str) -> List[Dict]:
+        rows = [dict(withdrawal, user_id=record['user_id']) for record, withdrawal in pairs
+                if withdrawal.get('status', 'pending') == status]
+        rows.sort(key=lambda row: (row['date'], row['id']))
+        return rows
+
+    def get_withdrawals(self, status: str, offset: int = 0, limit: int = 20) -> List[Dict]:
+        with self._lock:
+            _, pairs, _ = self._load_withdrawals()
+            return self._matching(pairs, status)[offset:offset + limit]
+
+    def withdrawal_totals(self, status: str) -> tuple:
+        with self._lock:
+            count, total = 0, 0
+            for record in self._stream():
+                for withdrawal in record.get('withdrawal_requests', []):
+                    if withdrawal.get('status', 'pending') == status:
+                        count += 1
+                        total += withdrawal['amount']
+            return count, total
+
+    def settle_withdrawals(self, ids: Optional[Iterable[int]], status: str) -> List[Dict]:
+        with self._lock:
+            db, pairs, _ = self._load_withdrawals()
+            wanted = set(ids) if ids is not None else None
+            settled = []
+            for record, withdrawal in pairs:
+                if withdrawal.get('status', 'pending') != 'pending':
+                    continue
+                if wanted is not None and withdrawal['id'] not in wanted:
+                    continue
+                withdrawal['status'] = status
+                settled.append(dict(withdrawal, user_id=record['user_id']))
+            if settled:
+                save_database(db)
+            settled.sort(key=lambda row: (row['date'], row['id']))
+            return settled
+
+    def snapshot(self, path: str) -> None:
+        with self._lock:
+            if os.path.exists(DATABASE_FILE):
+                shutil.copyfile(DATABASE_FILE, path)
+            else:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write('{}')
+
+class SQLiteStorage(StorageBackend):
     """
-    Handle all button callbacks
-    Routes to appropriate handler based on callback data
+    SQLite backend in WAL mode with a normalized schema
+    A single-user read or write only touches that user's rows
     """
-    query = update.callback_query
-    await query.answer()
-    
-    user_id = update.effective_user.id
-    data = query.data
-    
+
+    name = 'sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            stars REAL NOT NULL DEFAULT 0,
+            username TEXT,
+            first_name TEXT,
+            join_date TEXT NOT NULL,
+            last_daily_reward TEXT,
+            referred_by INTEGER,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            daily_reminder INTEGER NOT NULL DEFAULT 0,
+            next_reminder TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users(referred_by);
+
+        CREATE TABLE IF NOT EXISTS referrals (
+            referrer_id INTEGER NOT NULL,
+            referee_id INTEGER NOT NULL,
+            PRIMARY KEY (referrer_id, referee_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_referrals_referee ON referrals(referee_id);
+
+        CREATE TABLE IF NOT EXISTS completed_tasks (
+            user_id INTEGER NOT NULL,
+            task_id TEXT NOT NULL,
+            completed_at TEXT,
+            PRIMARY KEY (user_id, task_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_completed_tasks_task ON completed_tasks(task_id);
+
+        CREATE TABLE IF NOT EXISTS withdrawal_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            date TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+        );
+        CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawal_requests(user_id);
+        CREATE INDEX IF NOT EXISTS idx_withdrawals_status_date ON withdrawal_requests(status, date);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.is_new = not os.path.exists(path)
+        self._local = threading.local()
+        # Every connection opened on any thread, so close() can reach them all
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.executescript(self.SCHEMA)
+        self._migrate(conn)
+
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        """
+        Bring databases created by older versions up to the current schema
+        """
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+        if 'blocked' not in columns:
+            conn.execute('ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0')
+        if 'daily_reminder' not in columns:
+            conn.execute('ALTER TABLE users ADD COLUMN daily_reminder INTEGER NOT NULL DEFAULT 0')
+            conn.execute('ALTER TABLE users ADD COLUMN next_reminder TEXT')
+        # Only scheduled reminders are indexed, so the index stays small
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_users_next_reminder ON users(next_reminder) '
+                     'WHERE next_reminder IS NOT NULL')
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Return this thread's connection, opening it on first use
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run the block inside a write transaction
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    USER_COLUMNS = ('user_id, stars, username, first_name, join_date, last_daily_reward, referred_by, '
+                    'blocked, daily_reminder, next_reminder')
+
+    @staticmethod
+    def _user_record(row: tuple, completed_tasks: List[str]) -> Dict:
+        """
+        Build a user dict from a USER_COLUMNS row
+        """
+        return {
+            'user_id': row[0],
+            'stars': row[1],
+            'completed_tasks': completed_tasks,
+            'last_daily_reward': row[5],
+            'referred_by': row[6],
+            'username': row[2],
+            'first_name': row[3],
+            'join_date': row[4],
+            'blocked': bool(row[7]),
+            'daily_reminder': bool(row[8]),
+            'next_reminder': row[9]
+        }
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        conn = self._connection()
+        row = conn.execute(
+            f'SELECT {self.USER_COLUMNS} FROM users WHERE user_id = ?',
+            (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        completed_tasks = [r[0] for r in conn.execute(
+            'SELECT task_id FROM completed_tasks WHERE user_id = ? ORDER BY rowid', (user_id,)
+        )]
+        return self._user_record(row, completed_tasks)
+
+    def put_user(self, user_id: int, data: Dict) -> None:
+        with self._transaction() as conn:
+            self._write_user(conn, user_id, data)
+
+    def put_users(self, records: Iterable[Dict]) -> None:
+        with self._transaction() as conn:
+            for record in records:
+                self._write_user(conn, record['user_id'], record)
+
+    def _write_user(self, conn: sqlite3.Connection, user_id: int, data: Dict) -> None:
+        """
+        Upsert one user and sync its child rows inside an open transaction
+        """
+        conn.execute(
+            'INSERT INTO users (user_id, stars, username, first_name, join_date, last_daily_reward, referred_by, '
+            'blocked, daily_reminder, next_reminder) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET stars = excluded.stars, username = excluded.username, '
+            'first_name = excluded.first_name, join_date = excluded.join_date, '
+            'last_daily_reward = excluded.last_daily_reward, referred_by = excluded.referred_by, '
+            'blocked = excluded.blocked, daily_reminder = excluded.daily_reminder, '
+            'next_reminder = excluded.next_reminder',
+            (user_id, data.get('stars', 0.0), data.get('username'), data.get('first_name'),
+             data.get('join_date') or datetime.now().isoformat(),
+             data.get('last_daily_reward'), data.get('referred_by'), int(bool(data.get('blocked'))),
+             int(bool(data.get('daily_reminder'))), data.get('next_reminder'))
+        )
+
+        # Referral edges are keyed on the referee; legacy records may also
+        # carry a list of referees on the referrer
+        edges = [(user_id, referee_id) for referee_id in data.get('referrals', [])]
+        if data.get('referred_by') is not None:
+            edges.append((data['referred_by'], user_id))
+        conn.executemany(
+            'INSERT OR IGNORE INTO referrals (referrer_id, referee_id) VALUES (?, ?)',
+            edges
+        )
+
+        # Completed tasks can be revoked, so sync both directions
+        stored = {r[0] for r in conn.execute(
+            'SELECT task_id FROM completed_tasks WHERE user_id = ?', (user_id,)
+        )}
+        wanted = data.get('completed_tasks', [])
+        now = datetime.now().isoformat()
+        conn.executemany(
+            'INSERT INTO completed_tasks (user_id, task_id, completed_at) VALUES (?, ?, ?)',
+            [(user_id, task_id, now) for task_id in wanted if task_id not in stored]
+        )
+        conn.executemany(
+            'DELETE FROM completed_tasks WHERE user_id = ? AND task_id = ?',
+            [(user_id, task_id) for task_id in stored.difference(wanted)]
+        )
+
+    def iter_referrals(self) -> Iterator[tuple]:
+        cursor = self._connection().execute('SELECT referrer_id, referee_id FROM referrals')
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            yield from rows
+
+    def iter_balances(self) -> Iterator[tuple]:
+        after_id = 0
+        while True:
+            rows = self._connection().execute(
+                'SELECT user_id, stars FROM users WHERE user_id > ? AND stars > 0 ORDER BY user_id LIMIT 1000',
+                (after_id,)
+            ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            after_id = rows[-1][0]
+
+    def iter_reminders(self) -> Iterator[tuple]:
+        return iter(self._connection().execute(
+            'SELECT user_id, next_reminder FROM users WHERE next_reminder IS NOT NULL'
+        ).fetchall())
+
+    def count_completions(self) -> Dict[str, int]:
+        # Served from idx_completed_tasks_task without touching the table
+        return dict(self._connection().execute(
+            'SELECT task_id, COUNT(*) FROM completed_tasks GROUP BY task_id'
+        ).fetchall())
+
+    def iter_completions(self, after: tuple = (0, '')) -> Iterator[tuple]:
+        # Keyset pagination over the (user_id, task_id) primary key
+        user_id, task_id = after
+        while True:
+            rows = self._connection().execute(
+                'SELECT user_id, task_id FROM completed_tasks WHERE (user_id, task_id) > (?, ?) '
+                'ORDER BY user_id, task_id LIMIT 1000',
+                (user_id, task_id)
+            ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            user_id, task_id = rows[-1]
+
+    def iter_users(self) -> Iterator[Dict]:
+        # Keyset pages of users, each joined with the completed tasks of the
+        # same user_id range
+        conn = self._connection()
+        after_id = 0
+        while True:
+            rows = conn.execute(
+                f'SELECT {self.USER_COLUMNS} FROM users WHERE user_id > ? ORDER BY user_id LIMIT 500',
+                (after_id,)
+            ).fetchall()
+            if not rows:
+                return
+            completed: Dict[int, List[str]] = {}
+            for user_id, task_id in conn.execute(
+                'SELECT user_id, task_id FROM completed_tasks WHERE user_id BETWEEN ? AND ? ORDER BY user_id, rowid',
+                (rows[0][0], rows[-1][0])
+            ):
+                completed.setdefault(user_id, []).append(task_id)
+            for row in rows:
+                yield self._user_record(row, completed.get(row[0], []))
+            after_id = rows[-1][0]
+
+    def iter_user_ids(self, after_id: int = 0, include_blocked: bool = False) -> Iterator[int]:
+        # Keyset pagination: each page is a short primary key range scan,
+        # so no read transaction stays open while the caller works
+        query = 'SELECT user_id FROM users WHERE user_id > ?'
+        if not include_blocked:
+            query += ' AND blocked = 0'
+        query += ' ORDER BY user_id LIMIT 1000'
+        while True:
+            rows = self._connection().execute(query, (after_id,)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[0]
+            after_id = rows[-1][0]
+
+    def count_users(self, include_blocked: bool = False) -> int:
+        query = 'SELECT COUNT(*) FROM users' if include_blocked else 'SELECT COUNT(*) FROM users WHERE blocked = 0'
+        return self._connection().execute(query).fetchone()[0]
+
+    def add_withdrawals(self, withdrawals: Iterable[Dict]) -> List[int]:
+        ids = []
+        with self._transaction() as conn:
+            for withdrawal in withdrawals:
+                cursor = conn.execute(
+                    'INSERT INTO withdrawal_requests (user_id, amount, date, status) VALUES (?, ?, ?, ?)',
+                    (withdrawal['user_id'], withdrawal['amount'], withdrawal['date'],
+                     withdrawal.get('status', 'pending'))
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def get_withdrawals(self, status: str, offset: int = 0, limit: int = 20) -> List[Dict]:
+        rows = self._connection().execute(
+            'SELECT id, user_id, amount, date, status FROM withdrawal_requests '
+            'WHERE status = ? ORDER BY date, id LIMIT ? OFFSET ?',
+            (status, limit, offset)
+        )
+        return [withdrawal_row(row) for row in rows]
+
+    def withdrawal_totals(self, status: str) -> tuple:
+        count, total = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM withdrawal_requests WHERE status = ?',
+            (status,)
+        ).fetchone()
+        return count, total
+
+    def settle_withdrawals(self, ids: Optional[Iterable[int]], status: str) -> List[Dict]:
+        query = ('SELECT id, user_id, amount, date, status FROM withdrawal_requests '
+                 "WHERE status = 'pending'")
+        with self._transaction() as conn:
+            if ids is None:
+                rows = conn.execute(query + ' ORDER BY date, id').fetchall()
+            else:
+                ids = list(ids)
+                rows = []
+                # Stay well below SQLite's bound-parameter limit
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    rows.extend(conn.execute(
+                        f"{query} AND id IN ({','.join('?' * len(chunk))})", chunk
+                    ))
+                rows.sort(key=lambda row: (row[3], row[0]))
+            conn.executemany(
+                'UPDATE withdrawal_requests SET status = ? WHERE id = ?',
+                [(status, row[0]) for row in rows]
+            )
+        return [dict(withdrawal_row(row), status=status) for row in rows]
+
+    def snapshot(self, path: str) -> None:
+        # The online backup API copies a single read transaction, so
+        # writers on other connections keep going while it runs
+        target = sqlite3.connect(path)
+        try:
+            self._connection().backup(target)
+        finally:
+            target.close()
+
+    def close(self) -> None:
+        """
+        Checkpoint the WAL and close the connections of every thread
+        A later call opens fresh connections
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        if connections:
+            try:
+                connections[0].execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            except sqlite3.Error as e:
+                logger.warning(f"WAL checkpoint on close failed: {e}")
+        for conn in connections:
+            conn.close()
+
+class JournalStorage(StorageBackend):
+    """
+    All users held in memory, persisted as a snapshot plus an append-only journal
+    Each write appends one compact line per changed user and fsyncs at most
+    every fsync_interval seconds. compact() folds the journal into a fresh
+    snapshot; startup replays snapshot + journal.
+    Withdrawal changes are logged as {"withdrawals": [...]} lines, one line
+    per batch so a batch is replayed entirely or not at all.
+    Users are held as UserRecord and written in its packed form. A
+    {"tasks": [...], "at": n} line names the task ids behind bit positions
+    n, n+1, ... for the packed records that follow it in the same file
+    """
+
+    name = 'journal'
+
+    def __init__(self, snapshot_path: str, journal_path: str, fsync_interval: float, read_only: bool = False):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        # Journal being folded into a snapshot; only exists during compaction
+        self.rotated_path = f"{journal_path}.1"
+        self.fsync_interval = fsync_interval
+        self.read_only = read_only
+        self.is_new = not any(os.path.exists(p) for p in (snapshot_path, journal_path, self.rotated_path))
+        self._users: Dict[int, UserRecord] = {}
+        self._withdrawals: Dict[int, Dict] = {}
+        # status -> sorted list of (date, id)
+        self._withdrawal_index: Dict[str, List[tuple]] = {}
+        self._next_withdrawal_id = 1
+        # Withdrawal lists found on records written before withdrawals had their own lines
+        self._legacy_withdrawals: Dict[int, List[Dict]] = {}
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._last_fsync = time.monotonic()
+        self._unsynced = False
+        # TASK_BITS positions already named in the current journal file
+        self._logged_tasks = 0
+
+        if read_only:
+            # Nothing is truncated, upgraded or appended, so this is safe to
+            # open next to a running bot
+            self._journal = None
+            self._recover()
+            self._show_legacy_withdrawals()
+            return
+
+        directory = os.path.dirname(os.path.abspath(journal_path))
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self._journal = open(journal_path, 'a', encoding='utf-8')
+        self._upgrade_legacy_withdrawals()
+
+    @classmethod
+    def open_read_only(cls, snapshot_path: str, journal_path: str) -> 'JournalStorage':
+        """
+        Load snapshot + journals without writing to them, for offline reports
+        A compaction by the running bot mid-read can hide entries, so the
+        files are read again if the snapshot changed meanwhile
+        """
+        def snapshot_id() -> Optional[tuple]:
+            try:
+                stat = os.stat(snapshot_path)
+            except FileNotFoundError:
+                return None
+            return stat.st_ino, stat.st_mtime_ns
+
+        for _ in range(5):
+            before = snapshot_id()
+            storage = cls(snapshot_path, journal_path, 0, read_only=True)
+            if snapshot_id() == before:
+                break
+        return storage
+
+    def _recover(self) -> None:
+        """
+        Rebuild the in-memory state from snapshot + journals
+        """
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                tasks: List[str] = []
+                for line in f:
+                    self._apply(json.loads(line), tasks)
+
+        replayed = 0
+        for path in (self.rotated_path, self.journal_path):
+            replayed += self._replay(path)
+        if replayed:
+            logger.info(f"Replayed {replayed} journal entries on top of {self.snapshot_path}")
+
+    def _replay(self, path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        good_offset = 0
+        tasks: List[str] = []
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn write from a crash (or, read-only, a line the
+                    # running bot is still writing); everything after it is garbage
+                    if not self.read_only:
+                        logger.warning(f"Truncating torn journal entry in {path} at byte {good_offset}")
+                    break
+                self._apply(record, tasks)
+                good_offset += len(line)
+                count += 1
+        if good_offset < os.path.getsize(path) and not self.read_only:
+            with open(path, 'r+b') as f:
+                f.truncate(good_offset)
+        return count
+
+    def _apply(self, entry: Any, tasks: List[str]) -> None:
+        """
+        Apply one snapshot or journal line to the in-memory state
+        tasks is the bit position -> task id table of the file being read
+        """
+        if isinstance(entry, list):
+            record = UserRecord.unpack(entry, tasks)
+            self._legacy_withdrawals.pop(record.user_id, None)
+            self._users[record.user_id] = record
+            return
+        if 'withdrawals' in entry:
+            for withdrawal in entry['withdrawals']:
+                self._apply_withdrawal(withdrawal)
+            return
+        if 'tasks' in entry and 'user_id' not in entry:
+            at = entry.get('at', 0)
+            tasks[at:at + len(entry['tasks'])] = entry['tasks']
+            return
+        # User dicts written by older versions
+        legacy = entry.pop('withdrawal_requests', None)
+        if legacy:
+            self._legacy_withdrawals[entry['user_id']] = legacy
+        else:
+            self._legacy_withdrawals.pop(entry['user_id'], None)
+        self._users[entry['user_id']] = UserRecord.from_dict(entry)
+
+    def _apply_withdrawal(self, withdrawal: Dict) -> None:
+        old = self._withdrawals.get(withdrawal['id'])
+        if old is not None:
+            entries = self._withdrawal_index[old['status']]
+            del entries[bisect.bisect_left(entries, (old['date'], old['id']))]
+        self._withdrawals[withdrawal['id']] = withdrawal
+        bisect.insort(self._withdrawal_index.setdefault(withdrawal['status'], []),
+                      (withdrawal['date'], withdrawal['id']))
+        self._next_withdrawal_id = max(self._next_withdrawal_id, withdrawal['id'] + 1)
+
+    def _upgrade_legacy_withdrawals(self) -> None:
+        """
+        Give withdrawals still embedded in user records their own journal lines
+        The rewritten user records come after them, so a later replay
+        doesn't import the embedded copies again
+        """
+        if not self._legacy_withdrawals:
+            return
+        withdrawals = [
+            dict(withdrawal, user_id=user_id)
+            for user_id, legacy in self._legacy_withdrawals.items()
+            for withdrawal in legacy
+        ]
+        users = [self._users[user_id].to_dict() for user_id in self._legacy_withdrawals]
+        self._legacy_withdrawals = {}
+        self.add_withdrawals(withdrawals)
+        self.put_users(users)
+        logger.info(f"Moved {len(withdrawals)} withdrawal requests out of {len(users)} user records")
+
+    def _show_legacy_withdrawals(self) -> None:
+        """
+        Read-only counterpart of _upgrade_legacy_withdrawals: number the
+        embedded withdrawals in memory without writing them out
+        """
+        for user_id, legacy in self._legacy_withdrawals.items():
+            for withdrawal in legacy:
+                self._apply_withdrawal({
+                    'id': self._next_withdrawal_id,
+                    'user_id': user_id,
+                    'amount': withdrawal['amount'],
+                    'date': withdrawal['date'],
+                    'status': withdrawal.get('status', 'pending')
+                })
+        self._legacy_withdrawals = {}
+
+    def _append(self, lines: str) -> None:
+        """
+        Append to the journal; the caller holds self._lock
+        """
+        if self._journal is None:
+            raise RuntimeError(f"{self.journal_path} was opened read-only")
+        self._journal.write(lines)
+        self._journal.flush()
+        self._unsynced = True
+        if time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._fsync()
+
+    def _log_withdrawals(self, withdrawals: List[Dict]) -> None:
+        """
+        Journal and apply a batch of withdrawal rows; the caller holds self._lock
+        """
+        self._append(json.dumps({'withdrawals': withdrawals}, ensure_ascii=False, separators=(',', ':')) + '\n')
+        for withdrawal in withdrawals:
+            self._apply_withdrawal(withdrawal)
+
+    def _task_table(self) -> str:
+        """
+        Line naming task bit positions not yet named in the journal, if any;
+        the caller holds self._lock
+        """
+        if len(TASK_BITS) <= self._logged_tasks:
+            return ''
+        line = {'tasks': TASK_BITS.ids(self._logged_tasks), 'at': self._logged_tasks}
+        self._logged_tasks += len(line['tasks'])
+        return json.dumps(line, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        record = self._users.get(user_id)
+        return record.to_dict() if record is not None else None
+
+    def put_user(self, user_id: int, data: Dict) -> None:
+        self.put_users([data])
+
+    def put_users(self, records: Iterable[Dict]) -> None:
+        records = [UserRecord.from_dict(record) for record in records]
+        lines = ''.join(
+            json.dumps(record.pack(), ensure_ascii=False, separators=(',', ':')) + '\n'
+            for record in records
+        )
+        with self._lock:
+            # Bits used above were assigned before the lock, so the table covers them
+            self._append(self._task_table() + lines)
+            for record in records:
+                self._users[record.user_id] = record
+
+    def _fsync(self) -> None:
+        os.fsync(self._journal.fileno())
+        self._last_fsync = time.monotonic()
+        self._unsynced = False
+
+    def sync(self) -> None:
+        """
+        fsync anything written since the last fsync
+        """
+        with self._lock:
+            if self._unsynced:
+                self._fsync()
+
+    def journal_size(self) -> int:
+        """
+        Bytes currently in the journal
+        """
+        with self._lock:
+            return self._journal.tell() if self._journal is not None else 0
+
+    def compact(self) -> int:
+        """
+        Write a fresh snapshot and drop the journal entries it covers
+        Writers are only blocked while the journal is swapped, not while
+        the snapshot is written. Returns the number of users in the snapshot
+        """
+        if self._journal is None:
+            raise RuntimeError(f"{self.journal_path} was opened read-only")
+        with self._compact_lock:
+            with self._lock:
+                self._fsync()
+                self._journal.close()
+                os.replace(self.journal_path, self.rotated_path)
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')
+                self._logged_tasks = 0
+                # Stored records are replaced on write, never mutated, so a
+                # shallow copy is a consistent point-in-time view
+                users = list(self._users.values())
+                withdrawals = list(self._withdrawals.values())
+
+            tmp_path = f"{self.snapshot_path}.tmp"
+            self._write_snapshot(tmp_path, users, withdrawals)
+            os.replace(tmp_path, self.snapshot_path)
+            os.remove(self.rotated_path)
+            return len(users)
+
+    @staticmethod
+    def _write_snapshot(path: str, users: List[UserRecord], withdrawals: List[Dict]) -> None:
+        """
+        Write users and withdrawals to path in snapshot format and fsync it
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'tasks': TASK_BITS.ids(), 'at': 0}, ensure_ascii=False, separators=(',', ':')) + '\n')
+            for record in users:
+                f.write(json.dumps(record.pack(), ensure_ascii=False, separators=(',', ':')) + '\n')
+            for start in range(0, len(withdrawals), 1000):
+                chunk = withdrawals[start:start + 1000]
+                f.write(json.dumps({'withdrawals': chunk}, ensure_ascii=False, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def snapshot(self, path: str) -> None:
+        # Same point-in-time copy compaction takes, without touching the journal
+        with self._lock:
+            users = list(self._users.values())
+            withdrawals = list(self._withdrawals.values())
+        self._write_snapshot(path, users, withdrawals)
+
+    def iter_referrals(self) -> Iterator[tuple]:
+        for record in list(self._users.values()):
+            if record.referred_by is not None:
+                yield record.referred_by, record.user_id
+            # Older databases also kept a list of referees on the referrer
+            for referee_id in (record.extra or {}).get('referrals', []):
+                yield record.user_id, referee_id
+
+    def iter_balances(self) -> Iterator[tuple]:
+        return iter([(user_id, record.stars) for user_id, record in list(self._users.items())
+                     if record.stars > 0])
+
+    def iter_reminders(self) -> Iterator[tuple]:
+        return iter([(user_id, unpack_time(record.next_reminder)) for user_id, record in list(self._users.items())
+                     if record.next_reminder])
+
+    def count_completions(self) -> Dict[str, int]:
+        # Count each bit position first, then name the positions once
+        counts: Dict[int, int] = {}
+        for record in list(self._users.values()):
+            mask = record.tasks
+            while mask:
+                low = mask & -mask
+                counts[low] = counts.get(low, 0) + 1
+                mask ^= low
+        return {TASK_BITS.decode(low)[0]: count for low, count in counts.items()}
+
+    def iter_completions(self, after: tuple = (0, '')) -> Iterator[tuple]:
+        # Only the ids of users from the cursor on are sorted; their tasks are
+        # decoded a user at a time as the caller pages through them
+        after = tuple(after)
+        user_ids = sorted(user_id for user_id, record in list(self._users.items())
+                          if user_id >= after[0] and record.tasks)
+        for user_id in user_ids:
+            record = self._users.get(user_id)
+            if record is None:
+                continue
+            for task_id in sorted(TASK_BITS.decode(record.tasks)):
+                if (user_id, task_id) > after:
+                    yield user_id, task_id
+
+    def iter_users(self) -> Iterator[Dict]:
+        # Records are already in memory; expand them one at a time
+        for record in list(self._users.values()):
+            yield record.to_dict()
+
+    def iter_user_ids(self, after_id: int = 0, include_blocked: bool = False) -> Iterator[int]:
+        return iter(sorted(
+            user_id for user_id, record in list(self._users.items())
+            if user_id > after_id and (include_blocked or not record.blocked)
+        ))
+
+    def count_users(self, include_blocked: bool = False) -> int:
+        if include_blocked:
+            return len(self._users)
+        return sum(1 for record in list(self._users.values()) if not record.blocked)
+
+    def add_withdrawals(self, withdrawals: Iterable[Dict]) -> List[int]:
+        with self._lock:
+            rows = []
+            for withdrawal in withdrawals:
+                rows.append({
+                    'id': self._next_withdrawal_id,
+                    'user_id': withdrawal['user_id'],
+                    'amount': withdrawal['amount'],
+                    'date': withdrawal['date'],
+                    'status': withdrawal.get('status', 'pending')
+                })
+                self._next_withdrawal_id += 1
+            self._log_withdrawals(rows)
+            return [row['id'] for row in rows]
+
+    def get_withdrawals(self, status: str, offset: int = 0, limit: int = 20) -> List[Dict]:
+        with self._lock:
+            entries = self._withdrawal_index.get(status, [])[offset:offset + limit]
+            return [dict(self._withdrawals[withdrawal_id]) for _, withdrawal_id in entries]
+
+    def withdrawal_totals(self, status: str) -> tuple:
+        with self._lock:
+            entries = self._withdrawal_index.get(status, [])
+            return len(entries), sum(self._withdrawals[withdrawal_id]['amount'] for _, withdrawal_id in entries)
+
+    def settle_withdrawals(self, ids: Optional[Iterable[int]], status: str) -> List[Dict]:
+        with self._lock:
+            if ids is None:
+                ids = [withdrawal_id for _, withdrawal_id in self._withdrawal_index.get('pending', [])]
+            settled = []
+            ids = dict.fromkeys(ids)
+            for withdrawal_id in ids:
+                withdrawal = self._withdrawals.get(withdrawal_id)
+                if withdrawal is not None and withdrawal['status'] == 'pending':
+                    settled.append(dict(withdrawal, status=status))
+            if settled:
+                self._log_withdrawals(settled)
+            settled.sort(key=lambda row: (row['date'], row['id']))
+            return [dict(row) for row in settled]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._journal is not None and not self._journal.closed:
+                self._fsync()
+                self._journal.close()
+
+STORAGE_BACKENDS = {
+    'json': lambda: JsonStorage(),
+    'sqlite': lambda: SQLiteStorage(SQLITE_DATABASE_FILE),
+    'journal': lambda: JournalStorage(JOURNAL_SNAPSHOT_FILE, JOURNAL_FILE, JOURNAL_FSYNC_INTERVAL),
+}
+
+_storage: Optional[StorageBackend] = None
+
+def get_storage() -> StorageBackend:
+    """
+    Return the configured storage backend, creating it on first use
+    A fresh backend is seeded from the legacy JSON file if one exists
+    """
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}'")
+        _storage = STORAGE_BACKENDS[STORAGE_BACKEND]()
+        if _storage.is_new and os.path.exists(DATABASE_FILE):
+            count = import_json_database(DATABASE_FILE, _storage)
+            logger.info(f"Migrated {count} users from {DATABASE_FILE} to {_storage.name} storage")
+    return _storage
+
+def open_report_storage() -> StorageBackend:
+    """
+    Storage for offline commands (stats, export, snapshot) that may run
+    while the bot is up. The journal is opened read-only, so the running
+    bot's journal is never truncated or appended to
+    """
+    if STORAGE_BACKEND == 'journal':
+        return JournalStorage.open_read_only(JOURNAL_SNAPSHOT_FILE, JOURNAL_FILE)
+    return get_storage()
+
+def import_json_database(json_file: str, target: StorageBackend) -> int:
+    """
+    One-shot import of a legacy JSON database into another backend
+    Returns the number of migrated users
+    """
+    with open(json_file, 'r', encoding='utf-8') as f:
+        db = json.load(f)
+
+    records = []
+    withdrawals = []
+    for user_id_str, record in db.items():
+        record = dict(record)
+        record['user_id'] = int(record.get('user_id', user_id_str))
+        for withdrawal in record.pop('withdrawal_requests', []):
+            withdrawals.append(dict(withdrawal, user_id=record['user_id']))
+        records.append(record)
+
+    target.put_users(records)
+    if withdrawals:
+        target.add_withdrawals(withdrawals)
+    return len(records)
+
+# =====================================================
+# USER CACHE - In-memory LRU with write-behind flushing
+# =====================================================
+
+def copy_record(record: Dict) -> Dict:
+    """
+    Copy a user record deep enough that callers can't mutate the cached one
+    """
+    copied = dict(record)
+    for key, value in copied.items():
+        if isinstance(value, list):
+            copied[key] = [dict(item) if isinstance(item, dict) else item for item in value]
+    return copied
+
+class UserCache:
+    """
+    Bounded LRU cache of user records in front of a storage backend
+    Writes mark records dirty; dirty records are flushed to the backend in
+    batches when flush_batch is reached, on a timer and on shutdown.
+    Records are held as UserRecord; callers always get a fresh dict.
+    The global lock only guards the in-memory tables: misses load under the
+    user's stripe lock and flushes write under their own lock, so backend
+    I/O never holds up other users or stats()
+    """
+
+    def __init__(self, backend: StorageBackend, capacity: int, flush_batch: int):
+        self.backend = backend
+        self.capacity = capacity
+        self.flush_batch = flush_batch
+        self._records: 'OrderedDict[int, UserRecord]' = OrderedDict()
+        # Dirty records stay here until flushed, even if evicted from the LRU
+        self._dirty: Dict[int, UserRecord] = {}
+        # Records taken from _dirty by a flush that is still being written
+        self._flushing: Dict[int, UserRecord] = {}
+        self._lock = threading.RLock()
+        # Serializes backend writes, so a newer version of a record is never
+        # overwritten by an older one still in flight
+        self._flush_lock = threading.Lock()
+        # Per-user mutations serialize on one of USER_LOCK_STRIPES locks
+        # instead of a global lock, so unrelated users never wait on each other
+        self._user_locks = [threading.RLock() for _ in range(USER_LOCK_STRIPES)]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flushed_records = 0
+
+    def _lookup(self, user_id: int) -> Optional[UserRecord]:
+        """
+        Find the newest in-memory version of a record; caller holds _lock
+        """
+        record = self._records.get(user_id)
+        if record is not None:
+            self._records.move_to_end(user_id)
+            return record
+        record = self._dirty.get(user_id, self._flushing.get(user_id))
+        if record is not None:
+            self._remember(user_id, record)
+        return record
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        """
+        Return a copy of the user's record, loading it from the backend on a miss
+        """
+        with self._lock:
+            record = self._lookup(user_id)
+            if record is not None:
+                self.hits += 1
+                return record.to_dict()
+
+        # Writers of this user hold the same stripe lock, so nothing newer
+        # can appear while the backend is read
+        with self.user_lock(user_id):
+            with self._lock:
+                record = self._lookup(user_id)
+                if record is not None:
+                    self.hits += 1
+                    return record.to_dict()
+                self.misses += 1
+            with STORAGE_LATENCY.time(self.backend.name, 'get_user'):
+                data = self.backend.get_user(user_id)
+            if data is None:
+                return None
+            record = UserRecord.from_dict(data)
+            with self._lock:
+                self._remember(user_id, record)
+            return record.to_dict()
+
+    def put(self, user_id: int, data: Dict) -> None:
+        """
+        Store a copy of the record and schedule it for the next flush
+        """
+        if self.capacity <= 0:
+            with STORAGE_LATENCY.time(self.backend.name, 'put_user'):
+                self.backend.put_user(user_id, data)
+            return
+
+        record = UserRecord.from_dict(data)
+        with self.user_lock(user_id):
+            with self._lock:
+                self._remember(user_id, record)
+                self._dirty[user_id] = record
+                full = len(self._dirty) >= self.flush_batch
+        if full:
+            self.flush()
+
+    def user_lock(self, user_id: int) -> threading.RLock:
+        """
+        Return the lock guarding read-modify-write cycles on user_id
+        """
+        return self._user_locks[hash(user_id) % len(self._user_locks)]
+
+    def update(self, user_id: int, mutate: Callable[[Dict], Any], create: bool = True) -> Any:
+        """
+        Atomically apply mutate to the user's record and store the result
+        The record is created with default values if the user is unknown;
+        with create=False an unknown user is left alone and None returned
+        Returns whatever mutate returns
+        """
+        with self.user_lock(user_id):
+            record = self.get(user_id)
+            if record is None:
+                if not create:
+                    return None
+                record = new_user_record(user_id)
+            result = mutate(record)
+            self.put(user_id, record)
+            return result
+
+    def _remember(self, user_id: int, record: UserRecord) -> None:
+        """
+        Insert into the LRU, evicting the least recently used entries
+        """
+        if self.capacity <= 0:
+            return
+        self._records[user_id] = record
+        self._records.move_to_end(user_id)
+        while len(self._records) > self.capacity:
+            self._records.popitem(last=False)
+            self.evictions += 1
+
+    def flush(self) -> int:
+        """
+        Write all dirty records to the backend in one batch
+        Returns the number of records written
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                self._flushing, self._dirty = self._dirty, {}
+            batch = [record.to_dict() for record in self._flushing.values()]
+            try:
+                with STORAGE_LATENCY.time(self.backend.name, 'put_users'):
+                    self.backend.put_users(batch)
+            except Exception:
+                # Keep them dirty, behind anything written since
+                with self._lock:
+                    self._dirty = {**self._flushing, **self._dirty}
+                    self._flushing = {}
+                raise
+            with self._lock:
+                self._flushing = {}
+                self.flushes += 1
+                self.flushed_records += len(batch)
+            return len(batch)
+
+    def flush_user(self, user_id: int) -> bool:
+        """
+        Write one user's dirty record to the backend now
+        Returns False if it had nothing waiting to be flushed
+        """
+        with self._flush_lock:
+            with self._lock:
+                record = self._dirty.get(user_id)
+                if record is None:
+                    return False
+                self._flushing = {user_id: record}
+                del self._dirty[user_id]
+            try:
+                with STORAGE_LATENCY.time(self.backend.name, 'put_user'):
+                    self.backend.put_user(user_id, record.to_dict())
+            except Exception:
+                with self._lock:
+                    self._dirty.setdefault(user_id, record)
+                    self._flushing = {}
+                raise
+            with self._lock:
+                self._flushing = {}
+                self.flushed_records += 1
+            return True
+
+    def stats(self) -> Dict:
+        """
+        Counters for tuning cache size and flush settings
+        Read without the lock, so the event loop never waits on storage
+        """
+        hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'size': len(self._records),
+            'capacity': self.capacity,
+            'dirty': len(self._dirty),
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'flushes': self.flushes,
+            'flushed_records': self.flushed_records,
+        }
+
+_user_cache: Optional[UserCache] = None
+
+def get_user_cache() -> UserCache:
+    """
+    Return the shared user cache, creating it on first use
+    """
+    global _user_cache
+    if _user_cache is None:
+        _user_cache = UserCache(get_storage(), USER_CACHE_SIZE, CACHE_FLUSH_BATCH)
+    return _user_cache
+
+async def journal_maintenance_loop(storage: JournalStorage) -> None:
+    """
+    Keep the journal fsynced and fold it into a snapshot when it grows
+    past JOURNAL_COMPACT_BYTES or every JOURNAL_COMPACT_INTERVAL seconds
+    """
+    loop = asyncio.get_running_loop()
+    last_compaction = time.monotonic()
+    while True:
+        await asyncio.sleep(1)
+        try:
+            with STORAGE_LATENCY.time(storage.name, 'sync'):
+                await loop.run_in_executor(None, storage.sync)
+            size = storage.journal_size()
+            due = time.monotonic() - last_compaction >= JOURNAL_COMPACT_INTERVAL
+            if size >= JOURNAL_COMPACT_BYTES or (due and size > 0):
+                with STORAGE_LATENCY.time(storage.name, 'compact'):
+                    count = await loop.run_in_executor(None, storage.compact)
+                last_compaction = time.monotonic()
+                logger.info(f"Compacted {size} journal bytes into a snapshot of {count} users")
+        except Exception as e:
+            logger.error(f"Error maintaining journal: {e}")
+
+async def cache_flush_loop() -> None:
+    """
+    Flush dirty user records every CACHE_FLUSH_INTERVAL seconds
+    """
+    cache = get_user_cache()
+    while True:
+        await asyncio.sleep(CACHE_FLUSH_INTERVAL)
+        try:
+            await get_store().run(cache.flush)
+        except Exception as e:
+            logger.error(f"Error flushing user cache: {e}")
+
+# =====================================================
+# REFERRAL INDEX - In-memory referral graph
+# =====================================================
+
+class ReferralIndex:
+    """
+    Referral graph kept in memory and updated incrementally
+    Holds referrer -> referees and referee -> referrer, plus per-user counts
+    of referrals at each level (friends, friends of friends, ...) so that
+    membership and count queries are O(1)
+    """
+
+    def __init__(self, levels: int):
+        self.levels = levels
+        self._referees: Dict[int, set] = {}
+        self._referrer: Dict[int, int] = {}
+        # user_id -> [referrals at level 1, level 2, ..., level `levels`]
+        self._level_counts: Dict[int, List[int]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, referrer_id: int, referee_id: int) -> bool:
+        """
+        Record a referral edge
+        Returns False if referee_id was already referred or the edge would
+        close a loop (referee_id is referrer_id or one of its referrers)
+        """
+        with self._lock:
+            if referee_id in self._referrer or self._is_ancestor(referee_id, referrer_id):
+                return False
+            self._referrer[referee_id] = referrer_id
+            self._referees.setdefault(referrer_id, set()).add(referee_id)
+
+            # The referee and everything under it move in below each ancestor:
+            # an ancestor `distance` levels up gains subtree[k] users at level distance + k
+            subtree = [1] + self._level_counts.get(referee_id, [0] * self.levels)
+            ancestor = referrer_id
+            for distance in range(1, self.levels + 1):
+                counts = self._level_counts.setdefault(ancestor, [0] * self.levels)
+                for k in range(self.levels - distance + 1):
+                    counts[distance + k - 1] += subtree[k]
+                ancestor = self._referrer.get(ancestor)
+                if ancestor is None:
+                    break
+            return True
+
+    def _is_ancestor(self, user_id: int, of: int) -> bool:
+        """
+        True if user_id is `of` or somewhere up its referrer chain;
+        the caller holds self._lock
+        """
+        seen = set()
+        current = of
+        while current is not None and current not in seen:
+            if current == user_id:
+                return True
+            seen.add(current)
+            current = self._referrer.get(current)
+        return False
+
+    def creates_cycle(self, referrer_id: int, referee_id: int) -> bool:
+        """
+        True if referrer_id referring referee_id would close a loop
+        """
+        with self._lock:
+            return self._is_ancestor(referee_id, referrer_id)
+
+    def was_referred(self, user_id: int) -> bool:
+        """
+        True if user_id joined through someone's referral link
+        """
+        return user_id in self._referrer
+
+    def referrer_of(self, user_id: int) -> Optional[int]:
+        """
+        Return who referred user_id, if anyone
+        """
+        return self._referrer.get(user_id)
+
+    def count(self, user_id: int) -> int:
+        """
+        Number of users referred directly by user_id
+        """
+        referees = self._referees.get(user_id)
+        return len(referees) if referees else 0
+
+    def level_counts(self, user_id: int) -> List[int]:
+        """
+        Referral counts per level, starting with direct referrals
+        """
+        return list(self._level_counts.get(user_id, [0] * self.levels))
+
+    def referees(self, user_id: int) -> set:
+        """
+        Users referred directly by user_id
+        """
+        return set(self._referees.get(user_id, ()))
+
+    def referrers(self) -> List[int]:
+        """
+        Users who referred at least one other user
+        """
+        with self._lock:
+            return list(self._referees)
+
+    def __len__(self) -> int:
+        return len(self._referrer)
+
+_referral_index: Optional[ReferralIndex] = None
+
+def get_referral_index() -> ReferralIndex:
+    """
+    Return the referral index, loading it from storage on first use
+    """
+    global _referral_index
+    if _referral_index is None:
+        index = ReferralIndex(REFERRAL_LEVELS)
+        storage = get_storage()
+        with STORAGE_LATENCY.time(storage.name, 'iter_referrals'):
+            for referrer_id, referee_id in storage.iter_referrals():
+                index.add(referrer_id, referee_id)
+        logger.info(f"Loaded {len(index)} referrals into the referral index")
+        _referral_index = index
+    return _referral_index
+
+# =====================================================
+# LEADERBOARD - Rankings by stars and referrals
+# =====================================================
+
+class _SkipNode:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key: Any, height: int):
+        self.key = key
+        self.next: List[Optional['_SkipNode']] = [None] * height
+        # width[level] = how many positions next[level] is ahead of this node
+        self.width = [1] * height
+
+class RankedSet:
+    """
+    Sorted set with O(log n) add, remove and rank lookups
+    An indexable skiplist: each link also records how many elements it
+    jumps over, so the position of a key is summed up on the way down
+    """
+
+    MAX_HEIGHT = 24  # Plenty for 2**24 members
+
+    def __init__(self):
+        self._head = _SkipNode(None, self.MAX_HEIGHT)
+        self._size = 0
+
+    def _path(self, key: Any) -> tuple:
+        """
+        Return the last node before key on every level, and the positions
+        of those nodes (the head is position 0)
+        """
+        chain = [self._head] * self.MAX_HEIGHT
+        positions = [0] * self.MAX_HEIGHT
+        node = self._head
+        position = 0
+        for level in reversed(range(self.MAX_HEIGHT)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+            positions[level] = position
+        return chain, positions
+
+    def add(self, key: Any) -> None:
+        """
+        Insert key; keys must be unique
+        """
+        chain, positions = self._path(key)
+        height = 1
+        while height < self.MAX_HEIGHT and random.random() < 0.5:
+            height += 1
+        node = _SkipNode(key, height)
+        position = positions[0] + 1
+        for level in range(height):
+            prev = chain[level]
+            node.next[level] = prev.next[level]
+            prev.next[level] = node
+            node.width[level] = prev.width[level] - (position - 1 - positions[level])
+            prev.width[level] = position - positions[level]
+        for level in range(height, self.MAX_HEIGHT):
+            chain[level].width[level] += 1
+        self._size += 1
+
+    def remove(self, key: Any) -> bool:
+        """
+        Remove key. Returns False if it wasn't present
+        """
+        chain, _ = self._path(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            return False
+        for level in range(len(node.next)):
+            prev = chain[level]
+            prev.width[level] += node.width[level] - 1
+            prev.next[level] = node.next[level]
+        for level in range(len(node.next), self.MAX_HEIGHT):
+            chain[level].width[level] -= 1
+        self._size -= 1
+        return True
+
+    def rank(self, key: Any) -> int:
+        """
+        Number of members smaller than key
+        """
+        return self._path(key)[1][0]
+
+    def first(self, count: int) -> List[Any]:
+        """
+        The count smallest members in order
+        """
+        keys = []
+        node = self._head.next[0]
+        while node is not None and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+    def __len__(self) -> int:
+        return self._size
+
+class Leaderboard:
+    """
+    Users ranked by stars and by direct referrals
+    Scores are updated as they change, so top-N and rank queries never
+    look at the database. Only users with a positive score are ranked;
+    everyone else shares the place after the last ranked user
+    """
+
+    BOARDS = ('stars', 'referrals')
+
+    def __init__(self):
+        self._scores: Dict[str, Dict[int, float]] = {board: {} for board in self.BOARDS}
+        # Keys are (-score, user_id): best first, ties broken by who joined first
+        self._ranked = {board: RankedSet() for board in self.BOARDS}
+        self._lock = threading.Lock()
+
+    def set_score(self, board: str, user_id: int, score: float) -> bool:
+        """
+        Record the user's current score on board
+        Returns False if it was already known
+        """
+        with self._lock:
+            scores = self._scores[board]
+            old = scores.get(user_id, 0)
+            if old == score:
+                return False
+            ranked = self._ranked[board]
+            if old > 0:
+                ranked.remove((-old, user_id))
+            if score > 0:
+                ranked.add((-score, user_id))
+                scores[user_id] = score
+            else:
+                scores.pop(user_id, None)
+            return True
+
+    def top(self, board: str, count: int) -> List[tuple]:
+        """
+        The count best (user_id, score) pairs on board
+        """
+        with self._lock:
+            return [(user_id, -score) for score, user_id in self._ranked[board].first(count)]
+
+    def rank(self, board: str, user_id: int) -> tuple:
+        """
+        Return (1-based rank, score) of the user on board
+        """
+        with self._lock:
+            score = self._scores[board].get(user_id, 0)
+            ranked = self._ranked[board]
+            if score <= 0:
+                return len(ranked) + 1, 0
+            return ranked.rank((-score, user_id)) + 1, score
+
+    def size(self, board: str) -> int:
+        """
+        Number of ranked users on board
+        """
+        return len(self._ranked[board])
+
+_leaderboard: Optional[Leaderboard] = None
+
+def get_leaderboard() -> Leaderboard:
+    """
+    Return the leaderboard, building it from storage and the referral index
+    on first use
+    """
+    global _leaderboard
+    if _leaderboard is None:
+        board = Leaderboard()
+        # Balances still waiting in the write-behind cache must be counted too
+        get_user_cache().flush()
+        storage = get_storage()
+        with STORAGE_LATENCY.time(storage.name, 'iter_balances'):
+            for user_id, stars in storage.iter_balances():
+                board.set_score('stars', user_id, stars)
+        index = get_referral_index()
+        for referrer_id in index.referrers():
+            board.set_score('referrals', referrer_id, index.count(referrer_id))
+        logger.info(f"Loaded {board.size('stars')} balances and {board.size('referrals')} referrers into the leaderboard")
+        _leaderboard = board
+    return _leaderboard
+
+def update_leaderboard(board: str, user_id: int, score: float) -> None:
+    """
+    Record a changed score and pass it on to the other cluster workers
+    """
+    if get_leaderboard().set_score(board, user_id, score):
+        share_score(board, user_id, score)
+
+# =====================================================
+# TASK CATALOG - Hot-reloadable task list
+# =====================================================
+
+TASK_EVENTS = Counter('bot_task_events_total', "Task screens opened, verifications and completions", ('task', 'event'))
+METRICS.append(TASK_EVENTS)
+
+class TaskCatalog:
+    """
+    Task list loaded from a JSON file and indexed by task id
+    The file is re-read when it changes, so tasks can be added, edited or
+    retired without a restart. Completion counts are kept per task and a
+    task drops off the list once it reaches its max_completions
+    """
+
+    REQUIRED_FIELDS = ('id', 'name', 'link', 'chat_id')
+    EVENTS = ('opened', 'verified', 'completed')
+
+    def __init__(self, path: str, defaults: List[Dict], reload_interval: float, completions: Dict[str, int]):
+        self.path = path
+        self.defaults = defaults
+        self.reload_interval = reload_interval
+        # task_id -> users who completed it, all time
+        self.completions = dict(completions)
+        # task_id -> {event: count} since the process started
+        self.events: Dict[str, Dict[str, int]] = {}
+        self.version = 0
+        self._tasks: Dict[str, Dict] = {}
+        self._listed: List[Dict] = []
+        # (mtime, size) of the loaded file, None while using the defaults
+        self._stamp: Optional[tuple] = None
+        self._checked_at = time.monotonic()
+        self._lock = threading.RLock()
+        self.reload(force=True)
+
+    @classmethod
+    def normalize(cls, task: Dict) -> Dict:
+        """
+        Validate a task definition and fill in the optional fields
+        """
+        missing = [field for field in cls.REQUIRED_FIELDS if field not in task]
+        if missing:
+            raise ValueError(f"task {task.get('id', '?')} is missing {', '.join(missing)}")
+        normalized = {'type': 'channel', 'reward': TASK_REWARD, 'max_completions': None, 'active': True}
+        normalized.update(task)
+        normalized['id'] = str(normalized['id'])
+        return normalized
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Load the catalog again if the file changed
+        An invalid file is logged and the current catalog is kept
+        """
+        try:
+            stat = os.stat(self.path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._stamp and not force:
+            return False
+
+        source = self.path if stamp is not None else 'built-in TASKS'
+        try:
+            if stamp is None:
+                definitions = self.defaults
+            else:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    definitions = json.load(f)
+            tasks = [self.normalize(task) for task in definitions]
+        except (OSError, TypeError, ValueError) as e:
+            logger.error(f"Keeping the current task catalog, could not load {source}: {e}")
+            self._stamp = stamp
+            return False
+
+        with self._lock:
+            self._tasks = {task['id']: task for task in tasks}
+            self._stamp = stamp
+            self._relist()
+        logger.info(f"Loaded {len(tasks)} tasks from {source}, {len(self._listed)} available")
+        return True
+
+    def maybe_reload(self) -> None:
+        """
+        Check the file for changes at most every reload_interval seconds
+        """
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            self._checked_at = now
+            self.reload()
+
+    def _relist(self) -> None:
+        """
+        Rebuild the list of available tasks; called with the lock held
+        """
+        self._listed = [task for task in self._tasks.values() if self._available(task)]
+        self.version += 1
+        build_tasks_keyboard.cache_clear()
+
+    def _available(self, task: Dict) -> bool:
+        cap = task['max_completions']
+        return bool(task['active']) and (cap is None or self.completions.get(task['id'], 0) < cap)
+
+    def get(self, task_id: str) -> Optional[Dict]:
+        """
+        Look up a task by id, including retired ones
+        """
+        return self._tasks.get(task_id)
+
+    def is_available(self, task_id: str) -> bool:
+        """
+        True if the task is listed and can still be completed
+        """
+        task = self._tasks.get(task_id)
+        return task is not None and self._available(task)
+
+    def listed(self) -> List[Dict]:
+        """
+        Available tasks in catalog order
+        """
+        return self._listed
+
+    def reserve(self, task_id: str) -> bool:
+        """
+        Count a completion unless the task is unavailable or at its cap
+        """
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None or not self._available(task):
+                return False
+            self.record_completion(task_id)
+            return True
+
+    def release(self, task_id: str) -> None:
+        """
+        Undo a reserve() whose completion didn't happen or was revoked
+        """
+        with self._lock:
+            self.completions[task_id] = max(0, self.completions.get(task_id, 0) - 1)
+            task = self._tasks.get(task_id)
+            if task is not None and self._available(task) and task not in self._listed:
+                self._relist()
+
+    def record_completion(self, task_id: str) -> None:
+        """
+        Count a completion, retiring the task when it reaches its cap
+        """
+        with self._lock:
+            self.completions[task_id] = self.completions.get(task_id, 0) + 1
+            task = self._tasks.get(task_id)
+            if task is not None and task in self._listed and not self._available(task):
+                logger.info(f"Task {task_id} reached {task['max_completions']} completions and was retired")
+                self._relist()
+
+    def count(self, task_id: str, event: str) -> None:
+        """
+        Count a task event (opened, verified, completed)
+        """
+        with self._lock:
+            events = self.events.setdefault(task_id, dict.fromkeys(self.EVENTS, 0))
+            events[event] += 1
+        TASK_EVENTS.inc(task_id, event)
+
+    def stats(self) -> List[Dict]:
+        """
+        Per-task counters for the admin report, in catalog order
+        """
+        with self._lock:
+            return [
+                dict(self.events.get(task['id'], dict.fromkeys(self.EVENTS, 0)),
+                     id=task['id'], name=task['name'], available=self._available(task),
+                     completions=self.completions.get(task['id'], 0), max_completions=task['max_completions'])
+                for task in self._tasks.values()
+            ]
+
+_task_catalog: Optional[TaskCatalog] = None
+
+def get_task_catalog() -> TaskCatalog:
+    """
+    Return the task catalog, loading it and the completion counts on first
+    use and picking up changes to TASKS_FILE afterwards
+    """
+    global _task_catalog
+    if _task_catalog is None:
+        # Completions still waiting in the write-behind cache must be counted too
+        get_user_cache().flush()
+        storage = get_storage()
+        with STORAGE_LATENCY.time(storage.name, 'count_completions'):
+            completions = storage.count_completions()
+        _task_catalog = TaskCatalog(TASKS_FILE, TASKS, TASKS_RELOAD_INTERVAL, completions)
+    else:
+        _task_catalog.maybe_reload()
+    return _task_catalog
+
+# =====================================================
+# USER DATA ACCESS - Read and update user records
+# =====================================================
+
+def get_user_data(user_id: int) -> Dict:
+    """
+    Get user data from database
+    Creates new user if doesn't exist
+    """
+    cache = get_user_cache()
+    user_data = cache.get(user_id)
+
+    if user_data is None:
+        # Create new user with default values
+        user_data = new_user_record(user_id)
+        cache.put(user_id, user_data)
+
+    return user_data
+
+def update_user_data(user_id: int, data: Dict) -> None:
+    """
+    Update user data in database
+    Replaces the whole record; use mutate_user_data for read-modify-write
+    """
+    get_user_cache().put(user_id, data)
+    update_leaderboard('stars', user_id, data['stars'])
+
+def mutate_user_data(user_id: int, mutate: Callable[[Dict], Any], create: bool = True) -> Any:
+    """
+    Atomically apply mutate to the user's current record
+    Returns whatever mutate returns, or None for an unknown user when
+    create is False
+    """
+    def apply(user_data: Dict) -> Any:
+        result = mutate(user_data)
+        # Still under the user's lock, so the leaderboard sees changes in order
+        update_leaderboard('stars', user_id, user_data['stars'])
+        return result
+
+    return get_user_cache().update(user_id, apply, create)
+
+def increment_stars(user_id: int, delta: float, reason: str = "") -> float:
+    """
+    Atomically add delta (may be negative) to the user's balance
+    Returns new balance
+    """
+    def apply(user_data: Dict) -> float:
+        user_data['stars'] = round(user_data['stars'] + delta, 2)
+        return user_data['stars']
+
+    new_balance = mutate_user_data(user_id, apply)
+    logger.info(f"Added {delta} stars to user {user_id}. Reason: {reason}")
+    return new_balance
+
+def compare_and_set(user_id: int, field: str, expected: Any, new_value: Any) -> bool:
+    """
+    Set field to new_value only if it currently equals expected
+    Returns True if the value was changed
+    """
+    def apply(user_data: Dict) -> bool:
+        if user_data.get(field) != expected:
+            return False
+        user_data[field] = new_value
+        return True
+
+    return mutate_user_data(user_id, apply)
+
+def add_stars(user_id: int, amount: float, reason: str = "") -> float:
+    """
+    Add stars to user account
+    Returns new total
+    """
+    return increment_stars(user_id, amount, reason)
+
+def record_referral(referrer_id: int, referee_id: int) -> None:
+    """
+    Add a referral edge to the referral index and the referrer's ranking
+    """
+    index = get_referral_index()
+    if index.add(referrer_id, referee_id):
+        get_leaderboard().set_score('referrals', referrer_id, index.count(referrer_id))
+
+def claim_referral(user_id: int, referrer_id: int) -> bool:
+    """
+    Record that user_id was referred by referrer_id and reward the referrer
+    Returns False for self-referrals, users that were already referred and
+    links that would make a user their own (indirect) referrer
+    """
+    if referrer_id == user_id:
+        return False
+    referral_index = get_referral_index()
+    if referral_index.was_referred(user_id) or referral_index.creates_cycle(referrer_id, user_id):
+        return False
+    if not compare_and_set(user_id, 'referred_by', None, referrer_id):
+        return False
+
+    record_referral(referrer_id, user_id)
+    share_referral(referrer_id, user_id)
+    # The referrer may be owned by another cluster worker
+    run_user_op(referrer_id, 'increment_stars', REFERRAL_REWARD, f"Referral from {user_id}")
+    return True
+
+def complete_task(user_id: int, task: Dict) -> Optional[float]:
+    """
+    Mark task as completed and grant its reward in one atomic step
+    Returns new balance, or None if the task was already completed or has
+    reached its completion cap
+    """
+    def apply(user_data: Dict) -> Optional[float]:
+        if task['id'] in user_data['completed_tasks']:
+            return None
+        user_data['completed_tasks'].append(task['id'])
+        user_data['stars'] = round(user_data['stars'] + task['reward'], 2)
+        return user_data['stars']
+
+    catalog = get_task_catalog()
+    if not catalog.reserve(task['id']):
+        return None
+    new_balance = mutate_user_data(user_id, apply)
+    if new_balance is None:
+        catalog.release(task['id'])
+        return None
+
+    catalog.count(task['id'], 'completed')
+    share_task_completion(task['id'])
+    logger.info(f"Added {task['reward']} stars to user {user_id}. Reason: Task {task['id']}")
+    return new_balance
+
+def revoke_task(user_id: int, task_id: str, reward: float) -> Optional[float]:
+    """
+    Undo a task completion and take its reward back, without going below zero
+    Returns the stars taken back, or None if the task wasn't completed
+    """
+    def apply(user_data: Dict) -> Optional[float]:
+        if task_id not in user_data['completed_tasks']:
+            return None
+        user_data['completed_tasks'].remove(task_id)
+        taken = round(min(reward, max(user_data['stars'], 0)), 2)
+        user_data['stars'] = round(user_data['stars'] - taken, 2)
+        return taken
+
+    taken = mutate_user_data(user_id, apply)
+    if taken is not None:
+        # Free the completion slot, or every leave-and-rejoin would use up another one
+        get_task_catalog().release(task_id)
+        share_task_release(task_id)
+        logger.info(f"Took back {taken} stars from user {user_id}. Reason: Left task {task_id}")
+    return taken
+
+def create_withdrawal(user_id: int, amount: int) -> Optional[tuple]:
+    """
+    Deduct amount and record a pending withdrawal request
+    Returns (new balance, withdrawal id), or None if the balance is too low
+    """
+    def apply(user_data: Dict) -> Optional[float]:
+        if user_data['stars'] < amount:
+            return None
+        user_data['stars'] = round(user_data['stars'] - amount, 2)
+        return user_data['stars']
+
+    new_balance = mutate_user_data(user_id, apply)
+    if new_balance is None:
+        return None
+    # The request is written straight to storage, so the deduction must be
+    # stored first; otherwise a crash before the next flush would keep the
+    # request and give the stars back
+    get_user_cache().flush_user(user_id)
+
+    storage = get_storage()
+    try:
+        with STORAGE_LATENCY.time(storage.name, 'add_withdrawal'):
+            withdrawal_id = storage.add_withdrawal(user_id, amount, datetime.now().isoformat())
+    except Exception:
+        # The request wasn't recorded, so don't keep the stars
+        increment_stars(user_id, amount, "Withdrawal could not be recorded")
+        raise
+    return new_balance, withdrawal_id
+
+def set_user_blocked(user_id: int, blocked: bool) -> None:
+    """
+    Remember whether the user has blocked the bot
+    Blocked users are skipped by broadcasts
+    """
+    def apply(user_data: Dict) -> None:
+        user_data['blocked'] = blocked
+
+    mutate_user_data(user_id, apply)
+
+def settle_withdrawals(ids: Optional[Iterable[int]], status: str) -> List[Dict]:
+    """
+    Approve or reject pending withdrawals in one storage transaction
+    ids=None settles every pending request. Rejected amounts are refunded.
+    Returns the requests that were settled
+    """
+    storage = get_storage()
+    with STORAGE_LATENCY.time(storage.name, 'settle_withdrawals'):
+        settled = storage.settle_withdrawals(ids, status)
+
+    if status == 'rejected' and settled:
+        for withdrawal in settled:
+            run_user_op(withdrawal['user_id'], 'increment_stars', withdrawal['amount'],
+                        f"Withdrawal #{withdrawal['id']} rejected")
+        # Make the refunds as durable as the status change
+        get_user_cache().flush()
+    return settled
+
+# =====================================================
+# ASYNC STORE - Storage calls off the event loop
+# =====================================================
+
+class AsyncStore:
+    """
+    Awaitable front for the user data functions above
+    Calls run on a dedicated thread pool of `workers` threads, so at most
+    that many storage calls are in flight and a slow load or save never
+    stalls other updates. The functions are already thread-safe: the cache
+    serializes per user and every backend guards its own state
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Calls submitted and not finished yet, including queued ones
+        self.pending = 0
+        self.calls = 0
+
+    async def run(self, func: Callable, *args) -> Any:
+        """
+        Run func(*args) on a storage thread and return its result
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='storage')
+        self.pending += 1
+        self.calls += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def get_user(self, user_id: int) -> Dict:
+        """
+        Awaitable get_user_data
+        """
+        return await self.run(get_user_data, user_id)
+
+    async def update_user(self, user_id: int, mutate: Callable[[Dict], Any]) -> Any:
+        """
+        Awaitable mutate_user_data; mutate runs on a storage thread
+        """
+        return await self.run(mutate_user_data, user_id, mutate)
+
+    def close(self) -> None:
+        """
+        Wait for running calls and stop the threads
+        A later run() starts a fresh pool
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> Dict:
+        """
+        Counters for /botstats
+        """
+        return {'workers': self.workers, 'pending': self.pending, 'calls': self.calls}
+
+_store: Optional[AsyncStore] = None
+
+def get_store() -> AsyncStore:
+    """
+    Return the shared async store, creating it on first use
+    """
+    global _store
+    if _store is None:
+        _store = AsyncStore(STORAGE_WORKERS)
+    return _store
+
+# =====================================================
+# SNAPSHOTS - Rotating compressed copies of the database
+# =====================================================
+
+SNAPSHOTS = Counter('bot_snapshots_total', "Database snapshots taken by outcome", ('outcome',))
+METRICS.append(SNAPSHOTS)
+
+def storage_files(backend: str) -> List[str]:
+    """
+    Files holding a backend's data
+    A snapshot restores into the first one; the others are state that
+    belongs to the data being replaced
+    """
+    if backend == 'sqlite':
+        return [SQLITE_DATABASE_FILE, f"{SQLITE_DATABASE_FILE}-wal", f"{SQLITE_DATABASE_FILE}-shm"]
+    if backend == 'journal':
+        return [JOURNAL_SNAPSHOT_FILE, JOURNAL_FILE, f"{JOURNAL_FILE}.1"]
+    return [DATABASE_FILE]
+
+def file_sha256(path: str) -> str:
+    """
+    Hex SHA-256 of a file, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class SnapshotManager:
+    """
+    Point-in-time snapshots of the storage backend, gzip-compressed
+    Each snapshot is <backend>-<UTC time>.gz with a .sha256 file next to it
+    in sha256sum format. Only the newest `keep` snapshots are kept
+    """
+
+    def __init__(self, directory: str, keep: int):
+        self.directory = directory
+        self.keep = keep
+        self.taken = 0
+        self.failed = 0
+        self.last: Optional[Dict] = None
+
+    def list(self) -> List[str]:
+        """
+        Snapshot paths, newest first
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        names = [name for name in os.listdir(self.directory)
+                 if name.endswith('.gz') and name.split('-', 1)[0] in STORAGE_BACKENDS]
+        names.sort(key=lambda name: name.split('-', 1)[1], reverse=True)
+        return [os.path.join(self.directory, name) for name in names]
+
+    def newest_time(self) -> Optional[float]:
+        """
+        Modification time of the newest snapshot, None if there is none
+        """
+        paths = self.list()
+        return os.path.getmtime(paths[0]) if paths else None
+
+    def take(self, storage: StorageBackend) -> str:
+        """
+        Snapshot storage, compress it and drop snapshots past `keep`
+        Runs on a background thread; returns the new snapshot's path
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        start = time.monotonic()
+        # Microseconds keep the loop and the snapshot command from picking the same name
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S.%fZ')
+        path = os.path.join(self.directory, f"{storage.name}-{stamp}.gz")
+        raw_path = f"{path}.{os.getpid()}.raw"
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            storage.snapshot(raw_path)
+            with open(raw_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                with gzip.GzipFile(os.path.basename(raw_path), 'wb', compresslevel=6, fileobj=dst) as gz:
+                    shutil.copyfileobj(src, gz, 1024 * 1024)
+                dst.flush()
+                os.fsync(dst.fileno())
+            checksum = file_sha256(tmp_path)
+            # Unlike os.replace, link refuses to overwrite an existing snapshot
+            os.link(tmp_path, path)
+            with open(f"{path}.sha256.tmp", 'w', encoding='utf-8') as f:
+                f.write(f"{checksum}  {os.path.basename(path)}\n")
+            os.replace(f"{path}.sha256.tmp", f"{path}.sha256")
+        finally:
+            for leftover in (raw_path, tmp_path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+        for old in self.list()[max(self.keep, 1):]:
+            for stale in (old, f"{old}.sha256"):
+                if os.path.exists(stale):
+                    os.remove(stale)
+        self.taken += 1
+        self.last = {
+            'path': path,
+            'bytes': os.path.getsize(path),
+            'seconds': round(time.monotonic() - start, 2),
+            'at': stamp,
+        }
+        return path
+
+    @staticmethod
+    def verify(path: str) -> bool:
+        """
+        True if path matches the checksum recorded next to it
+        """
+        checksum_path = f"{path}.sha256"
+        if not os.path.exists(path) or not os.path.exists(checksum_path):
+            return False
+        with open(checksum_path, 'r', encoding='utf-8') as f:
+            expected = f.read().split()[:1]
+        return expected == [file_sha256(path)]
+
+    @staticmethod
+    def restore(path: str, files: List[str]) -> None:
+        """
+        Decompress a verified snapshot over files[0] and remove the other files
+        Whatever is replaced is kept as <file>.pre-restore
+        """
+        if not SnapshotManager.verify(path):
+            raise ValueError(f"{path} is missing its checksum or does not match it")
+        target = files[0]
+        directory = os.path.dirname(os.path.abspath(target))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{target}.restore"
+        # gzip checks its own CRC as the last block is read
+        with gzip.open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            dst.flush()
+            os.fsync(dst.fileno())
+        for existing in files:
+            if os.path.exists(existing):
+                os.replace(existing, f"{existing}.pre-restore")
+        os.replace(tmp_path, target)
+
+    def stats(self) -> Dict:
+        """
+        Counters for /botstats
+        """
+        last = self.last or {}
+        return {
+            'kept': len(self.list()),
+            'taken': self.taken,
+            'failed': self.failed,
+            'last': last.get('at', 'never'),
+            'last_bytes': last.get('bytes', 0),
+            'last_seconds': last.get('seconds', 0),
+        }
+
+_snapshots: Optional[SnapshotManager] = None
+
+def get_snapshots() -> SnapshotManager:
+    """
+    Return the shared snapshot manager, creating it on first use
+    """
+    global _snapshots
+    if _snapshots is None:
+        _snapshots = SnapshotManager(SNAPSHOT_DIR, SNAPSHOT_KEEP)
+    return _snapshots
+
+async def snapshot_loop() -> None:
+    """
+    Take a snapshot every SNAPSHOT_INTERVAL seconds
+    The schedule survives restarts: the next snapshot is due one interval
+    after the newest one on disk
+    """
+    loop = asyncio.get_running_loop()
+    manager = get_snapshots()
+    storage = get_storage()
+    while True:
+        newest = await loop.run_in_executor(None, manager.newest_time)
+        delay = 0 if newest is None else newest + SNAPSHOT_INTERVAL - time.time()
+        await asyncio.sleep(max(delay, 0))
+        try:
+            # Write back cached users first so the snapshot has them
+            await get_store().run(get_user_cache().flush)
+            # Compression runs on its own thread, never a storage thread
+            with STORAGE_LATENCY.time(storage.name, 'snapshot'):
+                path = await loop.run_in_executor(None, manager.take, storage)
+            SNAPSHOTS.inc('ok')
+            logger.info(f"Wrote snapshot {path} ({manager.last['bytes']} bytes)")
+        except Exception as e:
+            manager.failed += 1
+            SNAPSHOTS.inc('error')
+            logger.error(f"Error taking snapshot: {e}")
+            await asyncio.sleep(min(SNAPSHOT_INTERVAL, 300))
+
+# =====================================================
+# RATE LIMITING - Token buckets for Telegram API calls
+# =====================================================
+
+class TokenBucket:
+    """
+    Token bucket rate limiter
+    Async callers wait in FIFO order for a token instead of failing.
+    A rate of 0 or less means no limit; pause() still applies
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self.waiting = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """
+        Take tokens if available right now, without waiting
+        """
+        if time.monotonic() < self._paused_until:
+            return False
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """
+        Wait until tokens are available and take them
+        asyncio.Lock wakes waiters in FIFO order, so this doubles as the queue
+        """
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    pause = self._paused_until - time.monotonic()
+                    if pause > 0:
+                        await asyncio.sleep(pause)
+                        continue
+                    if self.rate <= 0:
+                        return
+                    self._refill()
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return
+                    await asyncio.sleep((tokens - self._tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop handing out tokens for a while, e.g. after a RetryAfter from Telegram
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+# =====================================================
+# THROTTLING - Per-user limits in front of the handlers
+# =====================================================
+
+THROTTLED_PRESSES = Counter('bot_throttled_presses_total', "Button presses dropped before reaching a handler", ('reason',))
+METRICS.append(THROTTLED_PRESSES)
+
+class CallbackThrottle:
+    """
+    Decides whether a button press may reach the handlers
+    Repeated presses of the same button on the same message within
+    debounce_window are duplicates; beyond that every user has a token
+    bucket. Both tables are bounded LRUs, so idle users fall out
+    """
+
+    def __init__(self, rate: float, burst: float, debounce_window: float, max_users: int):
+        self.rate = rate
+        self.burst = burst
+        self.debounce_window = debounce_window
+        self.max_users = max_users
+        self._buckets: OrderedDict = OrderedDict()
+        # (user_id, message key, data) -> monotonic time of the accepted press
+        self._presses: OrderedDict = OrderedDict()
+        self.allowed = 0
+        self.duplicates = 0
+        self.throttled = 0
+
+    def check(self, user_id: int, message_key: Any, data: str) -> Optional[str]:
+        """
+        Return None if the press may proceed, else 'duplicate' or 'throttled'
+        """
+        now = time.monotonic()
+        # Entries are kept in acceptance order, so expired ones are at the front
+        while self._presses and (now - next(iter(self._presses.values())) >= self.debounce_window
+                                 or len(self._presses) > self.max_users):
+            self._presses.popitem(last=False)
+
+        key = (user_id, message_key, data)
+        if key in self._presses:
+            self.duplicates += 1
+            return 'duplicate'
+
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        if not bucket.try_acquire():
+            self.throttled += 1
+            return 'throttled'
+
+        self._presses[key] = now
+        self.allowed += 1
+        return None
+
+    def stats(self) -> Dict:
+        """
+        Counters for /botstats
+        """
+        return {
+            'allowed': self.allowed,
+            'duplicates': self.duplicates,
+            'throttled': self.throttled,
+            'tracked_users': len(self._buckets)
+        }
+
+_callback_throttle: Optional[CallbackThrottle] = None
+
+def get_callback_throttle() -> CallbackThrottle:
+    """
+    Return the shared callback throttle, creating it on first use
+    """
+    global _callback_throttle
+    if _callback_throttle is None:
+        _callback_throttle = CallbackThrottle(THROTTLE_RATE, THROTTLE_BURST, DEBOUNCE_WINDOW, THROTTLE_MAX_USERS)
+    return _callback_throttle
+
+async def throttle_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Runs before every handler (group -1)
+    Dropped presses only get their spinner cleared, without touching storage
+    """
+    query = update.callback_query
+    if query is None or query.from_user is None:
+        return
+
+    message_key = (query.message.chat_id, query.message.message_id) if query.message else query.inline_message_id
+    reason = get_callback_throttle().check(query.from_user.id, message_key, query.data)
+    if reason is None:
+        return
+
+    THROTTLED_PRESSES.inc(reason)
+    try:
+        if reason == 'throttled':
+            await query.answer(render('slow_down'))
+        else:
+            await query.answer()
+    except TelegramError as e:
+        logger.debug(f"Could not answer dropped press from {query.from_user.id}: {e}")
+    raise ApplicationHandlerStop
+
+# =====================================================
+# MEMBERSHIP CHECKS - Cached, coalesced getChatMember calls
+# =====================================================
+
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+class MembershipChecker:
+    """
+    Answers "is user X in chat Y" with as few getChatMember calls as possible
+    Results are cached for a short TTL, concurrent checks for the same pair
+    share one API call, and all calls go through a global token bucket
+    """
+
+    def __init__(self, limiter: TokenBucket, positive_ttl: float, negative_ttl: float,
+                 max_wait: float, max_entries: int = 100000):
+        self.limiter = limiter
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_wait = max_wait
+        self.max_entries = max_entries
+        self._cache: 'OrderedDict[tuple, tuple]' = OrderedDict()
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.api_calls = 0
+        self.retries = 0
+
+    async def is_member(self, bot: Bot, chat_id, user_id: int) -> bool:
+        """
+        Return True if user_id is a member of chat_id
+        Raises if Telegram can't answer within max_wait
+        """
+        key = (str(chat_id), user_id)
+
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # The lookup runs as its own task, so cancelling whichever caller
+            # started it doesn't cancel it for everyone else waiting
+            inflight = asyncio.ensure_future(self._lookup(bot, chat_id, user_id, key))
+            # Mark the exception as retrieved in case every waiter went away
+            inflight.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self._inflight[key] = inflight
+        return await asyncio.shield(inflight)
+
+    async def _lookup(self, bot: Bot, chat_id, user_id: int, key: tuple) -> bool:
+        """
+        One shared getChatMember lookup, cached on success
+        """
+        try:
+            is_member = await asyncio.wait_for(self._fetch(bot, chat_id, user_id), self.max_wait)
+        finally:
+            del self._inflight[key]
+        self._remember(key, is_member)
+        return is_member
+
+    async def _fetch(self, bot: Bot, chat_id, user_id: int) -> bool:
+        while True:
+            await self.limiter.acquire()
+            self.api_calls += 1
+            try:
+                member = await bot.get_chat_member(chat_id, user_id)
+            except RetryAfter as e:
+                # Telegram asked us to back off: hold every caller, then retry
+                self.retries += 1
+                self.limiter.pause(e.retry_after)
+                continue
+            return member.status in MEMBER_STATUSES
+
+    def _remember(self, key: tuple, is_member: bool) -> None:
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._cache[key] = (time.monotonic() + ttl, is_member)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, chat_id, user_id: int) -> None:
+        """
+        Forget the cached answer for one (chat, user) pair
+        """
+        self._cache.pop((str(chat_id), user_id), None)
+
+    def stats(self) -> Dict:
+        """
+        Counters for tuning TTLs and the rate limit
+        """
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'api_calls': self.api_calls,
+            'retries': self.retries,
+            'in_flight': len(self._inflight),
+            'queued': self.limiter.waiting,
+        }
+
+_membership_checker: Optional[MembershipChecker] = None
+
+def get_membership_checker() -> MembershipChecker:
+    """
+    Return the shared membership checker, creating it on first use
+    """
+    global _membership_checker
+    if _membership_checker is None:
+        _membership_checker = MembershipChecker(
+            TokenBucket(MEMBERSHIP_CHECK_RATE, MEMBERSHIP_CHECK_BURST),
+            MEMBERSHIP_POSITIVE_TTL,
+            MEMBERSHIP_NEGATIVE_TTL,
+            MEMBERSHIP_MAX_WAIT
+        )
+    return _membership_checker
+
+# =====================================================
+# OUTBOUND QUEUE - Persistent, rate-limited message sending
+# =====================================================
+
+class OutboundQueue:
+    """
+    Persistent queue of outgoing messages
+    Handlers enqueue and return immediately; background workers send under a
+    global and a per-chat token bucket, retrying on RetryAfter and network errors.
+    Pending messages live in a small SQLite file so they survive restarts;
+    it is written on the queue's own thread, one statement at a time
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            created_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        );
+    """
+
+    def __init__(self, path: str, global_rate: float, chat_rate: float, workers: int, max_attempts: int):
+        self.path = path
+        self.limiter = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._chat_limiters: 'OrderedDict[int, TokenBucket]' = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._bot: Optional[Bot] = None
+        # Awaited with chat_id when a recipient has blocked the bot
+        self.blocked_callbacks: List[Callable[[int], Awaitable]] = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+        # A single thread keeps writes in order and off the event loop
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+
+    async def _write(self, func: Callable, *args) -> Any:
+        """
+        Run func(*args) on the writer thread and return its result
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._writer, func, *args)
+
+    async def enqueue(self, chat_id: int, text: str, parse_mode: Optional[str] = None) -> None:
+        """
+        Queue one message for delivery
+        """
+        await self.enqueue_many([(chat_id, text, parse_mode)])
+
+    async def enqueue_many(self, messages: Iterable[tuple]) -> None:
+        """
+        Queue (chat_id, text, parse_mode) tuples in a single transaction
+        """
+        rows = await self._write(self._insert, list(messages), time.time())
+        if self._queue is not None:
+            for row in rows:
+                self._queue.put_nowait(row)
+
+    def _insert(self, messages: List[tuple], now: float) -> List[Dict]:
+        rows = []
+        self._conn.execute('BEGIN')
+        try:
+            for chat_id, text, parse_mode in messages:
+                cursor = self._conn.execute(
+                    'INSERT INTO outbox (chat_id, text, parse_mode, created_at) VALUES (?, ?, ?, ?)',
+                    (chat_id, text, parse_mode, now)
+                )
+                rows.append({'id': cursor.lastrowid, 'chat_id': chat_id, 'text': text,
+                             'parse_mode': parse_mode, 'created_at': now, 'attempts': 0})
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+        return rows
+
+    def start(self, bot: Bot) -> None:
+        """
+        Load messages left over from the last run and start the sender workers
+        """
+        self._bot = bot
+        self._queue = asyncio.Queue()
+        for row in self._conn.execute(
+            'SELECT id, chat_id, text, parse_mode, created_at, attempts FROM outbox ORDER BY id'
+        ):
+            self._queue.put_nowait({'id': row[0], 'chat_id': row[1], 'text': row[2],
+                                    'parse_mode': row[3], 'created_at': row[4], 'attempts': row[5]})
+        if self._queue.qsize():
+            logger.info(f"Resuming {self._queue.qsize()} queued outbound messages")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """
+        Stop the workers; unsent messages stay on disk for the next start
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _chat_limiter(self, chat_id: int) -> TokenBucket:
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self._chat_limiters[chat_id] = TokenBucket(self.chat_rate, 1)
+            if len(self._chat_limiters) > 10000:
+                self._chat_limiters.popitem(last=False)
+        else:
+            self._chat_limiters.move_to_end(chat_id)
+        return limiter
+
+    async def _worker(self) -> None:
+        while True:
+            message = await self._queue.get()
+            try:
+                await self._deliver(message)
+            except Exception as e:
+                logger.error(f"Outbound worker error for chat {message['chat_id']}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, message: Dict) -> None:
+        await self._chat_limiter(message['chat_id']).acquire()
+        await self.limiter.acquire()
+        try:
+            await self._bot.send_message(
+                chat_id=message['chat_id'],
+                text=message['text'],
+                parse_mode=message['parse_mode']
+            )
+        except RetryAfter as e:
+            # Flood limit: hold all sends, then try this message again
+            self.limiter.pause(e.retry_after)
+            self.retried += 1
+            self._queue.put_nowait(message)
+            return
+        except Forbidden:
+            # The user blocked the bot; retrying won't help
+            await self._finish(message, delivered=False)
+            for callback in self.blocked_callbacks:
+                await callback(message['chat_id'])
+            return
+        except BadRequest as e:
+            # BadRequest subclasses NetworkError, but resending won't fix it
+            logger.error(f"Could not send message to {message['chat_id']}: {e}")
+            await self._finish(message, delivered=False)
+            return
+        except (TimedOut, NetworkError) as e:
+            message['attempts'] += 1
+            if message['attempts'] < self.max_attempts:
+                self.retried += 1
+                await self._write(self._conn.execute, 'UPDATE outbox SET attempts = ? WHERE id = ?',
+                                  (message['attempts'], message['id']))
+                await asyncio.sleep(min(2 ** message['attempts'], 60))
+                self._queue.put_nowait(message)
+                return
+            logger.error(f"Giving up on message to {message['chat_id']}: {e}")
+            await self._finish(message, delivered=False)
+            return
+        except TelegramError as e:
+            logger.error(f"Could not send message to {message['chat_id']}: {e}")
+            await self._finish(message, delivered=False)
+            return
+
+        await self._finish(message, delivered=True)
+
+    async def _finish(self, message: Dict, delivered: bool) -> None:
+        await self._write(self._conn.execute, 'DELETE FROM outbox WHERE id = ?', (message['id'],))
+        if delivered:
+            latency = time.time() - message['created_at']
+            self.sent += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+        else:
+            self.failed += 1
+
+    def depth(self) -> int:
+        """
+        Number of messages waiting to be sent
+        """
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self) -> Dict:
+        """
+        Queue depth and delivery counters
+        """
+        return {
+            'depth': self.depth(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'avg_latency_s': round(self.latency_total / self.sent, 3) if self.sent else 0.0,
+            'max_latency_s': round(self.latency_max, 3),
+        }
+
+_outbox: Optional[OutboundQueue] = None
+
+def get_outbox() -> OutboundQueue:
+    """
+    Return the shared outbound queue, creating it on first use
+    """
+    global _outbox
+    if _outbox is None:
+        _outbox = OutboundQueue(OUTBOX_FILE, OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE,
+                                OUTBOX_WORKERS, OUTBOX_MAX_ATTEMPTS)
+    return _outbox
+
+# =====================================================
+# BROADCASTS - Resumable mass messaging
+# =====================================================
+
+class Broadcaster:
+    """
+    Sends one message to every user who hasn't blocked the bot
+    Recipient ids are streamed from storage in ascending order and sent in
+    batches, concurrently, under the global send limiter. The cursor is
+    checkpointed after every batch so a restart resumes from the last
+    finished batch. Users who blocked the bot are marked and skipped later
+    """
+
+    def __init__(self, state_path: str, limiter: TokenBucket, batch_size: int,
+                 concurrency: int, progress_interval: float):
+        self.state_path = state_path
+        self.limiter = limiter
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.state: Optional[Dict] = self._load_state()
+        self._task: Optional[asyncio.Task] = None
+        self._bot: Optional[Bot] = None
+        # Recipients per second in the current run, for the ETA
+        self.rate = 0.0
+
+    def _load_state(self) -> Optional[Dict]:
+        if not os.path.exists(self.state_path):
+            return None
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError as e:
+            logger.error(f"Ignoring unreadable broadcast checkpoint {self.state_path}: {e}")
+            return None
+
+    async def _save_state(self) -> None:
+        # Serialized here, so the state can't change mid-dump; written on a storage thread
+        await get_store().run(self._write_state, json.dumps(self.state, ensure_ascii=False))
+
+    def _write_state(self, data: str) -> None:
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.state_path)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, bot: Bot, text: str, parse_mode: Optional[str], admin_chat_id: int,
+                    status_message_id: Optional[int] = None) -> None:
+        """
+        Begin a new broadcast; progress is reported by editing status_message_id
+        """
+        storage = get_storage()
+        total = await get_store().run(storage.count_users)
+        self.state = {
+            'id': int(time.time()),
+            'text': text,
+            'parse_mode': parse_mode,
+            'admin_chat_id': admin_chat_id,
+            'status_message_id': status_message_id,
+            'cursor': 0,
+            'total': total,
+            'sent': 0,
+            'blocked': 0,
+            'failed': 0,
+            'started_at': time.time(),
+            'finished': False,
+        }
+        await self._save_state()
+        self.resume(bot)
+
+    def resume(self, bot: Bot) -> bool:
+        """
+        Continue an unfinished broadcast, e.g. after a restart
+        Returns True if one was resumed
+        """
+        if self.state is None or self.state['finished'] or self.running:
+            return False
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+        return True
+
+    async def stop(self) -> None:
+        """
+        Pause the running broadcast; the checkpoint is kept for resume()
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def cancel(self) -> bool:
+        """
+        Stop the current broadcast for good
+        Returns False if there was nothing to cancel
+        """
+        if self.state is None or self.state['finished']:
+            return False
+        await self.stop()
+        self.state['finished'] = True
+        await self._save_state()
+        return True
+
+    async def _run(self) -> None:
+        state = self.state
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # Some backends build the id list up front, so not on the event loop
+        recipients = await get_store().run(get_storage().iter_user_ids, state['cursor'])
+        next_batch = lambda: list(islice(recipients, self.batch_size))
+        run_started = time.monotonic()
+        run_processed = 0
+        last_report = run_started
+        self.rate = 0.0
+
+        if state['cursor']:
+            logger.info(f"Resuming broadcast {state['id']} after user {state['cursor']}")
+        try:
+            while True:
+                batch = await get_store().run(next_batch)
+                if not batch:
+                    break
+                outcomes = await asyncio.gather(*(self._send(chat_id, semaphore) for chat_id in batch))
+                # Counters move together with the cursor, so a batch cut short
+                # by a restart is neither lost nor counted twice
+                for outcome in outcomes:
+                    state[outcome] += 1
+                state['cursor'] = batch[-1]
+                run_processed += len(batch)
+                self.rate = run_processed / (time.monotonic() - run_started)
+                await self._save_state()
+
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    await self._report()
+        except asyncio.CancelledError:
+            await self._save_state()
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {state['id']} stopped: {e}")
+            await self._save_state()
+            return
+
+        state['finished'] = True
+        await self._save_state()
+        logger.info(f"Broadcast {state['id']} finished: {state['sent']} sent, "
+                    f"{state['blocked']} blocked, {state['failed']} failed")
+        await self._report()
+
+    async def _send(self, chat_id: int, semaphore: asyncio.Semaphore) -> str:
+        """
+        Deliver the broadcast to one user
+        Returns the counter it lands in: sent, blocked or failed
+        """
+        state = self.state
+        attempts = 0
+        async with semaphore:
+            while True:
+                await self.limiter.acquire()
+                try:
+                    await self._bot.send_message(chat_id=chat_id, text=state['text'],
+                                                 parse_mode=state['parse_mode'])
+                except RetryAfter as e:
+                    self.limiter.pause(e.retry_after)
+                    continue
+                except Forbidden:
+                    await get_store().run(run_user_op, chat_id, 'set_user_blocked', True)
+                    return 'blocked'
+                except BadRequest:
+                    return 'failed'
+                except (TimedOut, NetworkError):
+                    attempts += 1
+                    if attempts < 3:
+                        await asyncio.sleep(2 ** attempts)
+                        continue
+                    return 'failed'
+                except TelegramError:
+                    return 'failed'
+                return 'sent'
+
+    def progress_text(self) -> str:
+        """
+        Render the progress of the current (or last) broadcast
+        """
+        state = self.state
+        rate = self.rate if self.running else 0.0
+        processed = state['sent'] + state['blocked'] + state['failed']
+        total = max(state['total'], processed)
+        if state['finished']:
+            eta = 'done'
+        elif rate:
+            eta = str(timedelta(seconds=int((total - processed) / rate)))
+        else:
+            eta = 'unknown'
+        return render(
+            'broadcast_progress',
+            icon='✅' if state['finished'] else '📣',
+            status='finished' if state['finished'] else 'in progress',
+            processed=processed,
+            total=total,
+            percent=round(100 * processed / total, 1) if total else 100.0,
+            sent=state['sent'],
+            blocked=state['blocked'],
+            failed=state['failed'],
+            rate=round(rate, 1) if rate else '-',
+            eta=eta
+        )
+
+    async def _report(self) -> None:
+        """
+        Update the admin's status message
+        """
+        state = self.state
+        text = self.progress_text()
+        try:
+            if state['status_message_id'] is not None:
+                await self._bot.edit_message_text(text, chat_id=state['admin_chat_id'],
+                                                  message_id=state['status_message_id'])
+            else:
+                await self._bot.send_message(chat_id=state['admin_chat_id'], text=text)
+        except TelegramError as e:
+            logger.warning(f"Could not report broadcast progress: {e}")
+
+_broadcaster: Optional[Broadcaster] = None
+
+def get_broadcaster() -> Broadcaster:
+    """
+    Return the shared broadcaster, creating it on first use
+    Broadcasts share the outbound queue's global rate limit
+    """
+    global _broadcaster
+    if _broadcaster is None:
+        _broadcaster = Broadcaster(BROADCAST_STATE_FILE, get_outbox().limiter, BROADCAST_BATCH_SIZE,
+                                   BROADCAST_CONCURRENCY, BROADCAST_PROGRESS_INTERVAL)
+    return _broadcaster
+
+# =====================================================
+# RE-VERIFICATION - Background sweeps over completed tasks
+# =====================================================
+
+SWEEP_CHECKS = Counter('bot_sweep_checks_total', "Completed tasks re-verified by outcome", ('outcome',))
+METRICS.append(SWEEP_CHECKS)
+
+class MembershipSweeper:
+    """
+    Walks every completed task and checks the user is still in the chat
+    Completions are streamed from storage in (user_id, task_id) order and
+    checked in batches under their own rate limit and concurrency cap, on
+    top of the shared membership checker, so live verifications always
+    keep most of the getChatMember budget. The cursor is checkpointed after
+    every batch; a restart continues the current pass. Users who left lose
+    the reward (clawback) or are reported to the admin (flag)
+    """
+
+    def __init__(self, state_path: str, limiter: TokenBucket, interval: float, batch_size: int,
+                 concurrency: int, action: str):
+        self.state_path = state_path
+        self.limiter = limiter
+        self.interval = interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.action = action
+        self.state: Optional[Dict] = self._load_state()
+        self._task: Optional[asyncio.Task] = None
+        self._bot: Optional[Bot] = None
+
+    def _load_state(self) -> Optional[Dict]:
+        if not os.path.exists(self.state_path):
+            return None
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError as e:
+            logger.error(f"Ignoring unreadable sweep checkpoint {self.state_path}: {e}")
+            return None
+
+    async def _save_state(self) -> None:
+        # Serialized here, so the state can't change mid-dump; written on a storage thread
+        await get_store().run(self._write_state, json.dumps(self.state, ensure_ascii=False))
+
+    def _write_state(self, data: str) -> None:
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.state_path)
+
+    def start(self, bot: Bot) -> None:
+        """
+        Run passes in the background, continuing an unfinished one first
+        """
+        self._bot = bot
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        """
+        Pause the sweeper; the checkpoint is kept for the next start
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            if self.state is not None and self.state['finished']:
+                delay = self.state['finished_at'] + self.interval - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if self.state is None or self.state['finished']:
+                self.state = {
+                    'started_at': time.time(),
+                    'finished_at': None,
+                    'cursor': [0, ''],
+                    'checked': 0,
+                    'left': 0,
+                    'clawed_back': 0.0,
+                    'errors': 0,
+                    'flagged': [],
+                    'finished': False,
+                }
+                await self._save_state()
+            try:
+                await self._sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Re-verification pass stopped: {e}")
+                await asyncio.sleep(60)
+
+    async def _sweep(self) -> None:
+        state = self.state
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # Some backends scan their users before the first completion, so not on the event loop
+        completions = await get_store().run(get_storage().iter_completions, tuple(state['cursor']))
+        next_batch = lambda: list(islice(completions, self.batch_size))
+        if state['cursor'][0]:
+            logger.info(f"Resuming re-verification after user {state['cursor'][0]}")
+
+        while True:
+            batch = await get_store().run(next_batch)
+            if not batch:
+                break
+            results = await asyncio.gather(*(self._check(user_id, task_id, semaphore) for user_id, task_id in batch))
+            # Counters move together with the cursor, so a batch cut short
+            # by a restart is neither lost nor counted twice
+            for (user_id, task_id), (outcome, taken) in zip(batch, results):
+                SWEEP_CHECKS.inc(outcome)
+                if outcome == 'error':
+                    state['errors'] += 1
+                elif outcome != 'skipped':
+                    state['checked'] += 1
+                if outcome == 'left':
+                    state['left'] += 1
+                    state['clawed_back'] = round(state['clawed_back'] + (taken or 0), 2)
+                    if self.action != 'clawback' and len(state['flagged']) < 100:
+                        state['flagged'].append([user_id, task_id])
+            state['cursor'] = list(batch[-1])
+            await self._save_state()
+
+        state['finished'] = True
+        state['finished_at'] = time.time()
+        await self._save_state()
+        logger.info(f"Re-verification pass finished: {state['checked']} checked, {state['left']} left, "
+                    f"{state['clawed_back']} stars taken back, {state['errors']} errors")
+        await get_outbox().enqueue(ADMIN_ID, self.summary_text())
+
+    async def _check(self, user_id: int, task_id: str, semaphore: asyncio.Semaphore) -> tuple:
+        """
+        Re-verify one completion
+        Returns (outcome, stars taken back) with outcome one of member,
+        left, error or skipped
+        """
+        task = get_task_catalog().get(task_id)
+        # Other cluster workers sweep their own users
+        if task is None or (_cluster is not None and not _cluster.is_local(user_id)):
+            return 'skipped', None
+
+        async with semaphore:
+            await self.limiter.acquire()
+            try:
+                is_member = await get_membership_checker().is_member(self._bot, task['chat_id'], user_id)
+            except (TelegramError, asyncio.TimeoutError) as e:
+                # e.g. the bot lost access to the chat; try again next pass
+                logger.warning(f"Could not re-verify task {task_id} for user {user_id}: {e}")
+                return 'error', None
+        if is_member:
+            return 'member', None
+
+        if self.action != 'clawback':
+            logger.info(f"User {user_id} left task {task_id} after completing it")
+            return 'left', None
+
+        taken = await get_store().run(revoke_task, user_id, task_id, task['reward'])
+        if taken is not None:
+            await get_outbox().enqueue(
+                user_id,
+                render('task_revoked', name=escape_markdown(task['name']), amount=taken),
+                parse_mode='Markdown'
+            )
+        return 'left', taken
+
+    def summary_text(self) -> str:
+        """
+        Render the result of the last finished pass for the admin
+        """
+        state = self.state
+        text = render(
+            'sweep_summary',
+            checked=state['checked'],
+            left=state['left'],
+            clawed_back=state['clawed_back'],
+            errors=state['errors']
+        )
+        if state['flagged']:
+            text += render('sweep_flagged', pairs=', '.join(f"{user_id}/{task_id}" for user_id, task_id in state['flagged']))
+        return text
+
+    def stats(self) -> Dict:
+        """
+        Progress of the current (or last) pass
+        """
+        state = self.state or {}
+        return {
+            'running': self._task is not None and not self._task.done(),
+            'cursor': state.get('cursor'),
+            'checked': state.get('checked', 0),
+            'left': state.get('left', 0),
+            'clawed_back': state.get('clawed_back', 0.0),
+            'errors': state.get('errors', 0),
+            'finished': state.get('finished', False),
+        }
+
+_sweeper: Optional[MembershipSweeper] = None
+
+def get_sweeper() -> MembershipSweeper:
+    """
+    Return the shared re-verification sweeper, creating it on first use
+    """
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = MembershipSweeper(SWEEP_STATE_FILE, TokenBucket(SWEEP_RATE, max(1.0, SWEEP_RATE)),
+                                     SWEEP_INTERVAL, SWEEP_BATCH_SIZE, SWEEP_CONCURRENCY, SWEEP_ACTION)
+    return _sweeper
+
+# =====================================================
+# DAILY REMINDERS - Opt-in "your gift is ready" messages
+# =====================================================
+
+class ReminderSchedule:
+    """
+    Min-heap of (due time, user_id) for users waiting for a gift reminder
+    Rescheduling or cancelling leaves the old heap entry in place; stale
+    entries are skipped when they reach the top, so every operation is
+    O(log n) and a run only touches the users that are due
+    """
+
+    def __init__(self):
+        self._heap: List[tuple] = []
+        self._due: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, user_id: int, due: Optional[float]) -> None:
+        """
+        Remind user_id at unix time due, or never if due is None
+        """
+        with self._lock:
+            if due is None:
+                self._due.pop(user_id, None)
+                return
+            if self._due.get(user_id) == due:
+                return
+            self._due[user_id] = due
+            heapq.heappush(self._heap, (due, user_id))
+            # Don't let stale entries pile up when users keep rescheduling
+            if len(self._heap) > 2 * len(self._due) + 1024:
+                self._heap = [(due, user_id) for user_id, due in self._due.items()]
+                heapq.heapify(self._heap)
+
+    def pop_due(self, now: float, limit: int) -> List[int]:
+        """
+        Remove and return up to limit users whose reminder is due
+        """
+        due_users = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(due_users) < limit:
+                due, user_id = heapq.heappop(self._heap)
+                if self._due.get(user_id) == due:
+                    del self._due[user_id]
+                    due_users.append(user_id)
+        return due_users
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+def reminder_time(next_reminder: Optional[str]) -> Optional[float]:
+    """
+    Convert a stored next_reminder to a unix time
+    """
+    return datetime.fromisoformat(next_reminder).timestamp() if next_reminder else None
+
+_reminder_schedule: Optional[ReminderSchedule] = None
+
+def get_reminder_schedule() -> ReminderSchedule:
+    """
+    Return the reminder schedule, loading it from storage on first use
+    """
+    global _reminder_schedule
+    if _reminder_schedule is None:
+        schedule = ReminderSchedule()
+        get_user_cache().flush()
+        storage = get_storage()
+        with STORAGE_LATENCY.time(storage.name, 'iter_reminders'):
+            for user_id, next_reminder in storage.iter_reminders():
+                # In cluster mode each worker reminds its own users
+                if _cluster is None or _cluster.is_local(user_id):
+                    schedule.schedule(user_id, reminder_time(next_reminder))
+        logger.info(f"Loaded {len(schedule)} scheduled daily gift reminders")
+        _reminder_schedule = schedule
+    return _reminder_schedule
+
+def set_daily_reminder(user_id: int, enabled: bool) -> None:
+    """
+    Turn daily gift reminders on or off for user_id
+    When turned on during a cooldown, the current cooldown is scheduled too
+    """
+    now = datetime.now()
+
+    def apply(user_data: Dict) -> Optional[str]:
+        user_data['daily_reminder'] = enabled
+        user_data['next_reminder'] = None
+        last_claim = user_data.get('last_daily_reward')
+        if enabled and last_claim:
+            ready_at = datetime.fromisoformat(last_claim) + timedelta(hours=24)
+            if ready_at > now:
+                user_data['next_reminder'] = ready_at.isoformat()
+        return user_data['next_reminder']
+
+    next_reminder = mutate_user_data(user_id, apply)
+    get_reminder_schedule().schedule(user_id, reminder_time(next_reminder))
+
+async def send_daily_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job queue callback: queue reminders for every user whose gift is ready
+    They go out through the outbound queue, within its rate limits
+    """
+    now = datetime.now()
+    due_users = get_reminder_schedule().pop_due(now.timestamp(), REMINDER_BATCH_SIZE)
+    if not due_users:
+        return
+
+    def take_reminder(user_data: Dict) -> bool:
+        # The record is the source of truth; the heap entry may be outdated
+        next_reminder = user_data.get('next_reminder')
+        if not next_reminder or datetime.fromisoformat(next_reminder) > now:
+            return False
+        user_data['next_reminder'] = None
+        return bool(user_data.get('daily_reminder')) and not user_data.get('blocked')
+
+    text = render('daily_reminder')
+    # Users gone from storage (e.g. after a restore) just drop out of the heap
+    taken = await get_store().run(lambda: [user_id for user_id in due_users
+                                           if mutate_user_data(user_id, take_reminder, create=False)])
+    messages = [(user_id, text, 'Markdown') for user_id in taken]
+    if messages:
+        await get_outbox().enqueue_many(messages)
+    logger.info(f"Queued {len(messages)} daily gift reminders")
+
+# =====================================================
+# OFFLINE REPORTS - Streaming stats and exports
+# =====================================================
+
+# Columns written by `python bot.py export`, in order
+EXPORT_FIELDS = ('user_id', 'username', 'first_name', 'stars', 'join_date', 'last_daily_reward',
+                 'referred_by', 'blocked', 'daily_reminder', 'next_reminder', 'completed_tasks')
+
+class UserStats:
+    """
+    Running aggregates over a stream of user records
+    Memory grows with the number of tasks, not the number of users
+    """
+
+    def __init__(self, now: datetime):
+        self.now = now
+        self.users = 0
+        self.blocked = 0
+        self.stars = 0.0
+        self.with_balance = 0
+        self.max_stars = 0.0
+        self.referred = 0
+        self.reminders = 0
+        self.daily_active = 0
+        self.joined_week = 0
+        self.completions: Dict[str, int] = {}
+
+    def add(self, record: Dict) -> None:
+        """
+        Fold one user record into the totals
+        """
+        self.users += 1
+        self.blocked += bool(record.get('blocked'))
+        stars = record.get('stars', 0)
+        self.stars += stars
+        if stars > 0:
+            self.with_balance += 1
+            self.max_stars = max(self.max_stars, stars)
+        self.referred += record.get('referred_by') is not None
+        self.reminders += bool(record.get('daily_reminder'))
+        if self._within(record.get('last_daily_reward'), timedelta(days=1)):
+            self.daily_active += 1
+        if self._within(record.get('join_date'), timedelta(days=7)):
+            self.joined_week += 1
+        for task_id in record.get('completed_tasks', []):
+            self.completions[task_id] = self.completions.get(task_id, 0) + 1
+
+    def _within(self, iso: Optional[str], window: timedelta) -> bool:
+        return bool(iso) and self.now - datetime.fromisoformat(iso) <= window
+
+    def report(self, pending: tuple, tasks: Dict[str, str]) -> Dict:
+        """
+        Summary dict; tasks maps task ids to names for the completion rates
+        """
+        task_ids = list(tasks) + sorted(set(self.completions).difference(tasks))
+        return {
+            'users': self.users,
+            'blocked': self.blocked,
+            'stars_outstanding': round(self.stars, 2),
+            'users_with_balance': self.with_balance,
+            'max_balance': self.max_stars,
+            'referred_users': self.referred,
+            'reminders_enabled': self.reminders,
+            'daily_gift_last_24h': self.daily_active,
+            'joined_last_7d': self.joined_week,
+            'pending_withdrawals': pending[0],
+            'pending_withdrawal_stars': pending[1],
+            'tasks': [
+                {
+                    'id': task_id,
+                    'name': tasks.get(task_id, task_id),
+                    'completions': self.completions.get(task_id, 0),
+                    'rate': self.completions.get(task_id, 0) / self.users if self.users else 0.0
+                }
+                for task_id in task_ids
+            ]
+        }
+
+def export_row(record: Dict) -> Dict:
+    """
+    Project a user record onto EXPORT_FIELDS
+    """
+    row = {field: record.get(field) for field in EXPORT_FIELDS}
+    row['completed_tasks'] = list(record.get('completed_tasks', []))
+    return row
+
+# =====================================================
+# MESSAGE TEMPLATES - Precompiled bot texts
+# =====================================================
+
+class _KeepPlaceholders(dict):
+    """
+    format_map helper that leaves unknown {fields} untouched
+    """
+
+    def __missing__(self, key: str) -> str:
+        return '{' + key + '}'
+
+def compile_template(text: str) -> str:
+    """
+    Bake the reward constants into a template once
+    Per-user values stay as {placeholders} for render()
+    """
+    return text.format_map(_KeepPlaceholders(
+        DAILY_REWARD=DAILY_REWARD,
+        TASK_REWARD=TASK_REWARD,
+        REFERRAL_REWARD=REFERRAL_REWARD
+    ))
+
+TEMPLATES = {name: compile_template(text) for name, text in {
+    'welcome': (
+        "⭐️⭐️⭐️⭐️⭐️\n\n"
+        "🌟 **Welcome to Telegram Stars Bot!** 🌟\n\n"
+        "Hello, {first_name}! @{username}\n\n"
+        "🎯 **Start earning Telegram Stars now!**\n\n"
+        "💫 **How to earn:**\n"
+        "🎁 Daily gifts - {DAILY_REWARD} stars\n"
+        "📋 Complete tasks - {TASK_REWARD} stars each\n"
+        "👥 Refer friends - {REFERRAL_REWARD} stars per referral\n\n"
+        "🚀 Choose an option below to get started!"
+    ),
+    'referral_notification': (
+        "🎉 Great news! @{name} joined using your referral link!\n"
+        "💰 You earned {REFERRAL_REWARD} stars!"
+    ),
+    'help_command': (
+        "📖 **Bot Help Guide**\n\n"
+        "🌟 **Available Commands:**\n"
+        "/start - Start the bot\n"
+        "/help - Show this help message\n"
+        "/account - View your account details\n"
+        "/top - Top earners (/top referrals for top referrers)\n\n"
+        "💫 **How to Use:**\n\n"
+        "1️⃣ **Daily Gift**: Claim your daily reward every 24 hours\n"
+        "2️⃣ **Tasks**: Join channels/groups to earn stars\n"
+        "3️⃣ **Referral**: Share your link and earn from referrals\n"
+        "4️⃣ **Withdraw**: Request withdrawal when you have enough stars\n"
+        "5️⃣ **Account**: Check your balance and statistics\n\n"
+        "❓ **Need Support?** Contact admin for help!"
+    ),
+    'help': (
+        "📖 **Bot Help Guide**\n\n"
+        "🌟 **How to Use:**\n\n"
+        "1️⃣ **Daily Gift**: Claim your daily reward every 24 hours\n"
+        "2️⃣ **Tasks**: Join channels/groups to earn stars\n"
+        "3️⃣ **Referral**: Share your link and earn from referrals\n"
+        "4️⃣ **Withdraw**: Request withdrawal when you have enough stars\n"
+        "5️⃣ **Account**: Check your balance and statistics\n\n"
+        "❓ **Need Support?** Contact admin for help!"
+    ),
+    'main_menu': (
+        "⭐️ **Telegram Stars Bot** ⭐️\n\n"
+        "Hello, {first_name}!\n\n"
+        "🎯 Choose an option below:"
+    ),
+    'account': (
+        "👤 **Your Account Details**\n\n"
+        "💰 **Balance:** {stars} ⭐️ Stars\n"
+        "👥 **Referrals:** {referrals_count} users\n"
+        "✅ **Completed Tasks:** {completed_tasks}/{total_tasks}\n"
+        "📅 **Member Since:** {join_date}\n\n"
+        "🎯 **Total Earned:**\n"
+        "  • From referrals: {referral_earnings} ⭐️\n"
+        "  • From tasks: {task_earnings} ⭐️\n\n"
+        "💡 Keep earning stars and withdraw when ready!"
+    ),
+    'daily_claimed': (
+        "🎁 **Daily Gift Claimed!** 🎁\n\n"
+        "Congratulations! You received {DAILY_REWARD} ⭐️ stars!\n\n"
+        "💰 **New Balance:** {new_balance} ⭐️\n\n"
+        "⏰ Come back in 24 hours for your next gift!"
+    ),
+    'daily_reminder': (
+        "🎁 **Your daily gift is ready!** 🎁\n\n"
+        "Open the menu with /start and claim {DAILY_REWARD} ⭐️ stars!"
+    ),
+    'reminders_on': (
+        "🔔 **Reminders On** 🔔\n\n"
+        "I'll message you as soon as your next daily gift is ready."
+    ),
+    'reminders_off': (
+        "🔕 **Reminders Off** 🔕\n\n"
+        "You won't get daily gift reminders anymore."
+    ),
+    'daily_not_ready': (
+        "⏰ **Daily Gift Not Ready** ⏰\n\n"
+        "You already claimed your daily gift today!\n\n"
+        "⏳ **Time until next gift:** {time_left}\n\n"
+        "💡 Try completing tasks or referring friends meanwhile!"
+    ),
+    'tasks': (
+        "📋 **Available Tasks** 📋\n\n"
+        "Complete tasks to earn {TASK_REWARD} ⭐️ stars each!\n\n"
+        "✅ **Completed:** {completed}/{total} tasks\n\n"
+        "💡 Click on a task to complete it:"
+    ),
+    'task_details': (
+        "📋 **Task: {name}**\n\n"
+        "💰 **Reward:** {reward} ⭐️ stars\n\n"
+        "📝 **Instructions:**\n"
+        "1️⃣ Click 'Join Channel' button below\n"
+        "2️⃣ Join the channel/group\n"
+        "3️⃣ Click 'Verify' to check and get your reward\n\n"
+        "⚠️ Make sure you stay in the channel to receive your reward!"
+    ),
+    'task_completed': (
+        "✅ **Task Completed!** ✅\n\n"
+        "Congratulations! You earned {reward} ⭐️ stars!\n\n"
+        "💰 **New Balance:** {new_balance} ⭐️\n\n"
+        "🎯 Complete more tasks to earn more stars!"
+    ),
+    'referral': (
+        "👥 **Referral Program** 👥\n\n"
+        "💰 Earn {REFERRAL_REWARD} ⭐️ stars for each friend!\n\n"
+        "📊 **Your Statistics:**\n"
+        "  • Total Referrals: {referrals_count}\n"
+        "  • Their Referrals: {indirect_count}\n"
+        "  • Stars Earned: {total_earned} ⭐️\n\n"
+        "🔗 **Your Referral Link:**\n"
+        "`{referral_link}`\n\n"
+        "📱 **How it works:**\n"
+        "1️⃣ Share your link with friends\n"
+        "2️⃣ They join using your link\n"
+        "3️⃣ You get {REFERRAL_REWARD} ⭐️ stars instantly!\n\n"
+        "💡 The more friends you invite, the more you earn!"
+    ),
+    'withdraw_header': (
+        "💰 **Withdraw Your Stars** 💰\n\n"
+        "💎 **Your Balance:** {stars} ⭐️ stars\n\n"
+        "📋 **Available Amounts:**\n"
+    ),
+    'withdraw_amount_available': "  ✅ {amount} stars\n",
+    'withdraw_amount_short': "  ❌ {amount} stars (Need {missing} more)\n",
+    'withdraw_footer': (
+        "\n💡 **Note:** Withdrawal requests are reviewed by admin.\n"
+        "⏰ Processing time: 24-48 hours\n\n"
+        "👇 Select amount to withdraw:"
+    ),
+    'withdrawal_admin': (
+        "💰 **New Withdrawal Request** 💰\n\n"
+        "👤 **User Details:**\n"
+        "  • Name: {first_name}\n"
+        "  • Username: @{username}\n"
+        "  • User ID: `{user_id}`\n\n"
+        "💎 **Amount:** {amount} ⭐️ stars\n"
+        "📅 **Date:** {date}\n"
+        "🆔 **Request:** #{withdrawal_id}\n\n"
+        "⚠️ Please process this request.\n"
+        "✅ /approve {withdrawal_id}   ❌ /reject {withdrawal_id}"
+    ),
+    'withdrawal_submitted': (
+        "✅ **Withdrawal Request Submitted!** ✅\n\n"
+        "💎 **Amount:** {amount} ⭐️ stars\n"
+        "💰 **New Balance:** {new_balance} ⭐️\n\n"
+        "📝 **Your request has been sent to admin.**\n"
+        "⏰ Processing time: 24-48 hours\n\n"
+        "💡 You will be notified once processed!"
+    ),
+    'withdrawal_approved': (
+        "✅ **Withdrawal Approved!** ✅\n\n"
+        "💎 **Amount:** {amount} ⭐️ stars\n"
+        "🆔 **Request:** #{id}\n\n"
+        "🎉 Your stars are on the way!"
+    ),
+    'withdrawal_rejected': (
+        "❌ **Withdrawal Rejected** ❌\n\n"
+        "💎 **Amount:** {amount} ⭐️ stars\n"
+        "🆔 **Request:** #{id}\n\n"
+        "💰 The stars were returned to your balance.\n"
+        "❓ Contact admin for details."
+    ),
+    'withdrawals_header': (
+        "💰 **Pending Withdrawals** 💰\n\n"
+        "📋 **Requests:** {count}\n"
+        "💎 **Total:** {total} ⭐️ stars\n"
+        "📄 **Page:** {page}/{pages}\n\n"
+    ),
+    'withdrawals_item': "#{id} • `{user_id}` • {amount} ⭐️ • {date}\n",
+    'withdrawals_next': "\n➡️ Next page: /withdrawals {next_page}\n",
+    'withdrawals_footer': (
+        "\n✅ /approve 12 15 20-30 or /approve all\n"
+        "❌ /reject 12 15 20-30 or /reject all"
+    ),
+    'withdrawals_empty': "✅ No pending withdrawal requests.",
+    'broadcast_progress': (
+        "{icon} Broadcast {status}\n\n"
+        "📨 Processed: {processed}/{total} ({percent}%)\n"
+        "✅ Sent: {sent}\n"
+        "🚫 Blocked: {blocked}\n"
+        "⚠️ Failed: {failed}\n"
+        "⚡️ Rate: {rate}/s\n"
+        "⏳ ETA: {eta}"
+    ),
+    'broadcast_usage': (
+        "📣 Broadcast commands:\n\n"
+        "/broadcast <text> - Send text (Markdown) to every user\n"
+        "/broadcast status - Show progress\n"
+        "/broadcast resume - Continue a stopped broadcast\n"
+        "/broadcast cancel - Stop the broadcast for good"
+    ),
+    'broadcast_busy': (
+        "⚠️ Another broadcast is not finished yet.\n"
+        "Use /broadcast status, /broadcast resume or /broadcast cancel."
+    ),
+    'broadcast_invalid': "❌ Telegram rejected the message, nothing was sent: {error}",
+    'broadcast_starting': "📣 Broadcast starting...",
+    'broadcast_none': "ℹ️ There is no broadcast to {action}.",
+    'broadcast_cancelled': "🛑 Broadcast cancelled.",
+    'top_header': "🏆 **Top {title}** 🏆\n\n",
+    'top_item': "{place} {name} — {score} {unit}\n",
+    'top_empty': "Nobody is ranked yet. Be the first!\n",
+    'top_footer': (
+        "\n📍 **Your rank:** #{rank} with {score} {unit}\n\n"
+        "💡 /top stars • /top referrals"
+    ),
+    'task_revoked': (
+        "⚠️ **Task Reward Removed** ⚠️\n\n"
+        "You left **{name}**, so the {amount} ⭐️ stars for it were taken back.\n\n"
+        "💡 Join again and verify the task to earn them back!"
+    ),
+    'sweep_summary': (
+        "🔁 Re-verification pass finished\n\n"
+        "✅ Checked: {checked}\n"
+        "🚪 Left: {left}\n"
+        "💸 Taken back: {clawed_back} ⭐️\n"
+        "⚠️ Errors: {errors}"
+    ),
+    'sweep_flagged': "\n\n🚩 Left after completing (user/task): {pairs}",
+    'task_stats_header': "📋 **Task Statistics** 📋\n\n",
+    'task_stats_item': (
+        "{icon} **{name}** (`{id}`)\n"
+        "  • Completed: {completions}/{cap}\n"
+        "  • Since restart: {opened} opened → {verified} verified → {completed} completed ({conversion}%)\n\n"
+    ),
+    'task_stats_empty': "No tasks in the catalog.",
+    'slow_down': "⏳ Too many taps, please wait a moment.",
+    'withdrawals_settled': (
+        "{icon} **{count} withdrawal requests {status}**\n"
+        "💎 **Total:** {total} ⭐️ stars\n"
+        "⏭ **Skipped (not pending):** {skipped}"
+    ),
+}.items()}
+
+def render(template_name: str, /, **values) -> str:
+    """
+    Fill a precompiled template with per-user values
+    """
+    template = TEMPLATES[template_name]
+    return template.format(**values) if values else template
+
+# =====================================================
+# KEYBOARD LAYOUTS - Main menu and navigation
+# =====================================================
+
+@lru_cache(maxsize=None)
+def get_main_menu_keyboard() -> InlineKeyboardMarkup:
+    """
+    Generate main menu keyboard with all options
+    Built once and reused for every update
+    """
+    keyboard = [
+        [InlineKeyboardButton("⭐️ My Account", callback_data='account')],
+        [InlineKeyboardButton("🎁 Daily Gift", callback_data='daily_gift')],
+        [InlineKeyboardButton("📋 Tasks", callback_data='tasks')],
+        [InlineKeyboardButton("👥 Referral", callback_data='referral')],
+        [InlineKeyboardButton("💰 Withdraw", callback_data='withdraw')],
+        [InlineKeyboardButton("ℹ️ Help", callback_data='help')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+@lru_cache(maxsize=None)
+def get_back_keyboard() -> InlineKeyboardMarkup:
+    """
+    Generate back button keyboard
+    Built once and reused for every update
+    """
+    keyboard = [[InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]]
+    return InlineKeyboardMarkup(keyboard)
+
+def get_tasks_keyboard(completed_tasks: Iterable[str]) -> InlineKeyboardMarkup:
+    """
+    Generate tasks keyboard with completion status
+    Keyboards are memoized by catalog version and the set of completed tasks
+    """
+    catalog = get_task_catalog()
+    completed = set(completed_tasks)
+    return build_tasks_keyboard(catalog.version, frozenset(task['id'] for task in catalog.listed() if task['id'] in completed))
+
+@lru_cache(maxsize=256)
+def build_tasks_keyboard(version: int, completed_tasks: frozenset) -> InlineKeyboardMarkup:
+    """
+    Build the tasks keyboard for one catalog version and completion state
+    """
+    keyboard = []
+    for task in get_task_catalog().listed():
+        if task['id'] in completed_tasks:
+            status = "✅"
+        else:
+            status = "❌"
+        
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{status} {task['name']}",
+                callback_data=f"task_{task['id']}"
+            )
+        ])
+    
+    keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')])
+    return InlineKeyboardMarkup(keyboard)
+
+@lru_cache(maxsize=None)
+def get_daily_gift_keyboard(reminders: bool) -> InlineKeyboardMarkup:
+    """
+    Back button plus a toggle for daily gift reminders
+    """
+    if reminders:
+        toggle = InlineKeyboardButton("🔕 Stop Reminders", callback_data='reminders_off')
+    else:
+        toggle = InlineKeyboardButton("🔔 Remind Me When Ready", callback_data='reminders_on')
+    keyboard = [
+        [toggle],
+        [InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+@lru_cache(maxsize=None)
+def get_withdrawal_keyboard() -> InlineKeyboardMarkup:
+    """
+    Generate withdrawal amounts keyboard
+    Built once and reused for every update
+    """
+    keyboard = []
+    for amount in WITHDRAWAL_AMOUNTS:
+        keyboard.append([
+            InlineKeyboardButton(
+                f"💎 {amount} Stars",
+                callback_data=f"withdraw_{amount}"
+            )
+        ])
+    
+    keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data='main_menu')])
+    return InlineKeyboardMarkup(keyboard)
+
+@lru_cache(maxsize=256)
+def get_task_keyboard(task_id: str, link: str) -> InlineKeyboardMarkup:
+    """
+    Generate join/verify keyboard for a single task
+    """
+    keyboard = [
+        [InlineKeyboardButton("🔗 Join Channel", url=link)],
+        [InlineKeyboardButton("✅ Verify", callback_data=f"verify_{task_id}")],
+        [InlineKeyboardButton("🔙 Back to Tasks", callback_data='tasks')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# =====================================================
+# MESSAGE EDITS - Skip edits that would change nothing
+# =====================================================
+
+MESSAGE_EDITS = Counter('bot_message_edits_total', "Message edits by outcome", ('outcome',))
+METRICS.append(MESSAGE_EDITS)
+
+def message_digest(text: str, reply_markup: Optional[InlineKeyboardMarkup], parse_mode: Optional[str]) -> bytes:
+    """
+    Short hash of everything an edit would put on screen
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(text.encode('utf-8'))
+    digest.update(b'\0' + (parse_mode or '').encode('ascii'))
+    if reply_markup is not None:
+        digest.update(b'\0' + reply_markup.to_json().encode('utf-8'))
+    return digest.digest()
+
+class MessageStates:
+    """
+    What each bot message currently shows, as a digest per (chat_id, message_id)
+    Only messages edited through edit_message are known; a bounded LRU,
+    so old menus fall out and simply get edited again
+    """
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self._digests: OrderedDict = OrderedDict()
+        self.sent = 0
+        self.skipped = 0
+        self.not_modified = 0
+
+    def shows(self, key: tuple, digest: bytes) -> bool:
+        """
+        True if the message is known to show digest already
+        """
+        if self._digests.get(key) != digest:
+            return False
+        self._digests.move_to_end(key)
+        return True
+
+    def remember(self, key: tuple, digest: bytes) -> None:
+        if self.max_messages <= 0:
+            return
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        if len(self._digests) > self.max_messages:
+            self._digests.popitem(last=False)
+
+    def forget(self, key: tuple) -> None:
+        self._digests.pop(key, None)
+
+    def stats(self) -> Dict:
+        """
+        Counters for /botstats
+        """
+        return {
+            'sent': self.sent,
+            'skipped': self.skipped,
+            'not_modified': self.not_modified,
+            'tracked_messages': len(self._digests)
+        }
+
+_message_states: Optional[MessageStates] = None
+
+def get_message_states() -> MessageStates:
+    """
+    Return the shared message state cache, creating it on first use
+    """
+    global _message_states
+    if _message_states is None:
+        _message_states = MessageStates(MESSAGE_STATE_SIZE)
+    return _message_states
+
+async def edit_message(query: CallbackQuery, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None,
+                       parse_mode: Optional[str] = 'Markdown') -> bool:
+    """
+    Edit the message behind a button press, unless it already shows exactly
+    this text and keyboard. Returns True if Telegram was called
+    Callers answer the query themselves, so a skipped edit costs no API call
+    """
+    message = query.message
+    if message is None:
+        # Inline-mode messages carry no chat/message id to key on
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        return True
+
+    states = get_message_states()
+    key = (message.chat_id, message.message_id)
+    digest = message_digest(text, reply_markup, parse_mode)
+    if states.shows(key, digest):
+        states.skipped += 1
+        MESSAGE_EDITS.inc('skipped')
+        return False
+
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if 'message is not modified' not in str(e).lower():
+            states.forget(key)
+            raise
+        # Shown already, e.g. edited before this process started
+        states.not_modified += 1
+        MESSAGE_EDITS.inc('not_modified')
+        states.remember(key, digest)
+        return True
+    except Exception:
+        # The edit may or may not have landed, so the old digest can't be trusted
+        states.forget(key)
+        raise
+    states.sent += 1
+    MESSAGE_EDITS.inc('sent')
+    states.remember(key, digest)
+    return True
+
+# =====================================================
+# COMMAND HANDLERS - Bot commands
+# =====================================================
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle /start command
+    Process referral links and welcome new users
+    """
+    user = update.effective_user
+    user_id = user.id
+    
+    # Update user info
+    def update_profile(user_data: Dict) -> None:
+        user_data['username'] = user.username
+        user_data['first_name'] = user.first_name
+        # Talking to the bot again means they unblocked it
+        user_data['blocked'] = False
+
+    store = get_store()
+    await store.update_user(user_id, update_profile)
+    
+    # Check for referral parameter
+    if context.args and len(context.args) > 0:
+        referrer_id = context.args[0]
+        try:
+            referrer_id = int(referrer_id)
+            
+            # Check if user hasn't been referred before and not self-referral
+            if await store.run(claim_referral, user_id, referrer_id):
+                # Notify referrer
+                await get_outbox().enqueue(
+                    referrer_id,
+                    render('referral_notification', name=user.username or user.first_name)
+                )
+        except ValueError:
+            pass
+    
+    # Welcome message with large star emoji
+    welcome_text = render('welcome', first_name=user.first_name, username=user.username or 'User')
+    
+    await update.message.reply_text(
+        welcome_text,
+        reply_markup=get_main_menu_keyboard(),
+        parse_mode='Markdown'
+    )
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle /help command
+    """
+    help_text = render('help_command')
+    
+    await update.message.reply_text(
+        help_text,
+        reply_markup=get_back_keyboard(),
+        parse_mode='Markdown'
+    )
+
+async def account_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle /account command
+    """
+    user_id = update.effective_user.id
+    await show_account(update, context, user_id)
+
+TOP_BOARDS = {
+    # board: (title, unit)
+    'stars': ("Earners", "⭐️"),
+    'referrals': ("Referrers", "referrals"),
+}
+TOP_MEDALS = ("🥇", "🥈", "🥉")
+
+def leaderboard_name(user_id: int) -> str:
+    """
+    Markdown-safe display name of a ranked user
+    """
+    if _cluster is None or _cluster.is_local(user_id):
+        record = get_user_cache().get(user_id)
+    else:
+        # Owned by another worker; read its stored profile without caching it here
+        record = get_storage().get_user(user_id)
+    if record and record.get('username'):
+        name = '@' + record['username']
+    elif record and record.get('first_name'):
+        name = record['first_name']
+    else:
+        name = f"User {user_id}"
+    return escape_markdown(name)
+
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle /top [stars|referrals]
+    Shows the best users and the caller's own rank
+    """
+    user_id = update.effective_user.id
+    board = context.args[0].lower() if context.args else 'stars'
+    if board not in TOP_BOARDS:
+        board = 'stars'
+    title, unit = TOP_BOARDS[board]
+
+    leaderboard = get_leaderboard()
+    parts = [render('top_header', title=title)]
+    top = leaderboard.top(board, LEADERBOARD_SIZE)
+    names = await get_store().run(lambda: [leaderboard_name(ranked_id) for ranked_id, _ in top])
+    for place, ((ranked_id, score), name) in enumerate(zip(top, names), 1):
+        medal = TOP_MEDALS[place - 1] if place <= len(TOP_MEDALS) else f"{place}."
+        parts.append(render('top_item', place=medal, name=name, score=score, unit=unit))
+    if not top:
+        parts.append(render('top_empty'))
+    rank, score = leaderboard.rank(board, user_id)
+    parts.append(render('top_footer', rank=rank, score=score, unit=unit))
+
+    await update.message.reply_text(
+        ''.join(parts),
+        reply_markup=get_back_keyboard(),
+        parse_mode='Markdown'
+    )
+
+async def task_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle /taskstats command (admin only)
+    Shows completions per task and how many task screens led to a completion
+    """
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    stats = get_task_catalog().stats()
+    if not stats:
+        await update.message.reply_text(render('task_stats_empty'))
+        return
+
+    parts = [render('task_stats_header')]
+    for task in stats:
+        conversion = round(100 * task['completed'] / task['opened'], 1) if task['opened'] else 0
+        parts.append(render(
+            'task_stats_item',
+            icon='🟢' if task['available'] else '⚪️',
+            name=escape_markdown(task['name']),
+            id=task['id'],
+            completions=task['completions'],
+            cap=task['max_completions'] if task['max_completions'] is not None else '∞',
+            opened=task['opened'],
+            verified=task['verified'],
+            completed=task['completed'],
+            conversion=conversion
+        ))
+    await update.message.reply_text(''.join(parts), parse_mode='Markdown')
+
+async def bot_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle /botstats command (admin only)
+    Shows cache and queue counters
+    """
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    sections = [
+        ("🗃 User cache", get_user_cache().stats()),
+        ("📡 Membership checks", get_membership_checker().stats()),
+        ("📤 Outbound queue", get_outbox().stats()),
+        ("🔁 Re-verification", get_sweeper().stats()),
+        ("🚦 Button presses", get_callback_throttle().stats()),
+        ("💾 Storage threads", get_store().stats()),
+        ("✏️ Message edits", get_message_states().stats()),
+        ("🗄 Snapshots", get_snapshots().stats()),
+    ]
+    text = "\n\n".join(
+        title + "\n" + "\n".join(f"{key}: {value}" for key, value in stats.items())
+        for title, stats in sections
+    )
+    await update.message.reply_text(text)
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle /broadcast command (admin only)
+    /broadcast <text> sends text to every user; status, resume and cancel
+    manage the current broadcast
+    """
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    broadcaster = get_broadcaster()
+    parts = (update.message.text or '').split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ''
+    action = text.lower()
+
+    if not text:
+        await update.message.reply_text(render('broadcast_usage'))
+        return
+
+    if action == 'status':
+        if broadcaster.state is None:
+            await update.message.reply_text(render('broadcast_none', action='show'))
+        else:
+            await update.message.reply_text(broadcaster.progress_text())
+        return
+
+    if action == 'resume':
+        if not (broadcaster.running or broadcaster.resume(context.bot)):
+            await update.message.reply_text(render('broadcast_none', action='resume'))
+        else:
+            await update.message.reply_text(broadcaster.progress_text())
+        return
+
+    if action == 'cancel':
+        if await broadcaster.cancel():
+            await update.message.reply_text(render('broadcast_cancelled'))
+        else:
+            await update.message.reply_text(render('broadcast_none', action='cancel'))
+        return
+
+    if broadcaster.state is not None and not broadcaster.state['finished']:
+        await update.message.reply_text(render('broadcast_busy'))
+        return
+
+    # Send the admin a preview first so a Markdown error doesn't fail for every user
+    try:
+        await update.message.reply_text(text, parse_mode='Markdown')
+    except BadRequest as e:
+        await update.message.reply_text(render('broadcast_invalid', error=e.message))
+        return
+
+    status = await update.message.reply_text(render('broadcast_starting'))
+    await broadcaster.start(context.bot, text, 'Markdown', update.effective_chat.id, status.message_id)
+    logger.info(f"Admin started broadcast {broadcaster.state['id']} to {broadcaster.state['total']} users")
+
+def parse_withdrawal_ids(args: List[str]) -> Optional[List[int]]:
+    """
+    Parse "/approve 12 15 20-30" style arguments into withdrawal ids
+    Returns None for "all"; raises ValueError on anything else
+    """
+    if [arg.lower() for arg in args] == ['all']:
+        return None
+    ids = []
+    for arg in args:
+        first, _, last = arg.partition('-')
+        if last:
+            if int(last) - int(first) > 100000:
+                raise ValueError(f"range {arg} is too large")
+            ids.extend(range(int(first), int(last) + 1))
+        else:
+            ids.append(int(first))
+    if not ids:
+        raise ValueError("no withdrawal ids given")
+    return ids
+
+async def withdrawals_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle /withdrawals [page] command (admin only)
+    Lists pending withdrawal requests, oldest first
+    """
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    try:
+        page = max(1, int(context.args[0])) if context.args else 1
+    except ValueError:
+        page = 1
+
+    def load_page(page: int) -> tuple:
+        storage = get_storage()
+        with STORAGE_LATENCY.time(storage.name, 'withdrawal_totals'):
+            count, total = storage.withdrawal_totals('pending')
+        pages = (count + WITHDRAWALS_PAGE_SIZE - 1) // WITHDRAWALS_PAGE_SIZE
+        page = min(page, pages)
+        withdrawals = []
+        if count:
+            with STORAGE_LATENCY.time(storage.name, 'get_withdrawals'):
+                withdrawals = storage.get_withdrawals('pending', (page - 1) * WITHDRAWALS_PAGE_SIZE,
+                                                      WITHDRAWALS_PAGE_SIZE)
+        return count, total, page, pages, withdrawals
+
+    count, total, page, pages, withdrawals = await get_store().run(load_page, page)
+    if not count:
+        await update.message.reply_text(render('withdrawals_empty'))
+        return
+
+    text = render('withdrawals_header', count=count, total=round(total, 2), page=page, pages=pages)
+    for withdrawal in withdrawals:
+        text += render(
+            'withdrawals_item',
+            id=withdrawal['id'],
+            user_id=withdrawal['user_id'],
+            amount=withdrawal['amount'],
+            date=withdrawal['date'][:16].replace('T', ' ')
+        )
+    if page < pages:
+        text += render('withdrawals_next', next_page=page + 1)
+    text += render('withdrawals_footer')
+
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def settle_withdrawals_command(update: Update, context: ContextTypes.DEFAULT_TYPE, status: str) -> None:
+    """
+    Approve or reject the withdrawal requests named in the command arguments
+    Users are notified in one outbox batch
+    """
+    if update.effective_user.id != ADMIN_ID:
+        return
+
+    command = 'approve' if status == 'approved' else 'reject'
+    try:
+        ids = parse_withdrawal_ids(context.args or [])
+    except ValueError:
+        await update.message.reply_text(f"Usage: /{command} 12 15 20-30 or /{command} all")
+        return
+
+    settled = await get_store().run(settle_withdrawals, ids, status)
+
+    template = 'withdrawal_approved' if status == 'approved' else 'withdrawal_rejected'
+    await get_outbox().enqueue_many(
+        (withdrawal['user_id'], render(template, id=withdrawal['id'], amount=withdrawal['amount']), 'Markdown')
+        for withdrawal in settled
+    )
+    logger.info(f"Admin {status} {len(settled)} withdrawal requests")
+
+    await update.message.reply_text(
+        render(
+            'withdrawals_settled',
+            icon='✅' if status == 'approved' else '❌',
+            count=len(settled),
+            status=status,
+            total=round(sum(withdrawal['amount'] for withdrawal in settled), 2),
+            skipped=len(set(ids)) - len(settled) if ids is not None else 0
+        ),
+        parse_mode='Markdown'
+    )
+
+async def approve_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle /approve command (admin only)
+    """
+    await settle_withdrawals_command(update, context, 'approved')
+
+async def reject_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle /reject command (admin only)
+    Rejected amounts are refunded
+    """
+    await settle_withdrawals_command(update, context, 'rejected')
+
+# =====================================================
+# CALLBACK HANDLERS - Button interactions
+# =====================================================
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle all button callbacks
+    Routes to appropriate handler based on callback data
+    """
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    data = query.data
+    
     # Route to appropriate handler
     if data == 'main_menu':
         await show_main_menu(update, context)
@@ -338,10 +5056,13 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await show_account(update, context, user_id)
     elif data == 'daily_gift':
         await claim_daily_gift(update, context, user_id)
+    elif data in ('reminders_on', 'reminders_off'):
+        await toggle_daily_reminder(update, context, user_id, data == 'reminders_on')
     elif data == 'tasks':
         await show_tasks(update, context, user_id)
     elif data.startswith('task_'):
-        task_id = data.replace('task_', '')
+        # Task ids may themselves start with task_, so only strip the prefix once
+        task_id = data[len('task_'):]
         await handle_task(update, context, user_id, task_id)
     elif data == 'referral':
         await show_referral(update, context, user_id)
@@ -351,20 +5072,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         amount = int(data.replace('withdraw_', ''))
         await process_withdrawal(update, context, user_id, amount)
     elif data == 'help':
-        help_text = (
-            "📖 **Bot Help Guide**\n\n"
-            "🌟 **How to Use:**\n\n"
-            "1️⃣ **Daily Gift**: Claim your daily reward every 24 hours\n"
-            "2️⃣ **Tasks**: Join channels/groups to earn stars\n"
-            "3️⃣ **Referral**: Share your link and earn from referrals\n"
-            "4️⃣ **Withdraw**: Request withdrawal when you have enough stars\n"
-            "5️⃣ **Account**: Check your balance and statistics\n\n"
-            "❓ **Need Support?** Contact admin for help!"
-        )
-        await query.edit_message_text(
+        help_text = render('help')
+        await edit_message(
+            query,
             help_text,
-            reply_markup=get_back_keyboard(),
-            parse_mode='Markdown'
+            reply_markup=get_back_keyboard()
         )
 
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -374,16 +5086,12 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     user = update.effective_user
     
-    menu_text = (
-        f"⭐️ **Telegram Stars Bot** ⭐️\n\n"
-        f"Hello, {user.first_name}!\n\n"
-        f"🎯 Choose an option below:"
-    )
+    menu_text = render('main_menu', first_name=user.first_name)
     
-    await query.edit_message_text(
+    await edit_message(
+        query,
         menu_text,
-        reply_markup=get_main_menu_keyboard(),
-        parse_mode='Markdown'
+        reply_markup=get_main_menu_keyboard()
     )
 
 async def show_account(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
@@ -391,30 +5099,31 @@ async def show_account(update: Update, context: ContextTypes.DEFAULT_TYPE, user_
     Display user account details
     Shows stars balance and referral count
     """
-    user_data = get_user_data(user_id)
+    user_data = await get_store().get_user(user_id)
     
     stars = user_data['stars']
-    referrals_count = len(user_data['referrals'])
+    referrals_count = get_referral_index().count(user_id)
     completed_tasks = len(user_data['completed_tasks'])
+    # Retired tasks still count as completed, so never show more done than total
+    total_tasks = max(len(get_task_catalog().listed()), completed_tasks)
     join_date = datetime.fromisoformat(user_data['join_date']).strftime('%Y-%m-%d')
     
-    account_text = (
-        f"👤 **Your Account Details**\n\n"
-        f"💰 **Balance:** {stars} ⭐️ Stars\n"
-        f"👥 **Referrals:** {referrals_count} users\n"
-        f"✅ **Completed Tasks:** {completed_tasks}/{len(TASKS)}\n"
-        f"📅 **Member Since:** {join_date}\n\n"
-        f"🎯 **Total Earned:**\n"
-        f"  • From referrals: {referrals_count * REFERRAL_REWARD} ⭐️\n"
-        f"  • From tasks: {completed_tasks * TASK_REWARD} ⭐️\n\n"
-        f"💡 Keep earning stars and withdraw when ready!"
+    account_text = render(
+        'account',
+        stars=stars,
+        referrals_count=referrals_count,
+        completed_tasks=completed_tasks,
+        total_tasks=total_tasks,
+        join_date=join_date,
+        referral_earnings=referrals_count * REFERRAL_REWARD,
+        task_earnings=completed_tasks * TASK_REWARD
     )
     
     if update.callback_query:
-        await update.callback_query.edit_message_text(
+        await edit_message(
+            update.callback_query,
             account_text,
-            reply_markup=get_back_keyboard(),
-            parse_mode='Markdown'
+            reply_markup=get_back_keyboard()
         )
     else:
         await update.message.reply_text(
@@ -429,50 +5138,58 @@ async def claim_daily_gift(update: Update, context: ContextTypes.DEFAULT_TYPE, u
     Check 24-hour cooldown
     """
     query = update.callback_query
-    user_data = get_user_data(user_id)
-    
-    last_claim = user_data.get('last_daily_reward')
     now = datetime.now()
     
-    # Check if user can claim
-    can_claim = True
-    time_left = ""
-    
-    if last_claim:
-        last_claim_dt = datetime.fromisoformat(last_claim)
-        time_diff = now - last_claim_dt
+    # Check cooldown and grant the reward in one atomic step
+    def claim(user_data: Dict):
+        reminders = bool(user_data.get('daily_reminder'))
+        last_claim = user_data.get('last_daily_reward')
+        if last_claim:
+            time_diff = now - datetime.fromisoformat(last_claim)
+            if time_diff < timedelta(hours=24):
+                return False, timedelta(hours=24) - time_diff, reminders
         
-        if time_diff < timedelta(hours=24):
-            can_claim = False
-            time_left_td = timedelta(hours=24) - time_diff
-            hours = time_left_td.seconds // 3600
-            minutes = (time_left_td.seconds % 3600) // 60
-            time_left = f"{hours}h {minutes}m"
+        user_data['last_daily_reward'] = now.isoformat()
+        user_data['stars'] = round(user_data['stars'] + DAILY_REWARD, 2)
+        if reminders:
+            user_data['next_reminder'] = (now + timedelta(hours=24)).isoformat()
+        return True, user_data['stars'], reminders
+    
+    can_claim, result, reminders = await get_store().update_user(user_id, claim)
     
     if can_claim:
-        # Give reward
-        user_data['last_daily_reward'] = now.isoformat()
-        add_stars(user_id, DAILY_REWARD, "Daily gift")
-        update_user_data(user_id, user_data)
-        
-        message = (
-            f"🎁 **Daily Gift Claimed!** 🎁\n\n"
-            f"Congratulations! You received {DAILY_REWARD} ⭐️ stars!\n\n"
-            f"💰 **New Balance:** {user_data['stars']} ⭐️\n\n"
-            f"⏰ Come back in 24 hours for your next gift!"
-        )
+        new_balance = result
+        logger.info(f"Added {DAILY_REWARD} stars to user {user_id}. Reason: Daily gift")
+        if reminders:
+            get_reminder_schedule().schedule(user_id, (now + timedelta(hours=24)).timestamp())
     else:
-        message = (
-            f"⏰ **Daily Gift Not Ready** ⏰\n\n"
-            f"You already claimed your daily gift today!\n\n"
-            f"⏳ **Time until next gift:** {time_left}\n\n"
-            f"💡 Try completing tasks or referring friends meanwhile!"
-        )
+        time_left_td = result
+        hours = time_left_td.seconds // 3600
+        minutes = (time_left_td.seconds % 3600) // 60
+        time_left = f"{hours}h {minutes}m"
+    
+    if can_claim:
+        message = render('daily_claimed', new_balance=new_balance)
+    else:
+        message = render('daily_not_ready', time_left=time_left)
     
-    await query.edit_message_text(
+    await edit_message(
+        query,
         message,
-        reply_markup=get_back_keyboard(),
-        parse_mode='Markdown'
+        reply_markup=get_daily_gift_keyboard(reminders)
+    )
+
+async def toggle_daily_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, enabled: bool) -> None:
+    """
+    Handle the remind me / stop reminders buttons
+    """
+    query = update.callback_query
+    await get_store().run(set_daily_reminder, user_id, enabled)
+
+    await edit_message(
+        query,
+        render('reminders_on' if enabled else 'reminders_off'),
+        reply_markup=get_daily_gift_keyboard(enabled)
     )
 
 async def show_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
@@ -480,22 +5197,18 @@ async def show_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id
     Display available tasks
     """
     query = update.callback_query
-    user_data = get_user_data(user_id)
+    user_data = await get_store().get_user(user_id)
     
-    completed = len(user_data['completed_tasks'])
-    total = len(TASKS)
+    listed = get_task_catalog().listed()
+    completed = sum(1 for task in listed if task['id'] in user_data['completed_tasks'])
+    total = len(listed)
     
-    tasks_text = (
-        f"📋 **Available Tasks** 📋\n\n"
-        f"Complete tasks to earn {TASK_REWARD} ⭐️ stars each!\n\n"
-        f"✅ **Completed:** {completed}/{total} tasks\n\n"
-        f"💡 Click on a task to complete it:"
-    )
+    tasks_text = render('tasks', completed=completed, total=total)
     
-    await query.edit_message_text(
+    await edit_message(
+        query,
         tasks_text,
-        reply_markup=get_tasks_keyboard(user_id),
-        parse_mode='Markdown'
+        reply_markup=get_tasks_keyboard(user_data['completed_tasks'])
     )
 
 async def handle_task(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, task_id: str) -> None:
@@ -504,10 +5217,11 @@ async def handle_task(update: Update, context: ContextTypes.DEFAULT_TYPE, user_i
     Check if user joined channel/group
     """
     query = update.callback_query
-    user_data = get_user_data(user_id)
+    user_data = await get_store().get_user(user_id)
     
     # Find task
-    task = next((t for t in TASKS if t['id'] == task_id), None)
+    catalog = get_task_catalog()
+    task = catalog.get(task_id)
     if not task:
         await query.answer("Task not found!")
         return
@@ -516,28 +5230,20 @@ async def handle_task(update: Update, context: ContextTypes.DEFAULT_TYPE, user_i
     if task_id in user_data['completed_tasks']:
         await query.answer("✅ You already completed this task!")
         return
+
+    if not catalog.is_available(task_id):
+        await query.answer("⏳ This task is no longer available!", show_alert=True)
+        return
+
+    catalog.count(task_id, 'opened')
     
     # Show task details with join button
-    task_text = (
-        f"📋 **Task: {task['name']}**\n\n"
-        f"💰 **Reward:** {task['reward']} ⭐️ stars\n\n"
-        f"📝 **Instructions:**\n"
-        f"1️⃣ Click 'Join Channel' button below\n"
-        f"2️⃣ Join the channel/group\n"
-        f"3️⃣ Click 'Verify' to check and get your reward\n\n"
-        f"⚠️ Make sure you stay in the channel to receive your reward!"
-    )
-    
-    keyboard = [
-        [InlineKeyboardButton("🔗 Join Channel", url=task['link'])],
-        [InlineKeyboardButton("✅ Verify", callback_data=f"verify_{task_id}")],
-        [InlineKeyboardButton("🔙 Back to Tasks", callback_data='tasks')]
-    ]
+    task_text = render('task_details', name=task['name'], reward=task['reward'])
     
-    await query.edit_message_text(
+    await edit_message(
+        query,
         task_text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode='Markdown'
+        reply_markup=get_task_keyboard(task_id, task['link'])
     )
 
 async def verify_task_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -554,44 +5260,48 @@ async def verify_task_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     if not data.startswith('verify_'):
         return
     
-    task_id = data.replace('verify_', '')
+    task_id = data[len('verify_'):]
     
     # Find task
-    task = next((t for t in TASKS if t['id'] == task_id), None)
+    catalog = get_task_catalog()
+    task = catalog.get(task_id)
     if not task:
         await query.answer("Task not found!")
         return
     
-    user_data = get_user_data(user_id)
+    user_data = await get_store().get_user(user_id)
     
     # Check if already completed
     if task_id in user_data['completed_tasks']:
         await query.answer("✅ You already completed this task!")
         await show_tasks(update, context, user_id)
         return
+
+    if not catalog.is_available(task_id):
+        await query.answer("⏳ This task is no longer available!", show_alert=True)
+        await show_tasks(update, context, user_id)
+        return
     
     # Try to verify membership
     try:
-        member = await context.bot.get_chat_member(task['chat_id'], user_id)
+        catalog.count(task_id, 'verified')
+        is_member = await get_membership_checker().is_member(context.bot, task['chat_id'], user_id)
         
         # Check if user is a member
-        if member.status in ['member', 'administrator', 'creator']:
+        if is_member:
             # Mark task as completed
-            user_data['completed_tasks'].append(task_id)
-            add_stars(user_id, task['reward'], f"Task {task_id}")
-            update_user_data(user_id, user_data)
+            new_balance = await get_store().run(complete_task, user_id, task)
+            if new_balance is None:
+                # A concurrent press already granted this reward
+                await show_tasks(update, context, user_id)
+                return
             
-            success_text = (
-                f"✅ **Task Completed!** ✅\n\n"
-                f"Congratulations! You earned {task['reward']} ⭐️ stars!\n\n"
-                f"💰 **New Balance:** {user_data['stars']} ⭐️\n\n"
-                f"🎯 Complete more tasks to earn more stars!"
-            )
+            success_text = render('task_completed', reward=task['reward'], new_balance=new_balance)
             
-            await query.edit_message_text(
+            await edit_message(
+                query,
                 success_text,
-                reply_markup=get_back_keyboard(),
-                parse_mode='Markdown'
+                reply_markup=get_back_keyboard()
             )
         else:
             await query.answer("❌ You haven't joined the channel yet!", show_alert=True)
@@ -607,33 +5317,27 @@ async def show_referral(update: Update, context: ContextTypes.DEFAULT_TYPE, user
     Display referral information
     """
     query = update.callback_query
-    user_data = get_user_data(user_id)
+    referral_index = get_referral_index()
     
     bot_username = context.bot.username
     referral_link = f"https://t.me/{bot_username}?start={user_id}"
     
-    referrals_count = len(user_data['referrals'])
+    referrals_count = referral_index.count(user_id)
+    indirect_count = sum(referral_index.level_counts(user_id)[1:])
     total_earned = referrals_count * REFERRAL_REWARD
     
-    referral_text = (
-        f"👥 **Referral Program** 👥\n\n"
-        f"💰 Earn {REFERRAL_REWARD} ⭐️ stars for each friend!\n\n"
-        f"📊 **Your Statistics:**\n"
-        f"  • Total Referrals: {referrals_count}\n"
-        f"  • Stars Earned: {total_earned} ⭐️\n\n"
-        f"🔗 **Your Referral Link:**\n"
-        f"`{referral_link}`\n\n"
-        f"📱 **How it works:**\n"
-        f"1️⃣ Share your link with friends\n"
-        f"2️⃣ They join using your link\n"
-        f"3️⃣ You get {REFERRAL_REWARD} ⭐️ stars instantly!\n\n"
-        f"💡 The more friends you invite, the more you earn!"
+    referral_text = render(
+        'referral',
+        referrals_count=referrals_count,
+        indirect_count=indirect_count,
+        total_earned=total_earned,
+        referral_link=referral_link
     )
     
-    await query.edit_message_text(
+    await edit_message(
+        query,
         referral_text,
-        reply_markup=get_back_keyboard(),
-        parse_mode='Markdown'
+        reply_markup=get_back_keyboard()
     )
 
 async def show_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
@@ -641,32 +5345,24 @@ async def show_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE, user
     Display withdrawal options
     """
     query = update.callback_query
-    user_data = get_user_data(user_id)
+    user_data = await get_store().get_user(user_id)
     
     stars = user_data['stars']
     
-    withdraw_text = (
-        f"💰 **Withdraw Your Stars** 💰\n\n"
-        f"💎 **Your Balance:** {stars} ⭐️ stars\n\n"
-        f"📋 **Available Amounts:**\n"
-    )
+    withdraw_text = render('withdraw_header', stars=stars)
     
     for amount in WITHDRAWAL_AMOUNTS:
         if stars >= amount:
-            withdraw_text += f"  ✅ {amount} stars\n"
+            withdraw_text += render('withdraw_amount_available', amount=amount)
         else:
-            withdraw_text += f"  ❌ {amount} stars (Need {amount - stars} more)\n"
+            withdraw_text += render('withdraw_amount_short', amount=amount, missing=amount - stars)
     
-    withdraw_text += (
-        f"\n💡 **Note:** Withdrawal requests are reviewed by admin.\n"
-        f"⏰ Processing time: 24-48 hours\n\n"
-        f"👇 Select amount to withdraw:"
-    )
+    withdraw_text += render('withdraw_footer')
     
-    await query.edit_message_text(
+    await edit_message(
+        query,
         withdraw_text,
-        reply_markup=get_withdrawal_keyboard(),
-        parse_mode='Markdown'
+        reply_markup=get_withdrawal_keyboard()
     )
 
 async def process_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, amount: int) -> None:
@@ -676,104 +5372,1001 @@ async def process_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE,
     """
     query = update.callback_query
     user = update.effective_user
-    user_data = get_user_data(user_id)
     
-    stars = user_data['stars']
+    # Deduct stars and record the withdrawal request
+    store = get_store()
+    result = await store.run(create_withdrawal, user_id, amount)
     
     # Check if user has enough stars
-    if stars < amount:
+    if result is None:
+        stars = (await store.get_user(user_id))['stars']
         await query.answer(
             f"❌ Insufficient balance! You need {amount - stars} more stars.",
             show_alert=True
         )
         return
-    
-    # Deduct stars
-    user_data['stars'] = round(stars - amount, 2)
-    
-    # Record withdrawal request
-    withdrawal = {
-        'amount': amount,
-        'date': datetime.now().isoformat(),
-        'status': 'pending'
-    }
-    user_data['withdrawal_requests'].append(withdrawal)
-    update_user_data(user_id, user_data)
+    new_balance, withdrawal_id = result
     
     # Send notification to admin
-    admin_message = (
-        f"💰 **New Withdrawal Request** 💰\n\n"
-        f"👤 **User Details:**\n"
-        f"  • Name: {user.first_name}\n"
-        f"  • Username: @{user.username or 'Not set'}\n"
-        f"  • User ID: `{user_id}`\n\n"
-        f"💎 **Amount:** {amount} ⭐️ stars\n"
-        f"📅 **Date:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-        f"⚠️ Please process this request."
+    admin_message = render(
+        'withdrawal_admin',
+        first_name=user.first_name,
+        username=user.username or 'Not set',
+        user_id=user_id,
+        amount=amount,
+        date=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        withdrawal_id=withdrawal_id
     )
     
-    try:
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=admin_message,
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        logger.error(f"Could not send message to admin: {e}")
+    await get_outbox().enqueue(ADMIN_ID, admin_message, parse_mode='Markdown')
     
     # Confirm to user
-    success_text = (
-        f"✅ **Withdrawal Request Submitted!** ✅\n\n"
-        f"💎 **Amount:** {amount} ⭐️ stars\n"
-        f"💰 **New Balance:** {user_data['stars']} ⭐️\n\n"
-        f"📝 **Your request has been sent to admin.**\n"
-        f"⏰ Processing time: 24-48 hours\n\n"
-        f"💡 You will be notified once processed!"
-    )
+    success_text = render('withdrawal_submitted', amount=amount, new_balance=new_balance)
     
-    await query.edit_message_text(
+    await edit_message(
+        query,
         success_text,
-        reply_markup=get_back_keyboard(),
-        parse_mode='Markdown'
+        reply_markup=get_back_keyboard()
     )
 
+# =====================================================
+# INSTRUMENTATION - Handler timing and runtime gauges
+# =====================================================
+
+# Label values are restricted to known routes to keep metric cardinality bounded
+COMMAND_ROUTES = ('start', 'help', 'account', 'top', 'botstats', 'taskstats', 'withdrawals', 'approve', 'reject', 'broadcast')
+CALLBACK_ROUTES = ('main_menu', 'account', 'daily_gift', 'reminders_on', 'reminders_off', 'tasks', 'referral', 'withdraw', 'help')
+CALLBACK_ROUTE_PREFIXES = ('task_', 'withdraw_', 'verify_')
+
+def update_route(update: Update) -> str:
+    """
+    Classify an update by command or callback route, e.g. '/start' or 'task_*'
+    """
+    query = update.callback_query
+    if query is not None:
+        data = query.data or ''
+        for prefix in CALLBACK_ROUTE_PREFIXES:
+            if data.startswith(prefix):
+                return prefix + '*'
+        return data if data in CALLBACK_ROUTES else 'other'
+
+    message = update.effective_message
+    if message is not None and message.text and message.text.startswith('/'):
+        command = message.text.split()[0][1:].split('@')[0].lower()
+        if command in COMMAND_ROUTES:
+            return '/' + command
+    return 'other'
+
+def instrument_handler(callback: Callable) -> Callable:
+    """
+    Wrap a handler callback with latency and outcome metrics
+    """
+    handler_name = callback.__name__
+
+    @wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        route = update_route(update)
+        outcome = 'error'
+        start = time.perf_counter()
+        try:
+            result = await callback(update, context)
+            outcome = 'ok'
+            return result
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, handler_name, route)
+            HANDLER_CALLS.inc(handler_name, route, outcome)
+            get_health_monitor().last_update = time.monotonic()
+
+    return wrapper
+
+def _metric_lines(name: str, kind: str, help_text: str, value: float) -> List[str]:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+def collect_runtime_metrics() -> Iterator[str]:
+    """
+    Cache, queue and index statistics read at scrape time
+    """
+    cache = get_user_cache().stats()
+    yield from _metric_lines('bot_user_cache_size', 'gauge', "Users held in the cache", cache['size'])
+    yield from _metric_lines('bot_user_cache_dirty', 'gauge', "Cached users waiting to be flushed", cache['dirty'])
+    yield from _metric_lines('bot_user_cache_hits_total', 'counter', "User cache hits", cache['hits'])
+    yield from _metric_lines('bot_user_cache_misses_total', 'counter', "User cache misses", cache['misses'])
+    yield from _metric_lines('bot_user_cache_evictions_total', 'counter', "User cache evictions", cache['evictions'])
+
+    storage = get_storage()
+    if isinstance(storage, JournalStorage):
+        yield from _metric_lines('bot_journal_bytes', 'gauge', "Bytes in the storage journal", storage.journal_size())
+
+    health = get_health_monitor()
+    yield from _metric_lines('bot_event_loop_lag_max_seconds', 'gauge', "Worst event loop lag in the last 30 seconds",
+                             health.max_lag())
+    if health.last_update is not None:
+        yield from _metric_lines('bot_last_update_age_seconds', 'gauge', "Seconds since an update was last handled",
+                                 round(time.monotonic() - health.last_update, 3))
+
+    outbox = get_outbox().stats()
+    yield from _metric_lines('bot_outbox_depth', 'gauge', "Messages waiting to be sent", outbox['depth'])
+    yield from _metric_lines('bot_outbox_sent_total', 'counter', "Messages delivered", outbox['sent'])
+    yield from _metric_lines('bot_outbox_failed_total', 'counter', "Messages dropped", outbox['failed'])
+    yield from _metric_lines('bot_outbox_retried_total', 'counter', "Message delivery retries", outbox['retried'])
+
+    membership = get_membership_checker().stats()
+    yield from _metric_lines('bot_membership_cache_hits_total', 'counter', "Membership checks answered from cache", membership['hits'])
+    yield from _metric_lines('bot_membership_api_calls_total', 'counter', "getChatMember calls made", membership['api_calls'])
+    yield from _metric_lines('bot_membership_queued', 'gauge', "Membership checks waiting for a token", membership['queued'])
+
+    yield from _metric_lines('bot_referrals', 'gauge', "Referral edges in the index", len(get_referral_index()))
+    if _reminder_schedule is not None:
+        yield from _metric_lines('bot_reminders_scheduled', 'gauge', "Daily gift reminders waiting to be sent",
+                                 len(_reminder_schedule))
+    yield "# HELP bot_task_completions Users who completed each task"
+    yield "# TYPE bot_task_completions gauge"
+    for task in get_task_catalog().stats():
+        yield f'bot_task_completions{{task="{task["id"]}"}} {task["completions"]}'
+    yield "# HELP bot_leaderboard_users Users ranked on each leaderboard"
+    yield "# TYPE bot_leaderboard_users gauge"
+    leaderboard = get_leaderboard()
+    for board in Leaderboard.BOARDS:
+        yield f'bot_leaderboard_users{{board="{board}"}} {leaderboard.size(board)}'
+
+METRIC_COLLECTORS.append(collect_runtime_metrics)
+
+async def metrics_endpoint(body: bytes, headers: Dict[str, str]) -> tuple:
+    """
+    GET /metrics
+    """
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', render_metrics()
+
+# =====================================================
+# HEALTH CHECKS - Liveness and readiness endpoints
+# =====================================================
+
+LOOP_LAG = Histogram('bot_event_loop_lag_seconds', "How late the event loop woke up a timer")
+METRICS.append(LOOP_LAG)
+
+class HealthMonitor:
+    """
+    Liveness and readiness for /healthz and /readyz
+    A ticker measures event loop lag, handlers and Bot API calls report in
+    as they finish, and further checks are registered per process.
+    Liveness checks failing means a restart should help (loop or storage
+    wedged); readiness also covers conditions that pass on their own
+    """
+
+    def __init__(self, interval: float = 0.5, window: float = 30):
+        self.interval = interval
+        self._lags: deque = deque(maxlen=max(1, int(window / interval)))
+        self.last_update: Optional[float] = None
+        self.last_api_error: Optional[Dict] = None
+        self.last_api_error_at = 0.0
+        self.retry_until = 0.0
+        # name -> (async check returning (ok, details), part of liveness)
+        self._checks: Dict[str, tuple] = {}
+
+    def add_check(self, name: str, check: Callable[[], Awaitable[tuple]], liveness: bool = False) -> None:
+        """
+        Register an async check returning (ok, details)
+        """
+        self._checks[name] = (check, liveness)
+
+    async def watch_loop(self) -> None:
+        """
+        Sleep interval seconds at a time and record how late each wakeup was
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self._lags.append(lag)
+            LOOP_LAG.observe(lag)
+
+    def max_lag(self) -> float:
+        """
+        Worst lag seen in the window
+        """
+        return round(max(self._lags, default=0.0), 3)
+
+    def api_error(self, method: str, code: Optional[int], payload: bytes) -> None:
+        """
+        Remember a failed Bot API call and any flood wait it asked for
+        """
+        description = payload.decode('utf-8', 'replace')[:200]
+        retry_after = None
+        try:
+            response = json.loads(payload)
+            description = response.get('description', description)
+            retry_after = (response.get('parameters') or {}).get('retry_after')
+        except (ValueError, AttributeError):
+            pass
+        self.last_api_error = {
+            'method': method,
+            'code': code,
+            'description': description,
+        }
+        self.last_api_error_at = time.monotonic()
+        if retry_after:
+            self.retry_until = max(self.retry_until, time.monotonic() + retry_after)
+
+    async def report(self, readiness: bool) -> tuple:
+        """
+        Run the checks and return (healthy, report)
+        """
+        now = time.monotonic()
+        checks = {'event_loop': (self.max_lag() <= HEALTH_MAX_LOOP_LAG, {
+            'lag': round(self._lags[-1], 3) if self._lags else 0.0,
+            'max_lag': self.max_lag(),
+        })}
+        retry_after = max(0.0, self.retry_until - now)
+        last_error = None
+        if self.last_api_error is not None:
+            last_error = dict(self.last_api_error, age=round(now - self.last_api_error_at, 1))
+        api = (retry_after <= HEALTH_MAX_RETRY_AFTER, {'retry_after': round(retry_after, 1), 'last_error': last_error})
+        if readiness:
+            checks['bot_api'] = api
+        for name, (check, liveness) in self._checks.items():
+            if readiness or liveness:
+                try:
+                    checks[name] = await check()
+                except Exception as e:
+                    checks[name] = (False, {'error': str(e)})
+
+        healthy = all(ok for ok, _ in checks.values())
+        report = {
+            'status': 'ok' if healthy else 'fail',
+            'last_update_age': round(now - self.last_update, 1) if self.last_update is not None else None,
+            'checks': {name: dict(details, ok=ok) for name, (ok, details) in checks.items()},
+        }
+        if not readiness:
+            report['bot_api'] = api[1]
+        return healthy, report
+
+    async def endpoint(self, readiness: bool) -> tuple:
+        healthy, report = await self.report(readiness)
+        return 200 if healthy else 503, 'application/json', json.dumps(report) + '\n'
+
+_health_monitor: Optional[HealthMonitor] = None
+
+def get_health_monitor() -> HealthMonitor:
+    """
+    Return the process-wide health monitor, creating it on first use
+    """
+    global _health_monitor
+    if _health_monitor is None:
+        _health_monitor = HealthMonitor()
+    return _health_monitor
+
+_storage_probe: Optional[asyncio.Future] = None
+
+async def check_storage() -> tuple:
+    """
+    Time a single-user read through the storage threads
+    Only one probe runs at a time, so a wedged pool doesn't pile them up
+    """
+    global _storage_probe
+
+    async def probe() -> float:
+        start = time.perf_counter()
+        await get_store().run(get_storage().get_user, 0)
+        return time.perf_counter() - start
+
+    if _storage_probe is None or _storage_probe.done():
+        _storage_probe = asyncio.ensure_future(probe())
+    try:
+        latency = await asyncio.wait_for(asyncio.shield(_storage_probe), HEALTH_STORAGE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return False, {'latency': None, 'error': f"no answer within {HEALTH_STORAGE_TIMEOUT}s"}
+    return True, {'latency': round(latency, 4), 'pending': get_store().pending}
+
+async def check_outbox() -> tuple:
+    """
+    Outbound queue depth against HEALTH_MAX_OUTBOX
+    """
+    depth = get_outbox().depth()
+    return depth <= HEALTH_MAX_OUTBOX, {'depth': depth}
+
+async def healthz_endpoint(body: bytes, headers: Dict[str, str]) -> tuple:
+    """
+    GET /healthz - liveness: 503 when the loop or storage is wedged
+    """
+    return await get_health_monitor().endpoint(readiness=False)
+
+async def readyz_endpoint(body: bytes, headers: Dict[str, str]) -> tuple:
+    """
+    GET /readyz - readiness: also 503 during long flood waits or a backed up outbox
+    """
+    return await get_health_monitor().endpoint(readiness=True)
+
+# =====================================================
+# CLUSTER MODE - Worker processes sharded by user_id
+# =====================================================
+
+def shard_of(user_id: int, shard_count: int) -> int:
+    """
+    Index of the worker that owns user_id
+    """
+    return user_id % shard_count
+
+def shard_path(path: str, shard: int) -> str:
+    """
+    Per-worker variant of a file path, e.g. bot_outbox.shard2.sqlite3
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext}"
+
+def update_user_id(update: Dict) -> Optional[int]:
+    """
+    Pull the sender's id out of a raw update dict
+    """
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from'].get('id')
+    return None
+
+class ClusterNode:
+    """
+    A worker's view of the cluster
+    Every worker has an inbox queue. Updates from the dispatcher and
+    operations from other workers arrive there as (kind, payload) tuples
+    """
+
+    def __init__(self, shard: int, inboxes: List):
+        self.shard = shard
+        self.inboxes = inboxes
+        self.ops_sent = 0
+        self.ops_received = 0
+
+    def owner(self, user_id: int) -> int:
+        return shard_of(user_id, len(self.inboxes))
+
+    def is_local(self, user_id: int) -> bool:
+        return self.owner(user_id) == self.shard
+
+    def send(self, shard: int, op: str, *args) -> None:
+        """
+        Ask another worker to run CLUSTER_OPS[op](*args)
+        """
+        self.inboxes[shard].put(('op', (op, args)))
+        self.ops_sent += 1
+
+    def broadcast(self, op: str, *args) -> None:
+        """
+        Ask every other worker to run CLUSTER_OPS[op](*args)
+        """
+        for shard in range(len(self.inboxes)):
+            if shard != self.shard:
+                self.send(shard, op, *args)
+
+_cluster: Optional[ClusterNode] = None
+
+def record_shared_completion(task_id: str) -> None:
+    """
+    Count a task completion made on another worker
+    """
+    get_task_catalog().record_completion(task_id)
+
+def release_shared_completion(task_id: str) -> None:
+    """
+    Uncount a task completion revoked on another worker
+    """
+    get_task_catalog().release(task_id)
+
+def set_shared_score(board: str, user_id: int, score: float) -> None:
+    """
+    Apply a leaderboard change made on another worker
+    """
+    get_leaderboard().set_score(board, user_id, score)
+
+# Operations one worker may ask another to run
+CLUSTER_OPS = {
+    'increment_stars': increment_stars,
+    'set_user_blocked': set_user_blocked,
+    'add_referral': record_referral,
+    'set_score': set_shared_score,
+    'task_completed': record_shared_completion,
+    'task_released': release_shared_completion,
+}
+
+def run_user_op(user_id: int, op: str, *args) -> Any:
+    """
+    Run a user-state operation on the worker that owns user_id
+    Outside cluster mode, or for local users, it runs inline and its result
+    is returned; otherwise it is sent to the owner and None is returned
+    """
+    if _cluster is not None and not _cluster.is_local(user_id):
+        _cluster.send(_cluster.owner(user_id), op, user_id, *args)
+        return None
+    return CLUSTER_OPS[op](user_id, *args)
+
+def share_referral(referrer_id: int, referee_id: int) -> None:
+    """
+    Tell the other workers about a new referral edge
+    """
+    if _cluster is not None:
+        _cluster.broadcast('add_referral', referrer_id, referee_id)
+
+def share_task_completion(task_id: str) -> None:
+    """
+    Tell the other workers a task was completed, so caps hold cluster-wide
+    """
+    if _cluster is not None:
+        _cluster.broadcast('task_completed', task_id)
+
+def share_task_release(task_id: str) -> None:
+    """
+    Tell the other workers a task completion was revoked
+    """
+    if _cluster is not None:
+        _cluster.broadcast('task_released', task_id)
+
+def share_score(board: str, user_id: int, score: float) -> None:
+    """
+    Tell the other workers about a changed leaderboard score
+    """
+    if _cluster is not None:
+        _cluster.broadcast('set_score', board, user_id, score)
+
+def configure_worker(shard: int, shard_count: int) -> None:
+    """
+    Give this worker process its own outbox, broadcast and sweep files and an
+    even share of the Telegram rate limits
+    """
+    global OUTBOX_FILE, BROADCAST_STATE_FILE, OUTBOX_GLOBAL_RATE
+    global MEMBERSHIP_CHECK_RATE, MEMBERSHIP_CHECK_BURST, METRICS_PORT, SWEEP_STATE_FILE, SWEEP_RATE
+    global SNAPSHOT_INTERVAL
+    OUTBOX_FILE = shard_path(OUTBOX_FILE, shard)
+    BROADCAST_STATE_FILE = shard_path(BROADCAST_STATE_FILE, shard)
+    SWEEP_STATE_FILE = shard_path(SWEEP_STATE_FILE, shard)
+    SWEEP_RATE = SWEEP_RATE / shard_count
+    OUTBOX_GLOBAL_RATE = OUTBOX_GLOBAL_RATE / shard_count
+    MEMBERSHIP_CHECK_RATE = MEMBERSHIP_CHECK_RATE / shard_count
+    MEMBERSHIP_CHECK_BURST = max(1.0, MEMBERSHIP_CHECK_BURST / shard_count)
+    if shard != 0:
+        # Workers share one database, so only the first one snapshots it
+        SNAPSHOT_INTERVAL = 0
+    if METRICS_PORT:
+        # The dispatcher keeps METRICS_PORT, workers take the next ones
+        METRICS_PORT = METRICS_PORT + 1 + shard
+
+def run_worker(shard: int, inboxes: List) -> None:
+    """
+    Entry point of a cluster worker process
+    """
+    # Ctrl+C reaches the whole process group; the dispatcher decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global _cluster
+    configure_worker(shard, len(inboxes))
+    _cluster = ClusterNode(shard, inboxes)
+    asyncio.run(serve_worker(_cluster))
+
+async def serve_worker(node: ClusterNode) -> None:
+    """
+    Handle updates and cluster operations from this worker's inbox until
+    the dispatcher sends None
+    """
+    get_storage()
+    get_referral_index()
+    get_leaderboard()
+    get_task_catalog()
+    application = build_application(with_updater=False)
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    logger.info(f"Cluster worker {node.shard} ready")
+
+    loop = asyncio.get_running_loop()
+    inbox = node.inboxes[node.shard]
+    try:
+        while True:
+            message = await loop.run_in_executor(None, inbox.get)
+            if message is None:
+                break
+            kind, payload = message
+            if kind == 'update':
+                await application.update_queue.put(Update.de_json(payload, application.bot))
+                continue
+            op, args = payload
+            node.ops_received += 1
+            try:
+                await get_store().run(CLUSTER_OPS[op], *args)
+            except Exception as e:
+                logger.error(f"Cluster operation {op}{args} failed: {e}")
+    finally:
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+        logger.info(f"Cluster worker {node.shard} stopped")
+
+DISPATCHED_UPDATES = Counter('bot_dispatched_updates_total', "Updates forwarded to each cluster worker", ('shard',))
+
+class Dispatcher:
+    """
+    Front process in cluster mode
+    Receives updates by webhook or long polling and forwards each one to the
+    worker that owns its user, so one user's updates always land on the
+    same process and its cached state never needs cross-process locking
+    """
+
+    def __init__(self, worker_count: int):
+        context = multiprocessing.get_context('spawn')
+        self.inboxes = [context.Queue() for _ in range(worker_count)]
+        self.workers = [
+            context.Process(target=run_worker, args=(shard, self.inboxes), name=f"bot-worker-{shard}")
+            for shard in range(worker_count)
+        ]
+
+    def dispatch(self, update: Dict) -> None:
+        user_id = update_user_id(update)
+        shard = shard_of(user_id, len(self.inboxes)) if user_id is not None else 0
+        self.inboxes[shard].put(('update', update))
+        DISPATCHED_UPDATES.inc(str(shard))
+        get_health_monitor().last_update = time.monotonic()
+
+    def start(self) -> None:
+        for worker in self.workers:
+            worker.start()
+        logger.info(f"Started {len(self.workers)} cluster workers")
+
+    def stop(self) -> None:
+        """
+        Let every worker drain its inbox, flush and exit
+        """
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for worker in self.workers:
+            worker.join(timeout=60)
+            if worker.is_alive():
+                logger.error(f"{worker.name} did not stop in time, terminating it")
+                worker.terminate()
+
+    async def serve(self) -> None:
+        """
+        Receive updates until SIGINT or SIGTERM
+        """
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+
+        bot = Bot(BOT_TOKEN, base_url=BOT_API_BASE_URL,
+                  request=InstrumentedRequest(connection_pool_size=4),
+                  get_updates_request=InstrumentedRequest())
+        servers = []
+        if METRICS_PORT:
+            metrics_server = HttpServer(METRICS_LISTEN, METRICS_PORT)
+            metrics_server.route('GET', '/metrics', self._metrics)
+            metrics_server.route('GET', '/healthz', healthz_endpoint)
+            metrics_server.route('GET', '/readyz', readyz_endpoint)
+            servers.append(metrics_server)
+        if BOT_MODE == 'webhook':
+            webhook_server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+            webhook_server.route('POST', f"/{WEBHOOK_PATH}", self._webhook)
+            servers.append(webhook_server)
+
+        front = None
+        watcher = asyncio.create_task(get_health_monitor().watch_loop())
+        async with bot:
+            for server in servers:
+                await server.start()
+            if BOT_MODE == 'webhook':
+                await bot.set_webhook(
+                    url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                    allowed_updates=ALLOWED_UPDATES,
+                    secret_token=WEBHOOK_SECRET or None
+                )
+            else:
+                front = asyncio.create_task(self._poll(bot))
+
+            await stopped.wait()
+            logger.info("Stopping dispatcher")
+            if front is not None:
+                front.cancel()
+                await asyncio.gather(front, return_exceptions=True)
+            for server in servers:
+                await server.stop()
+            watcher.cancel()
+
+    async def _poll(self, bot: Bot) -> None:
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except (TimedOut, NetworkError) as e:
+                logger.warning(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self.dispatch(update.to_dict())
+
+    async def _webhook(self, body: bytes, headers: Dict[str, str]) -> tuple:
+        if WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+            return 403, 'text/plain', b'forbidden\n'
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400, 'text/plain', b'invalid update\n'
+        self.dispatch(update)
+        return 200, 'text/plain', b'ok\n'
+
+    async def _metrics(self, body: bytes, headers: Dict[str, str]) -> tuple:
+        lines = DISPATCHED_UPDATES.render() + API_LATENCY.render() + API_CALLS.render() + LOOP_LAG.render()
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', '\n'.join(lines) + '\n'
+
 # =====================================================
 # MAIN FUNCTION - Start the bot
 # =====================================================
 
-def main() -> None:
+async def on_startup(application: Application) -> None:
     """
-    Main function to start the bot
-    Initialize handlers and start polling
+    Start background tasks once the application is initialized
+    """
+    health = get_health_monitor()
+    health.add_check('storage', check_storage, liveness=True)
+    health.add_check('outbox', check_outbox)
+    application.bot_data['background_tasks'] = [
+        asyncio.create_task(cache_flush_loop()),
+        asyncio.create_task(health.watch_loop()),
+    ]
+    storage = get_storage()
+    if isinstance(storage, JournalStorage):
+        application.bot_data['background_tasks'].append(
+            asyncio.create_task(journal_maintenance_loop(storage))
+        )
+    if SNAPSHOT_INTERVAL > 0:
+        application.bot_data['background_tasks'].append(asyncio.create_task(snapshot_loop()))
+    outbox = get_outbox()
+    outbox.blocked_callbacks.append(lambda chat_id: get_store().run(run_user_op, chat_id, 'set_user_blocked', True))
+    outbox.start(application.bot)
+    get_broadcaster().resume(application.bot)
+    if SWEEP_INTERVAL > 0:
+        get_sweeper().start(application.bot)
+
+    if REMINDER_INTERVAL > 0:
+        get_reminder_schedule()
+        if application.job_queue is None:
+            logger.warning("Daily gift reminders need the job queue: pip install 'python-telegram-bot[job-queue]'")
+        else:
+            application.job_queue.run_repeating(send_daily_reminders, interval=REMINDER_INTERVAL, name='daily_reminders')
+
+    if METRICS_PORT:
+        server = HttpServer(METRICS_LISTEN, METRICS_PORT)
+        server.route('GET', '/metrics', metrics_endpoint)
+        server.route('GET', '/healthz', healthz_endpoint)
+        server.route('GET', '/readyz', readyz_endpoint)
+        try:
+            await server.start()
+        except OSError as e:
+            logger.error(f"Could not start metrics endpoint on {METRICS_LISTEN}:{METRICS_PORT}: {e}")
+        else:
+            application.bot_data['http_server'] = server
+
+async def on_shutdown(application: Application) -> None:
+    """
+    Stop background tasks and flush everything still buffered in memory
+    """
+    for task in application.bot_data.get('background_tasks', []):
+        task.cancel()
+    server = application.bot_data.get('http_server')
+    if server is not None:
+        await server.stop()
+    await get_broadcaster().stop()
+    await get_sweeper().stop()
+    await get_outbox().stop()
+
+    cache = get_user_cache()
+    store = get_store()
+    flushed = await store.run(cache.flush)
+    store.close()
+    logger.info(f"Flushed {flushed} cached users on shutdown. Cache stats: {cache.stats()}")
+    get_storage().close()
+
+def build_application(with_updater: bool = True) -> Application:
+    """
+    Create the application and register all handlers
+    Cluster workers get their updates from the dispatcher and run without an updater
+    """
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_BASE_URL)
+        .request(InstrumentedRequest(connection_pool_size=CONNECTION_POOL_SIZE))
+        .get_updates_request(InstrumentedRequest())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(CONCURRENT_UPDATES)
+    if not with_updater:
+        builder = builder.updater(None)
+    application = builder.build()
+    register_handlers(application)
+    return application
+
+def register_handlers(application: Application) -> None:
+    """
+    Register all command and callback handlers
+    Every callback is wrapped with latency and outcome metrics
+    """
+    # Drop duplicate and excess button presses before any handler runs
+    if THROTTLE_RATE > 0:
+        application.add_handler(TypeHandler(Update, throttle_callbacks), group=-1)
+
+    # Register command handlers
+    application.add_handler(CommandHandler("start", instrument_handler(start_command)))
+    application.add_handler(CommandHandler("help", instrument_handler(help_command)))
+    application.add_handler(CommandHandler("account", instrument_handler(account_command)))
+    application.add_handler(CommandHandler("top", instrument_handler(top_command)))
+    application.add_handler(CommandHandler("botstats", instrument_handler(bot_stats_command)))
+    application.add_handler(CommandHandler("taskstats", instrument_handler(task_stats_command)))
+    application.add_handler(CommandHandler("withdrawals", instrument_handler(withdrawals_command)))
+    application.add_handler(CommandHandler("approve", instrument_handler(approve_command)))
+    application.add_handler(CommandHandler("reject", instrument_handler(reject_command)))
+    application.add_handler(CommandHandler("broadcast", instrument_handler(broadcast_command)))
+    
+    # Register callback handlers
+    application.add_handler(CallbackQueryHandler(instrument_handler(verify_task_callback), pattern='^verify_'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(button_callback)))
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse command line arguments
+    Running without a subcommand starts the bot
+    """
+    parser = argparse.ArgumentParser(description="Telegram Stars Bot")
+    subparsers = parser.add_subparsers(dest='command')
+
+    migrate_parser = subparsers.add_parser('migrate', help="Import a JSON database into SQLite")
+    migrate_parser.add_argument('--source', default=DATABASE_FILE, help="JSON database to import")
+    migrate_parser.add_argument('--target', default=SQLITE_DATABASE_FILE, help="SQLite database to write")
+
+    stats_parser = subparsers.add_parser('stats', help="Print user, balance, withdrawal and task totals")
+    stats_parser.add_argument('--json', action='store_true', help="Print the totals as JSON")
+
+    export_parser = subparsers.add_parser('export', help="Export user records as CSV or JSON lines")
+    export_parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv', help="Output format")
+    export_parser.add_argument('--output', default='-', help="File to write, - for stdout")
+
+    subparsers.add_parser('snapshot', help="Write a snapshot of the configured storage now")
+
+    restore_parser = subparsers.add_parser('restore', help="Restore the configured storage from a snapshot")
+    restore_parser.add_argument('snapshot', nargs='?', help="Snapshot to restore; lists the snapshots when omitted")
+    restore_parser.add_argument('--force', action='store_true', help="Replace existing data (kept as *.pre-restore)")
+
+    cluster_parser = subparsers.add_parser('cluster', help="Run a dispatcher with worker processes sharded by user id")
+    cluster_parser.add_argument('--workers', type=int, default=CLUSTER_WORKERS, help="Number of worker processes")
+
+    return parser.parse_args(argv)
+
+def migrate_command(args: argparse.Namespace) -> None:
+    """
+    Handle `python bot.py migrate`
+    """
+    if not os.path.exists(args.source):
+        print(f"❌ Error: {args.source} not found")
+        return
+
+    if os.path.exists(args.target):
+        print(f"❌ Error: {args.target} already exists, refusing to migrate twice")
+        return
+
+    target = SQLiteStorage(args.target)
+    try:
+        count = import_json_database(args.source, target)
+    finally:
+        target.close()
+    print(f"✅ Migrated {count} users from {args.source} to {args.target}")
+
+def stats_command(args: argparse.Namespace) -> None:
+    """
+    Handle `python bot.py stats`
+    Totals come from one pass over the configured storage
+    """
+    storage = open_report_storage()
+    totals = UserStats(datetime.now())
+    for record in storage.iter_users():
+        totals.add(record)
+    catalog = TaskCatalog(TASKS_FILE, TASKS, TASKS_RELOAD_INTERVAL, {})
+    tasks = {task['id']: task['name'] for task in catalog.stats()}
+    report = totals.report(storage.withdrawal_totals('pending'), tasks)
+    storage.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+
+    print(f"📊 Stats from {storage.name} storage")
+    print(f"👥 Users: {report['users']} ({report['blocked']} blocked, {report['joined_last_7d']} joined in the last 7 days)")
+    print(f"⭐️ Stars outstanding: {report['stars_outstanding']} across {report['users_with_balance']} users "
+          f"(max {report['max_balance']})")
+    print(f"⏳ Pending withdrawals: {report['pending_withdrawals']} ({report['pending_withdrawal_stars']} stars)")
+    print(f"👥 Referred users: {report['referred_users']}")
+    print(f"🎁 Daily gift claimed in the last 24h: {report['daily_gift_last_24h']} "
+          f"({report['reminders_enabled']} with reminders)")
+    print("📋 Task completions:")
+    for task in report['tasks']:
+        print(f"  {task['id']} {task['name']}: {task['completions']} ({task['rate']:.1%})")
+
+def export_command(args: argparse.Namespace) -> None:
+    """
+    Handle `python bot.py export`
+    Records are written as they are read, one at a time
+    """
+    storage = open_report_storage()
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')
+    count = 0
+    try:
+        if args.format == 'csv':
+            writer = csv.DictWriter(output, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+        for record in storage.iter_users():
+            row = export_row(record)
+            if args.format == 'csv':
+                row['completed_tasks'] = ' '.join(row['completed_tasks'])
+                writer.writerow(row)
+            else:
+                output.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n')
+            count += 1
+    finally:
+        storage.close()
+        if output is not sys.stdout:
+            output.close()
+
+    # Keep stdout clean when it carries the export
+    print(f"✅ Exported {count} users from {storage.name} storage to {args.output}",
+          file=sys.stderr if args.output == '-' else sys.stdout)
+
+def snapshot_command(args: argparse.Namespace) -> None:
+    """
+    Handle `python bot.py snapshot`
+    """
+    storage = open_report_storage()
+    manager = get_snapshots()
+    try:
+        path = manager.take(storage)
+    finally:
+        storage.close()
+    print(f"✅ Wrote {path} ({manager.last['bytes']} bytes in {manager.last['seconds']}s)")
+
+def restore_command(args: argparse.Namespace) -> None:
+    """
+    Handle `python bot.py restore`
+    Run it while the bot is stopped
+    """
+    manager = get_snapshots()
+    if not args.snapshot:
+        paths = manager.list()
+        if not paths:
+            print(f"No snapshots in {manager.directory}")
+        for path in paths:
+            print(f"{path}  {os.path.getsize(path)} bytes")
+        return
+
+    backend = os.path.basename(args.snapshot).split('-', 1)[0]
+    if backend != STORAGE_BACKEND:
+        print(f"❌ Error: {args.snapshot} is a {backend} snapshot but STORAGE_BACKEND is {STORAGE_BACKEND}")
+        return
+
+    files = storage_files(backend)
+    if any(os.path.exists(path) for path in files) and not args.force:
+        print(f"❌ Error: {files[0]} already has data, pass --force to replace it")
+        return
+
+    try:
+        manager.restore(args.snapshot, files)
+    except (OSError, ValueError, EOFError) as e:
+        print(f"❌ Error: {e}")
+        return
+    print(f"✅ Restored {files[0]} from {args.snapshot}")
+
+def check_config() -> bool:
+    """
+    Validate settings needed to serve updates
+    Prints the problem and returns False if the bot can't start
     """
     # Check if token is provided
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN environment variable is not set!")
         print("❌ Error: Please set BOT_TOKEN environment variable")
-        return
+        return False
     
     if not ADMIN_ID or ADMIN_ID == 0:
         logger.warning("ADMIN_ID environment variable is not set!")
         print("⚠️ Warning: ADMIN_ID not set. Withdrawal notifications won't work.")
     
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    if BOT_MODE not in ('polling', 'webhook'):
+        print(f"❌ Error: BOT_MODE must be 'polling' or 'webhook', got '{BOT_MODE}'")
+        return False
     
-    # Register command handlers
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("account", account_command))
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL environment variable is not set!")
+        print("❌ Error: Please set WEBHOOK_URL to run in webhook mode")
+        return False
+    return True
+
+def cluster_command(args: argparse.Namespace) -> None:
+    """
+    Handle `python bot.py cluster`
+    """
+    if args.workers < 1:
+        print("❌ Error: --workers must be at least 1")
+        return
+
+    # Workers share one database file, which only SQLite supports
+    if STORAGE_BACKEND != 'sqlite':
+        print(f"❌ Error: cluster mode needs STORAGE_BACKEND=sqlite, got '{STORAGE_BACKEND}'")
+        return
+
+    # Migrate a legacy JSON database once, before the workers open the file
+    get_storage().close()
+
+    dispatcher = Dispatcher(args.workers)
+    dispatcher.start()
+    print(f"✅ Bot is running with {args.workers} workers... Press Ctrl+C to stop")
+    try:
+        asyncio.run(dispatcher.serve())
+    finally:
+        dispatcher.stop()
+
+def main() -> None:
+    """
+    Main function to start the bot
+    Initialize handlers and start polling or the webhook server
+    """
+    args = parse_args()
+    if args.command == 'migrate':
+        migrate_command(args)
+        return
+    if args.command == 'stats':
+        stats_command(args)
+        return
+    if args.command == 'export':
+        export_command(args)
+        return
+    if args.command == 'snapshot':
+        snapshot_command(args)
+        return
+    if args.command == 'restore':
+        restore_command(args)
+        return
+
+    if not check_config():
+        return
+
+    if args.command == 'cluster':
+        cluster_command(args)
+        return
     
-    # Register callback handlers
-    application.add_handler(CallbackQueryHandler(verify_task_callback, pattern='^verify_'))
-    application.add_handler(CallbackQueryHandler(button_callback))
+    # Open storage up front so a legacy JSON database is migrated before any update
+    storage = get_storage()
+    logger.info(f"Using {storage.name} storage backend")
+    get_referral_index()
+    get_leaderboard()
+    get_task_catalog()
+
+    application = build_application()
     
     # Start bot
     logger.info("🤖 Bot started successfully!")
     print("✅ Bot is running... Press Ctrl+C to stop")
     
     # Run bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        logger.info(f"Serving webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()